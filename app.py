@@ -1,11 +1,26 @@
 # Kaelynn lackey
 # 1 December 2025
 import click
-from pipeline import etl_pipeline
+from configuration import Config
 import json
+import os
+from datetime import date, timedelta
 
 # cases: fetch, state, summary, timeline, top
 
+# commands import what they use, so queries start without loading the
+# extractor, numpy or requests
+
+
+def _open_queries(read_only: bool = True):
+    """Query handle on the existing database; nothing is extracted and no
+    schema DDL runs."""
+    from queries import query_service
+    try:
+        return query_service(read_only=read_only)
+    except FileNotFoundError as e:
+        raise click.ClickException(str(e))
+
 @click.group()
 def cli():
     """covid data ETL pipeline"""
@@ -15,16 +30,64 @@ def cli():
 @click.option('--state', help='State code (e.g., CA, NY)')
 @click.option('--all-states', is_flag=True, help='Fetch all states')
 @click.option('--limit', default=None, type=int, help='Limit number of states')
-def fetch(state, all_states, limit):
-    pipeline=etl_pipeline()
+@click.option('--indexed', is_flag=True,
+              help='Read states through a byte-offset index of the CSV')
+@click.option('--incremental', is_flag=True,
+              help='Only write rows that are new or changed since the last load')
+@click.option('--workers', default=1, type=int,
+              help='Extract and clean states in N worker processes')
+@click.option('--bulk', is_flag=True,
+              help='Full reload in one transaction with index rebuilds')
+@click.option('--resume', is_flag=True,
+              help='With --all-states, skip states the last run on the same input committed')
+@click.option('--api', default=None, metavar='URL',
+              help='Fetch from a covidtracking-style JSON API instead of the CSV')
+@click.option('--metrics-json', type=click.Path(dir_okay=False),
+              help='Write a JSON run report with stage timings and row counts')
+@click.option('--metrics-prom', type=click.Path(dir_okay=False),
+              help='Write the run metrics as a Prometheus textfile')
+def fetch(state, all_states, limit, indexed, incremental, workers, bulk, resume,
+          api, metrics_json, metrics_prom):
+    if bulk and incremental:
+        raise click.UsageError("--bulk and --incremental are mutually exclusive")
+    if resume and not all_states:
+        raise click.UsageError("--resume applies to --all-states loads")
+    from pipeline import etl_pipeline
+    from metrics import run_metrics
+
+    metrics = run_metrics() if metrics_json or metrics_prom else None
+    config = Config(csv_index=indexed)
+    if api:
+        config.api = api
+    pipeline=etl_pipeline(config, metrics=metrics)
     if all_states:
-        total = pipeline.run_for_all_states(limit=100)
-        click.echo(f"loaded {total} records across all states")
+        total = pipeline.run_for_all_states(
+            limit=100, incremental=incremental, workers=workers, bulk=bulk,
+            resume=resume,
+        )
+        click.echo(f"loaded {total} records across all states (run {pipeline.run_id})")
+        if pipeline.failed_states:
+            click.echo(
+                f"failed: {', '.join(pipeline.failed_states)}; "
+                "rerun with --resume to retry them"
+            )
     elif state:
-        records = pipeline.run_for_state(state)
-        click.echo(f"loaded {len(records)} records for {state}")
+        written = pipeline.run_for_state(state, incremental=incremental)
+        pipeline.metrics.finish_run()
+        click.echo(f"loaded {written} records for {state}")
     else:
         click.echo("error: Specify --state CODE or --all-states")
+        return
+    if incremental:
+        totals = pipeline.load_totals()
+        click.echo(
+            f"inserted {totals['inserted']}, updated {totals['updated']}, "
+            f"skipped {totals['skipped']}"
+        )
+    if metrics_json:
+        metrics.write_json(metrics_json)
+    if metrics_prom:
+        metrics.write_prometheus(metrics_prom)
 
 
 @cli.command()
@@ -32,7 +95,7 @@ def fetch(state, all_states, limit):
 @click.option('--metric', default='cases', 
               type=click.Choice(['cases', 'deaths']))
 def top(limit, metric):
-    pipeline =etl_pipeline()
+    pipeline = _open_queries()
     if metric == 'cases':
         results =pipeline.query_top_cases(limit)
     else:
@@ -43,7 +106,7 @@ def top(limit, metric):
 @cli.command()
 @click.argument('state')
 def state(state):
-    pipeline=etl_pipeline()
+    pipeline = _open_queries()
     result = pipeline.query_state(state.upper())
     if result:
         click.echo(json.dumps(result,indent=2, default=str))
@@ -51,19 +114,114 @@ def state(state):
         click.echo(f"no data found for {state}")
 
 
+def _codes(value):
+    return [code.strip().upper() for code in (value or "").split(",") if code.strip()]
+
+
+def _window(pipeline, days, start=None, end=None):
+    """Date bounds: end defaults to the latest loaded date and start to
+    `days` before it."""
+    if end is None:
+        latest = pipeline.get_summary().get('latest_date')
+        end = date.fromisoformat(latest) if latest else None
+    if start is None and end is not None:
+        start = end - timedelta(days=days - 1)
+    return start, end
+
+
+def _timeline_range(pipeline, codes, days, start, end, fields):
+    """Stream several states' rows over a date window, one state at a time."""
+    start, end = _window(pipeline, days, start, end)
+    found = set()
+    try:
+        for code, rows in pipeline.iter_time_range(codes, start, end, fields):
+            found.add(code)
+            click.echo(f"\n{code} from {start or 'start'} to {end or 'end'}:")
+            click.echo(json.dumps(rows, indent=2, default=str))
+    except ValueError as e:
+        raise click.BadParameter(str(e), param_hint='--fields')
+    for code in codes:
+        if code not in found:
+            click.echo(f"no data found for {code}")
+
+
 @cli.command()
-@click.argument('state')
+@click.argument('state', required=False)
 @click.option('--days', default=30, help='Number of days')
-def timeline(state, days):
-    pipeline=etl_pipeline()
-    results= pipeline.query_time_series(state.upper(), days)
+@click.option('--metric', type=click.Choice(['new_cases', 'new_deaths']),
+              help='Show a daily increase instead of the full rows')
+@click.option('--rolling', default=1, type=click.Choice(['1', '7']),
+              help='Average the daily increase over this many days')
+@click.option('--states', help='Comma-separated states to compare, e.g. CA,NY,TX')
+@click.option('--from', 'start', type=click.DateTime(['%Y-%m-%d']),
+              help='First date (default: --days before --to)')
+@click.option('--to', 'end', type=click.DateTime(['%Y-%m-%d']),
+              help='Last date (default: the latest loaded date)')
+@click.option('--fields', help='Comma-separated metric columns (default: all)')
+def timeline(state, days, metric, rolling, states, start, end, fields):
+    """Show a state's last rows, or several states over a date range."""
+    codes = _codes(state) + _codes(states)
+    if not codes:
+        raise click.UsageError("give a STATE or --states")
+    ranged = states or start or end or fields
+    if metric and ranged:
+        raise click.UsageError("--metric takes a single STATE and --days")
+    pipeline = _open_queries()
+    if ranged:
+        _timeline_range(
+            pipeline, codes, days,
+            start.date() if start else None,
+            end.date() if end else None,
+            [f.strip() for f in fields.split(",") if f.strip()] if fields else None,
+        )
+        return
+    if metric:
+        results = pipeline.query_derived(state, metric, int(rolling), days)
+    else:
+        results= pipeline.query_time_series(state.upper(), days)
     click.echo(f"\nlast {days} days for {state}:")
     click.echo(json.dumps(results, indent=2, default=str))
 
+@cli.command()
+@click.argument('table', default='states', type=click.Choice(['states', 'derived']))
+@click.option('--format', 'fmt', default='ndjson', type=click.Choice(['ndjson', 'csv']),
+              help='One JSON object per line, or CSV with a header')
+@click.option('--output', '-o', default='-',
+              type=click.Path(dir_okay=False, allow_dash=True),
+              help='File to write (default: stdout)')
+@click.option('--compress', type=click.Choice(['gzip', 'zstd']),
+              help='Compress the output (default: from the .gz/.zst suffix)')
+@click.option('--states', help='Comma-separated states (default: all)')
+@click.option('--from', 'start', type=click.DateTime(['%Y-%m-%d']),
+              help='First date')
+@click.option('--to', 'end', type=click.DateTime(['%Y-%m-%d']),
+              help='Last date')
+@click.option('--fields', help='Comma-separated columns after state and date (default: all)')
+@click.option('--batch-size', default=4096, type=click.IntRange(min=1),
+              help='Rows fetched and written at a time')
+def export(table, fmt, output, compress, states, start, end, fields, batch_size):
+    """Stream covid_states or derived_metrics rows as NDJSON or CSV."""
+    from export import compression_for, open_output, write_rows
+
+    pipeline = _open_queries()
+    fields = [f.strip() for f in fields.split(",") if f.strip()] if fields else None
+    try:
+        columns = pipeline.export_columns(table, fields)
+    except ValueError as e:
+        raise click.BadParameter(str(e), param_hint='--fields')
+    batches = pipeline.iter_batches(
+        table, _codes(states) or None,
+        start.date() if start else None, end.date() if end else None,
+        fields, batch_size,
+    )
+    with open_output(output, compression_for(output, compress)) as out:
+        rows = write_rows(out, fmt, columns, batches)
+    click.echo(f"exported {rows} rows", err=True)
+
 @cli.command()
 def summary():
     """Get summary statistics"""
-    pipeline=etl_pipeline()
+    pipeline = _open_queries()
     stats = pipeline.get_summary()
     click.echo(f"total states: {stats.get('total_states') or 0}")
     click.echo(f"total cases: {(stats.get('total_cases') or 0):,}")
@@ -73,39 +231,235 @@ def summary():
     click.echo(f"latest data date: {stats.get('latest_date')}")
 
 @cli.command()
-@click.argument('state')
+@click.option('--clear', is_flag=True, help='Drop all cached query results')
+def cache(clear):
+    """Show query cache statistics (persisted when COVID_ETL_CACHE is set)."""
+    pipeline = _open_queries()
+    if clear:
+        pipeline.cache.clear()
+        click.echo("query cache cleared")
+    click.echo(json.dumps(pipeline.cache_stats(), indent=2))
+
+@cli.command()
+@click.option('--limit', default=10, help='Number of runs')
+def runs(limit):
+    """Recent all-states loads and how many states each committed."""
+    pipeline = _open_queries()
+    for run in pipeline.get_load_runs(limit):
+        click.echo(
+            f"{run['id']:>5} {run['status']:<9} {run['mode']:<12} "
+            f"{run['states']:>3} states {(run['records'] or 0):>10,} records  "
+            f"{run['started_at']} -> {run['finished_at'] or '-'}  "
+            f"input {run['fingerprint'][:12]}"
+        )
+
+@cli.command()
+@click.argument('level', type=click.Choice(['national', 'week', 'month']))
+@click.option('--states', help='Comma-separated states (week and month only)')
+@click.option('--from', 'start', type=click.DateTime(['%Y-%m-%d']),
+              help='First day, or first bucket start')
+@click.option('--to', 'end', type=click.DateTime(['%Y-%m-%d']),
+              help='Last day, or last bucket start')
+@click.option('--rebuild', is_flag=True,
+              help='Recompute the rollups from covid_states first')
+def rollup(level, states, start, end, rebuild):
+    """US totals by day, or each state's values by ISO week or month."""
+    if level == 'national' and states:
+        raise click.UsageError("national totals cover every state; drop --states")
+    pipeline = _open_queries(read_only=not rebuild)
+    if rebuild:
+        pipeline.rebuild_rollups()
+        click.echo("rebuilt rollups")
+    start = start.date() if start else None
+    end = end.date() if end else None
+    if level == 'national':
+        results = pipeline.query_national(start, end)
+    else:
+        results = pipeline.query_rollups(level, _codes(states) or None, start, end)
+    click.echo(json.dumps(results, indent=2, default=str))
+
+@cli.command(name='check-latest')
+@click.option('--rebuild', is_flag=True,
+              help='Rebuild latest_by_state from covid_states')
+def check_latest(rebuild):
+    """Check the latest-per-state table against the full history."""
+    pipeline = _open_queries(read_only=not rebuild)
+    stale = pipeline.check_latest()
+    if stale:
+        click.echo(f"latest_by_state out of date for: {', '.join(stale)}")
+    else:
+        click.echo("latest_by_state is consistent")
+    if rebuild:
+        pipeline.rebuild_latest()
+        click.echo("rebuilt latest_by_state")
+
+@cli.command()
+@click.option('--state', help='Only rows of this state')
+@click.option('--reason', help='Only rows rejected for this reason, e.g. bad_date')
+@click.option('--show', default=10, help='Number of quarantined rows to print')
+@click.option('--replay', is_flag=True,
+              help='Re-clean the selected rows and load the ones that pass now')
+def quarantine(state, reason, show, replay):
+    """Inspect rows the cleaner rejected, or replay them after a fix."""
+    if replay:
+        from pipeline import etl_pipeline
+        totals = etl_pipeline().replay_rejected(state, reason)
+        click.echo(f"loaded {totals['replayed']} rows, "
+                   f"{totals['rejected']} still rejected")
+        return
+    pipeline = _open_queries()
+    counts = [
+        row for row in pipeline.get_rejected_counts(state)
+        if reason is None or row['reason'] == reason
+    ]
+    if not counts:
+        click.echo("no quarantined rows")
+        return
+    for row in counts:
+        click.echo(f"{row['state']:<4} {row['reason']:<32} {row['rows']:>8,}")
+    for row in pipeline.get_rejected(state, reason, limit=show):
+        click.echo(json.dumps(row, default=str))
+
+@cli.command()
+@click.argument('state', required=False)
 @click.option('--metric', default='cases',
               type=click.Choice(['cases', 'deaths']))
 @click.option('--days', default=30, help='Number of days to plot')
-@click.option('--output', default='timeline.png',
-              help='Output file for the chart')
-def visualize(state, metric, days, output):
-    """Generate a simple timeline visualization for a state."""
-    import matplotlib
-    matplotlib.use('Agg')
-    import matplotlib.pyplot as plt
-
-    pipeline = etl_pipeline()
-    records = pipeline.query_time_series(state.upper(), days)
-    if not records:
-        click.echo(f"no data found for {state}")
+@click.option('--output', default=None,
+              help='Chart file (default timeline.png); with several states, '
+                   'a directory (default charts), or with --grid a file '
+                   '(default grid.png)')
+@click.option('--states', help='Comma-separated states to chart, e.g. CA,NY,TX')
+@click.option('--all-states', is_flag=True, help='Chart every loaded state')
+@click.option('--grid', is_flag=True,
+              help='Draw the states as small multiples in one image')
+@click.option('--workers', default=None, type=int,
+              help='Render charts in N processes (default: one per CPU)')
+def visualize(state, metric, days, output, states, all_states, grid, workers):
+    """Generate timeline charts for one state, several, or all of them."""
+    from charts import chart_renderer, render_charts, render_grid
+
+    codes = _codes(state) + _codes(states)
+    if not codes and not all_states:
+        raise click.UsageError("give a STATE, --states or --all-states")
+    pipeline = _open_queries()
+    field = 'cases_total' if metric == 'cases' else 'deaths_total'
+    ylabel = 'Total ' + metric
+
+    if len(codes) == 1 and not all_states and not grid:
+        dates, values = pipeline.series(codes[0], field, days)
+        if not len(dates):
+            click.echo(f"no data found for {codes[0]}")
+            return
+        output = output or 'timeline.png'
+        chart_renderer().render(
+            output, dates, values,
+            f"{codes[0]} {metric} over last {len(dates)} days", ylabel,
+        )
+        click.echo(f"saved visualization to {output}")
+        return
+
+    # every state's window in one query, then render
+    start, end = _window(pipeline, days)
+    series = pipeline.series_by_state(None if all_states else codes, field, start, end)
+    for code in codes:
+        if code not in series:
+            click.echo(f"no data found for {code}")
+    if not series:
+        return
+    if grid:
+        output = output or 'grid.png'
+        render_grid(series, output, f"total {metric}, {start} to {end}")
+        click.echo(f"saved {len(series)}-state grid to {output}")
         return
+    output = output or 'charts'
+    os.makedirs(output, exist_ok=True)
+    tasks = [
+        (os.path.join(output, f"{code.lower()}_{metric}.png"), dates, values,
+         f"{code} {metric} over last {len(dates)} days", ylabel)
+        for code, (dates, values) in series.items()
+    ]
+    if workers is None:
+        workers = pipeline.config.chart_workers
+    render_charts(tasks, workers)
+    click.echo(f"saved {len(tasks)} charts to {output}")
+
+@cli.command()
+@click.option('--state', help='Profile a load of one state')
+@click.option('--all-states', is_flag=True, help='Profile a load of all states')
+@click.option('--workers', default=1, type=int,
+              help='Worker processes (only this process is profiled)')
+@click.option('--db', type=click.Path(dir_okay=False),
+              help='Database to load into (default: a throwaway file)')
+@click.option('--top', 'top_n', default=25, help='Number of functions to print')
+@click.option('--sort', default='cumulative',
+              type=click.Choice(['cumulative', 'tottime', 'ncalls']))
+@click.option('--tracemalloc', 'trace_memory', is_flag=True,
+              help='Also report the largest allocation sites')
+def profile(state, all_states, workers, db, top_n, sort, trace_memory):
+    """Run a load under cProfile and print the hottest functions."""
+    import cProfile
+    import pstats
+    import tempfile
+    import tracemalloc
+    from pipeline import etl_pipeline
+    from metrics import run_metrics
+
+    if not state and not all_states:
+        raise click.UsageError("specify --state CODE or --all-states")
+    scratch = None
+    if db is None:
+        scratch = tempfile.mkdtemp(prefix="etl-profile-")
+        db = os.path.join(scratch, "profile.db")
+    metrics = run_metrics()
+    profiler = cProfile.Profile()
+    if trace_memory:
+        tracemalloc.start()
+    pipeline = None
+    profiler.enable()
+    try:
+        pipeline = etl_pipeline(Config(db=db), metrics=metrics)
+        if all_states:
+            pipeline.run_for_all_states(workers=workers)
+        else:
+            pipeline.run_for_state(state)
+            metrics.finish_run()
+    finally:
+        profiler.disable()
+        snapshot = tracemalloc.take_snapshot() if trace_memory else None
+        if trace_memory:
+            tracemalloc.stop()
+        if pipeline is not None:
+            pipeline.storage.close()
+        if scratch:
+            import shutil
+            shutil.rmtree(scratch)
+
+    run = metrics.report()["run"]
+    click.echo(json.dumps(run, indent=2))
+    stats = pstats.Stats(profiler)
+    stats.sort_stats(sort).print_stats(top_n)
+    if snapshot is not None:
+        click.echo(f"top {top_n} allocation sites:")
+        for stat in snapshot.statistics("lineno")[:top_n]:
+            click.echo(f"  {stat}")
+
+@cli.command()
+@click.option('--host', default='127.0.0.1', help='Interface to bind')
+@click.option('--port', default=8080, help='Port to listen on')
+@click.option('--max-concurrency', default=256,
+              help='Requests processed at once; the rest wait for a slot')
+def serve(host, port, max_concurrency):
+    """Serve top/state/timeline/summary as an HTTP/JSON API."""
+    import asyncio
+    from server import query_server
 
-    sorted_records = sorted(records, key=lambda r: r['date'])
-    dates = [r['date'] for r in sorted_records]
-    values = [r['cases_total'] if metric == 'cases' else r['deaths_total']
-              for r in sorted_records]
-
-    plt.figure(figsize=(10, 5))
-    plt.plot(dates, values, marker='o')
-    plt.title(f"{state.upper()} {metric} over last {len(sorted_records)} days")
-    plt.xlabel('Date')
-    plt.ylabel('Total ' + metric)
-    plt.xticks(rotation=45, ha='right')
-    plt.tight_layout()
-    plt.grid(True)
-    plt.savefig(output)
-    click.echo(f"saved visualization to {output}")
+    pipeline = _open_queries()
+    server = query_server(pipeline, host, port, max_concurrency)
+    try:
+        asyncio.run(server.serve_forever())
+    except KeyboardInterrupt:
+        click.echo("server stopped")
 
 if __name__ == '__main__':
     cli()
@@ -0,0 +1,260 @@
+import hashlib
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from datetime import date
+from typing import (
+    TYPE_CHECKING, Dict, Iterable, Iterator, List, Optional, Tuple, Union,
+)
+
+from configuration import Config
+from fields import EXPORT_TABLES, METRIC_FIELDS
+
+if TYPE_CHECKING:
+    # schema pulls in numpy, which read-only query commands never need
+    from schema import covid_schema, record_batch
+
+Records = Union["record_batch", List["covid_schema"]]
+
+BACKENDS = ("sqlite", "duckdb")
+
+# date.toordinal() of 1970-01-01, where epoch days start
+EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+
+# rows fetched from the cursor at a time by streamed queries
+BATCH_ROWS = 4096
+
+
+class storage_backend(ABC):
+    """What the pipeline needs from a database.
+
+    Dates come back as YYYY-MM-DD strings and rows as plain dicts, whatever
+    the engine. session() routes the calling thread's writes through one
+    connection until it closes; savepoint() makes a block's writes atomic
+    inside it.
+    """
+
+    # the backend can load and clean the source CSV itself (ingest_csv)
+    supports_csv_ingest = False
+
+    db: str
+
+    @staticmethod
+    def _row_values(r: "covid_schema", iso_dates: bool = True) -> tuple:
+        day = r.date.isoformat() if iso_dates else r.date.toordinal() - EPOCH_ORDINAL
+        return (r.state, day, r.cases_total,
+                r.cases_confirmed, r.deaths_total, r.deaths_confirmed,
+                r.deaths_probable, r.hospitalized_currently,
+                r.hospitalized_cumulative, r.in_icu_currently, r.tests_total)
+
+    def _iter_rows(self, records: Records, iso_dates: bool = True) -> Iterable[tuple]:
+        if isinstance(records, (list, tuple)):
+            return (self._row_values(r, iso_dates) for r in records)
+        return records.rows(iso_dates)
+
+    @staticmethod
+    def _states_of(records: Records) -> set:
+        if isinstance(records, (list, tuple)):
+            return {r.state for r in records}
+        return set(records.states.tolist())
+
+    @staticmethod
+    def _range_filter(states: Optional[Iterable[str]], start, end):
+        """Normalized (states, start, end) for iter_time_range: upper-case
+        states, or None for all, and ISO date bounds, or None for open."""
+        if states is not None:
+            states = sorted({state.upper() for state in states})
+        bounds = [
+            None if bound is None else date.fromisoformat(str(bound)).isoformat()
+            for bound in (start, end)
+        ]
+        return states, *bounds
+
+    @staticmethod
+    def _metric_fields(fields: Optional[Iterable[str]],
+                       allowed: Tuple[str, ...] = METRIC_FIELDS) -> List[str]:
+        if fields is None:
+            return list(allowed)
+        fields = list(fields)
+        unknown = [field for field in fields if field not in allowed]
+        if unknown:
+            raise ValueError(f"unknown fields: {', '.join(unknown)}")
+        return fields
+
+    @classmethod
+    def _export_table(cls, table: str, fields: Optional[Iterable[str]]
+                      ) -> Tuple[str, List[str]]:
+        """The SQL table behind an EXPORT_TABLES name and its checked fields."""
+        if table not in EXPORT_TABLES:
+            raise ValueError(
+                f"unknown table {table!r}; use one of {', '.join(EXPORT_TABLES)}"
+            )
+        name, allowed = EXPORT_TABLES[table]
+        return name, cls._metric_fields(fields, allowed)
+
+    @classmethod
+    def export_columns(cls, table: str = "states",
+                       fields: Optional[Iterable[str]] = None) -> List[str]:
+        """Names of the values in iter_batches rows."""
+        return ["state", "date", *cls._export_table(table, fields)[1]]
+
+    @staticmethod
+    def _row_hash(values: tuple) -> str:
+        return hashlib.blake2b(repr(values).encode(), digest_size=8).hexdigest()
+
+    @abstractmethod
+    def get_generation(self) -> int: ...
+
+    @abstractmethod
+    def get_instance_id(self) -> int: ...
+
+    @abstractmethod
+    def session(self): ...
+
+    @abstractmethod
+    def savepoint(self, conn, name: str = "load_state"): ...
+
+    @contextmanager
+    def bulk_load(self):
+        """Session for full reloads; backends may relax durability."""
+        with self.session() as conn:
+            yield conn
+
+    def commit_session(self, conn):
+        """Commit a session's writes so far; the session stays open."""
+        conn.commit()
+
+    @abstractmethod
+    def close(self): ...
+
+    @abstractmethod
+    def insert_records(self, records: Records): ...
+
+    @abstractmethod
+    def get_watermark(self, state: str) -> Optional[dict]: ...
+
+    @abstractmethod
+    def insert_records_incremental(self, records: Records, state: str,
+                                   source_digest: Optional[str] = None
+                                   ) -> Dict[str, int]: ...
+
+    @abstractmethod
+    def begin_load_run(self, fingerprint: str, mode: str,
+                       resume: bool = False) -> int: ...
+
+    @abstractmethod
+    def get_completed_states(self, run_id: int) -> Dict[str, Optional[int]]: ...
+
+    @abstractmethod
+    def complete_state(self, run_id: int, state: str,
+                       records: Optional[int]): ...
+
+    @abstractmethod
+    def finish_load_run(self, run_id: int, status: str): ...
+
+    @abstractmethod
+    def get_load_runs(self, limit: int = 10) -> List[dict]: ...
+
+    def ingest_csv(self, csv_path: str, states: Iterable[str] = None) -> int:
+        """Load and clean csv_path in the engine; returns rows written."""
+        raise NotImplementedError(
+            f"{type(self).__name__} cannot ingest CSV files directly"
+        )
+
+    def csv_states(self, csv_path: str) -> List[str]:
+        """The sorted state codes in csv_path, read by the engine."""
+        raise NotImplementedError(
+            f"{type(self).__name__} cannot read CSV files directly"
+        )
+
+    @abstractmethod
+    def insert_derived(self, state: str, rows: List[tuple],
+                       replace: bool = False): ...
+
+    @abstractmethod
+    def get_derived_watermark(self, state: str) -> Optional[str]: ...
+
+    @abstractmethod
+    def get_derived_series(self, state: str, days: int = 30,
+                           fields: Iterable[str] = None) -> List[dict]: ...
+
+    @abstractmethod
+    def quarantine(self, rows: List[tuple]): ...
+
+    @abstractmethod
+    def get_rejected(self, state: str = None, reason: str = None,
+                     limit: int = None) -> List[dict]: ...
+
+    @abstractmethod
+    def get_rejected_counts(self, state: str = None) -> List[dict]: ...
+
+    @abstractmethod
+    def delete_rejected(self, ids: Iterable[int]): ...
+
+    @abstractmethod
+    def check_latest(self) -> List[str]: ...
+
+    @abstractmethod
+    def rebuild_latest(self): ...
+
+    @abstractmethod
+    def rebuild_rollups(self): ...
+
+    @abstractmethod
+    def get_national_daily(self, start=None, end=None) -> List[dict]: ...
+
+    @abstractmethod
+    def get_rollups(self, period: str, states: Iterable[str] = None,
+                    start=None, end=None) -> List[dict]: ...
+
+    @abstractmethod
+    def get_latest_by_state(self, state: str) -> Optional[dict]: ...
+
+    @abstractmethod
+    def get_top_states_by_cases(self, limit: int = 10,
+                                as_of_date: date = None) -> List[dict]: ...
+
+    @abstractmethod
+    def get_top_states_by_deaths(self, limit: int = 10) -> List[dict]: ...
+
+    @abstractmethod
+    def get_time_series(self, state: str, days: int = 30) -> List[dict]: ...
+
+    @abstractmethod
+    def iter_batches(self, table: str = "states", states: Iterable[str] = None,
+                     start=None, end=None, fields: Iterable[str] = None,
+                     size: int = BATCH_ROWS) -> Iterator[List[tuple]]:
+        """Lists of up to `size` (state, date, *fields) tuples from an
+        EXPORT_TABLES table, for several states between two dates
+        (inclusive; None leaves a side open), ordered by state and date.
+        Streamed from one cursor, which is held until iteration ends."""
+
+    def iter_time_range(self, states: Iterable[str] = None, start=None,
+                        end=None, fields: Iterable[str] = None
+                        ) -> Iterator[dict]:
+        """iter_batches over covid_states as dicts of state, date and
+        `fields` of the metrics (default: all)."""
+        names = self.export_columns("states", fields)
+        for batch in self.iter_batches("states", states, start, end, fields):
+            for values in batch:
+                yield dict(zip(names, values))
+
+    @abstractmethod
+    def get_history(self, states: Iterable[str] = None,
+                    iso_dates: bool = True) -> List[tuple]: ...
+
+    @abstractmethod
+    def get_summary_stats(self) -> dict: ...
+
+
+def open_storage(config: Config, read_only: bool = False) -> storage_backend:
+    """The storage backend named by config.backend. A read-only backend
+    skips schema setup and needs an existing database."""
+    if config.backend == "sqlite":
+        from store import sqlstorage
+        return sqlstorage(config, read_only)
+    if config.backend == "duckdb":
+        from duckstore import duckdbstorage
+        return duckdbstorage(config, read_only)
+    raise ValueError(
+        f"unknown storage backend {config.backend!r}; expected one of {BACKENDS}"
+    )
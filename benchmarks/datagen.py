@@ -0,0 +1,112 @@
+"""Synthetic CSVs in the all-states-history.csv layout.
+
+Scale 1 matches the sample file (56 states x 371 days). Larger scales add
+states first (up to every two-letter code) and then lengthen the history.
+
+    python -m benchmarks.datagen --scale 10 --output /tmp/history-10x.csv
+"""
+import argparse
+import csv
+import random
+import string
+from datetime import date, timedelta
+from itertools import product
+from typing import List
+
+SAMPLE_STATES = 56
+SAMPLE_DAYS = 371
+LAST_DAY = date(2021, 3, 7)
+
+HEADER = [
+    "date", "state", "death", "deathConfirmed", "deathIncrease", "deathProbable",
+    "hospitalized", "hospitalizedCumulative", "hospitalizedCurrently",
+    "hospitalizedIncrease", "inIcuCumulative", "inIcuCurrently", "negative",
+    "negativeIncrease", "negativeTestsAntibody", "negativeTestsPeopleAntibody",
+    "negativeTestsViral", "onVentilatorCumulative", "onVentilatorCurrently",
+    "positive", "positiveCasesViral", "positiveIncrease", "positiveScore",
+    "positiveTestsAntibody", "positiveTestsAntigen", "positiveTestsPeopleAntibody",
+    "positiveTestsPeopleAntigen", "positiveTestsViral", "recovered",
+    "totalTestEncountersViral", "totalTestEncountersViralIncrease",
+    "totalTestResults", "totalTestResultsIncrease", "totalTestsAntibody",
+    "totalTestsAntigen", "totalTestsPeopleAntibody", "totalTestsPeopleAntigen",
+    "totalTestsPeopleViral", "totalTestsPeopleViralIncrease", "totalTestsViral",
+    "totalTestsViralIncrease",
+]
+
+
+def dimensions(scale: float):
+    """(states, days) for a scale factor relative to the sample."""
+    max_states = 26 * 26
+    states = min(max(int(SAMPLE_STATES * scale), 1), max_states)
+    days = max(int(round(SAMPLE_DAYS * SAMPLE_STATES * scale / states)), 1)
+    return states, days
+
+
+def state_codes(count: int) -> List[str]:
+    return ["".join(pair) for pair in product(string.ascii_uppercase, repeat=2)][:count]
+
+
+def generate_csv(path: str, scale: float = 1.0, seed: int = 0) -> int:
+    """Write a synthetic history to path and return the number of rows."""
+    rng = random.Random(seed)
+    n_states, n_days = dimensions(scale)
+    codes = state_codes(n_states)
+    first_day = LAST_DAY - timedelta(days=n_days - 1)
+    growth = {code: rng.uniform(50, 5000) for code in codes}
+    totals = {code: [0, 0, 0] for code in codes}  # cases, deaths, tests
+    columns = {name: i for i, name in enumerate(HEADER)}
+
+    # accumulate oldest first, then write newest first like the source file
+    days = []
+    for offset in range(n_days):
+        day = (first_day + timedelta(days=offset)).isoformat()
+        rows = []
+        for code in codes:
+            new_cases = int(rng.expovariate(1 / growth[code]))
+            new_deaths = int(new_cases * rng.uniform(0, 0.03))
+            new_tests = new_cases * rng.randint(5, 20)
+            total = totals[code]
+            total[0] += new_cases
+            total[1] += new_deaths
+            total[2] += new_tests
+            row = [""] * len(HEADER)
+            row[columns["date"]] = day
+            row[columns["state"]] = code
+            row[columns["positive"]] = str(total[0])
+            row[columns["positiveIncrease"]] = str(new_cases)
+            row[columns["death"]] = str(total[1])
+            row[columns["deathIncrease"]] = str(new_deaths)
+            row[columns["totalTestResults"]] = str(total[2])
+            row[columns["totalTestResultsIncrease"]] = str(new_tests)
+            if rng.random() < 0.7:
+                row[columns["positiveCasesViral"]] = str(int(total[0] * 0.8))
+                row[columns["deathConfirmed"]] = str(int(total[1] * 0.9))
+                row[columns["deathProbable"]] = str(total[1] - int(total[1] * 0.9))
+            if rng.random() < 0.8:
+                current = int(new_cases * rng.uniform(0.5, 2))
+                row[columns["hospitalizedCurrently"]] = str(current)
+                row[columns["inIcuCurrently"]] = str(current // 5)
+                row[columns["hospitalizedCumulative"]] = str(int(total[0] * 0.05))
+            rows.append(row)
+        days.append(rows)
+
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f, quoting=csv.QUOTE_MINIMAL)
+        writer.writerow(HEADER)
+        for rows in reversed(days):
+            writer.writerows(rows)
+    return n_states * n_days
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--scale", type=float, default=1.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", required=True)
+    args = parser.parse_args()
+    rows = generate_csv(args.output, args.scale, args.seed)
+    print(f"wrote {rows} rows to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+"""Concurrent load test for `app.py serve`.
+
+    python app.py serve --port 8080 &
+    python benchmarks/loadtest.py --port 8080 --concurrency 200 --requests 20000
+"""
+import argparse
+import asyncio
+import json
+import statistics
+import time
+
+DEFAULT_PATHS = [
+    "/top?metric=cases&limit=10",
+    "/top?metric=deaths&limit=10",
+    "/state/CA",
+    "/timeline/NY?days=30",
+    "/summary",
+]
+
+
+async def _read_response(reader: asyncio.StreamReader) -> int:
+    status_line = await reader.readline()
+    status = int(status_line.split()[1])
+    length = None
+    chunked = False
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        name = name.strip().lower()
+        if name == "content-length":
+            length = int(value)
+        elif name == "transfer-encoding" and "chunked" in value:
+            chunked = True
+    if chunked:
+        while True:
+            size = int((await reader.readline()).strip(), 16)
+            await reader.readexactly(size + 2)
+            if size == 0:
+                break
+    elif length:
+        await reader.readexactly(length)
+    return status
+
+
+async def _client(host, port, paths, count, latencies, errors):
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        for i in range(count):
+            path = paths[i % len(paths)]
+            started = time.perf_counter()
+            writer.write(f"GET {path} HTTP/1.1\r\nHost: {host}\r\n\r\n".encode())
+            await writer.drain()
+            status = await _read_response(reader)
+            latencies.append(time.perf_counter() - started)
+            if status != 200:
+                errors.append(status)
+    finally:
+        writer.close()
+
+
+async def run(host, port, concurrency, requests, paths):
+    latencies, errors = [], []
+    per_client = max(requests // concurrency, 1)
+    started = time.perf_counter()
+    await asyncio.gather(*(
+        _client(host, port, paths[i % len(paths):] + paths[:i % len(paths)],
+                per_client, latencies, errors)
+        for i in range(concurrency)
+    ))
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+
+    def percentile(p):
+        return latencies[min(int(len(latencies) * p), len(latencies) - 1)] * 1000
+
+    return {
+        "requests": len(latencies),
+        "concurrency": concurrency,
+        "errors": len(errors),
+        "seconds": round(elapsed, 3),
+        "requests_per_second": round(len(latencies) / elapsed, 1),
+        "latency_ms": {
+            "mean": round(statistics.fmean(latencies) * 1000, 3),
+            "p50": round(percentile(0.50), 3),
+            "p95": round(percentile(0.95), 3),
+            "p99": round(percentile(0.99), 3),
+            "max": round(latencies[-1] * 1000, 3),
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--concurrency", type=int, default=100)
+    parser.add_argument("--requests", type=int, default=10000)
+    parser.add_argument("--path", action="append", dest="paths",
+                        help="request path (repeatable); defaults to a dashboard mix")
+    args = parser.parse_args()
+    report = asyncio.run(run(
+        args.host, args.port, args.concurrency, args.requests,
+        args.paths or DEFAULT_PATHS,
+    ))
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
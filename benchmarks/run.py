@@ -0,0 +1,471 @@
+"""Time each ETL stage and query at several data sizes.
+
+    python -m benchmarks.run --scales 1 10 --output results.json
+    python -m benchmarks.run --scales 1 10 --baseline results.json
+
+Every scale gets a synthetic CSV (see benchmarks.datagen) and a fresh
+database in a scratch directory. Stages are timed with perf_counter; peak
+memory is the tracemalloc peak of the stage plus the process high-water
+mark (ru_maxrss). With --baseline, any timing more than --tolerance times
+slower than the baseline is reported and the exit status is 1.
+"""
+import argparse
+import gzip
+import json
+import logging
+import os
+import platform
+import resource
+import shutil
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from contextlib import contextmanager
+from typing import Callable, Dict, List
+
+from benchmarks.datagen import dimensions, generate_csv
+from configuration import Config
+
+QUERY_REPEATS = 200
+# every DIRTY_EVERY-th row gets an invalid date in the transform_dirty stage
+DIRTY_EVERY = 10
+# runs of each CLI command in the startup stages
+STARTUP_REPEATS = 10
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# gzip shards the extract_sharded_gz stage reads
+SHARDS = 8
+# timing differences below this are noise, never regressions
+NOISE_SECONDS = 50e-6
+
+
+def _max_rss_mb() -> float:
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes elsewhere
+    return rss / (1024 * 1024) if sys.platform == "darwin" else rss / 1024
+
+
+class stage_recorder:
+    def __init__(self, trace_memory: bool = True):
+        self.trace_memory = trace_memory
+        self.results: Dict[str, dict] = {}
+
+    @contextmanager
+    def stage(self, name: str, rows: int = None):
+        if self.trace_memory:
+            tracemalloc.start()
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            result = {"seconds": round(elapsed, 6), "max_rss_mb": round(_max_rss_mb(), 1)}
+            if self.trace_memory:
+                result["peak_alloc_mb"] = round(
+                    tracemalloc.get_traced_memory()[1] / (1024 * 1024), 2
+                )
+                tracemalloc.stop()
+            if rows:
+                result["rows"] = rows
+                result["rows_per_second"] = round(rows / elapsed) if elapsed else None
+            self.results[name] = result
+
+    def repeat(self, name: str, func: Callable, repeats: int = QUERY_REPEATS):
+        """Time func() repeats times; records the median and best call."""
+        timings = []
+        for _ in range(repeats):
+            started = time.perf_counter()
+            func()
+            timings.append(time.perf_counter() - started)
+        self.results[name] = {
+            "seconds": round(statistics.median(timings), 7),
+            "best_seconds": round(min(timings), 7),
+            "repeats": repeats,
+        }
+
+
+def _write_gz_shards(csv_path: str, shard_dir: str, shards: int = SHARDS):
+    os.makedirs(shard_dir, exist_ok=True)
+    with open(csv_path) as f:
+        header = f.readline()
+        outputs = [
+            gzip.open(os.path.join(shard_dir, f"part-{i:03d}.csv.gz"), "wt",
+                      compresslevel=1)
+            for i in range(shards)
+        ]
+        for output in outputs:
+            output.write(header)
+        for i, line in enumerate(f):
+            outputs[i % shards].write(line)
+        for output in outputs:
+            output.close()
+
+
+def _has_duckdb() -> bool:
+    try:
+        import duckdb  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def _bench_startup(recorder: stage_recorder, db: str, workdir: str, state: str):
+    """Wall time of whole CLI invocations against db, from a directory
+    with no CSV in it, next to a bare interpreter start."""
+    cwd = os.path.join(workdir, "startup")
+    os.makedirs(cwd, exist_ok=True)
+    target = os.path.join(cwd, Config().db)
+    if os.path.exists(target):
+        os.remove(target)
+    os.link(db, target)
+    env = dict(os.environ, PYTHONPATH=REPO_ROOT)
+    app = os.path.join(REPO_ROOT, "app.py")
+    commands = {
+        "startup_python": [sys.executable, "-c", "pass"],
+        "startup_cli_top": [sys.executable, app, "top"],
+        "startup_cli_state": [sys.executable, app, "state", state],
+        "startup_cli_summary": [sys.executable, app, "summary"],
+        "startup_cli_timeline": [sys.executable, app, "timeline", state],
+    }
+    for name, argv in commands.items():
+        recorder.repeat(
+            name,
+            lambda: subprocess.run(
+                argv, cwd=cwd, env=env, check=True,
+                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+            ),
+            repeats=STARTUP_REPEATS,
+        )
+    os.remove(target)
+
+
+# covid_states as schema 1 stored it, for the layout stages
+V1_COVID_STATES = (
+    """CREATE TABLE covid_states (
+        state TEXT NOT NULL,
+        date DATE NOT NULL,
+        cases_total INTEGER, cases_confirmed INTEGER, deaths_total INTEGER,
+        deaths_confirmed INTEGER, deaths_probable INTEGER,
+        hospitalized_currently INTEGER, hospitalized_cumulative INTEGER,
+        in_icu_currently INTEGER, tests_total INTEGER,
+        loaded_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (state, date)
+    )""",
+    "CREATE INDEX idx_state ON covid_states(state)",
+    "CREATE INDEX idx_date ON covid_states(date DESC)",
+    "CREATE INDEX idx_cases ON covid_states(cases_total DESC)",
+    "CREATE INDEX idx_deaths ON covid_states(deaths_total DESC)",
+)
+
+
+def _bench_layouts(recorder: stage_recorder, db: str, workdir: str,
+                   state: str) -> Dict[str, int]:
+    """covid_states alone in the schema 1 layout and the current one: the
+    same queries against each, and each file's size."""
+    from store import DAY_PARAM, METRIC_LIST, ROW_COLUMNS, _iso
+
+    source = sqlite3.connect(db)
+    current_ddl = [
+        row[0] for row in source.execute(
+            "SELECT sql FROM sqlite_master"
+            " WHERE tbl_name = 'covid_states' AND sql IS NOT NULL"
+            " ORDER BY type DESC"
+        )
+    ]
+    as_of = source.execute(f"SELECT {_iso('MAX(day)')} FROM covid_states").fetchone()[0]
+    source.close()
+    layouts = {
+        "v1": (V1_COVID_STATES, f"state, {_iso('day')}, {METRIC_LIST}", {
+            "time_series": ("SELECT * FROM covid_states WHERE state = ?"
+                            " ORDER BY date DESC LIMIT 30", (state,)),
+            "top_as_of": ("SELECT * FROM covid_states WHERE date = ?"
+                          " ORDER BY cases_total DESC LIMIT 10", (as_of,)),
+            "latest_dates": ("SELECT state, MAX(date) FROM covid_states"
+                             " GROUP BY state", ()),
+            "history": (f"SELECT state, date, {METRIC_LIST} FROM covid_states"
+                        " ORDER BY state, date", ()),
+        }),
+        "v2": (current_ddl, f"state, day, {METRIC_LIST}", {
+            "time_series": (f"SELECT {ROW_COLUMNS} FROM covid_states"
+                            " WHERE state = ? ORDER BY day DESC LIMIT 30", (state,)),
+            "top_as_of": (f"SELECT {ROW_COLUMNS} FROM covid_states"
+                          f" WHERE day = {DAY_PARAM}"
+                          " ORDER BY cases_total DESC LIMIT 10", (as_of,)),
+            "latest_dates": (f"SELECT state, {_iso('MAX(day)')} FROM covid_states"
+                             " GROUP BY state", ()),
+            # as get_history(iso_dates=False) reads it for the column store
+            "history": (f"SELECT state, day, {METRIC_LIST}"
+                        " FROM covid_states ORDER BY state, day", ()),
+        }),
+    }
+    sizes = {}
+    for name, (ddl, copied, queries) in layouts.items():
+        path = os.path.join(workdir, f"layout-{name}.db")
+        if os.path.exists(path):
+            os.remove(path)
+        conn = sqlite3.connect(path)
+        for statement in ddl:
+            conn.execute(statement)
+        conn.execute("ATTACH ? AS source", (db,))
+        target = ", ".join(["state", "date" if name == "v1" else "day",
+                            *METRIC_LIST.split(", ")])
+        conn.execute(
+            f"INSERT INTO covid_states ({target}) SELECT {copied}"
+            " FROM source.covid_states ORDER BY state, day"
+        )
+        conn.commit()
+        conn.execute("DETACH source")
+        conn.execute("VACUUM")
+        conn.execute("ANALYZE")
+        sizes[name] = os.path.getsize(path)
+        for query, (sql, params) in queries.items():
+            recorder.repeat(
+                f"layout_{name}_{query}",
+                lambda: conn.execute(sql, params).fetchall(),
+                repeats=20 if query == "history" else QUERY_REPEATS,
+            )
+        conn.close()
+        os.remove(path)
+    return sizes
+
+
+def bench_scale(scale: float, workdir: str, trace_memory: bool = True) -> dict:
+    from backend import open_storage
+    from columnar import column_store
+    from dataextractor import data_extraction
+    from derive import derived_rows, metric_deriver
+    from export import EXPORT_FORMATS, write_rows
+    from pipeline import etl_pipeline
+    from quarantine import quarantine_rows
+    from queries import query_service
+    from store import SUM_LIST, sqlstorage
+    from transform import data_cleaner
+
+    csv_path = os.path.join(workdir, f"history-{scale:g}x.csv")
+    rows = generate_csv(csv_path, scale)
+    states, days = dimensions(scale)
+    config = Config(csv_path=csv_path, db=os.path.join(workdir, f"bench-{scale:g}x.db"))
+    recorder = stage_recorder(trace_memory)
+
+    with recorder.stage("extract", rows):
+        extractor = data_extraction(config)
+        columns = {
+            item["state"]: extractor.fetch_state_columns(item["state"])
+            for item in extractor.get_state_info()
+        }
+
+    shard_dir = os.path.join(workdir, f"shards-{scale:g}x")
+    _write_gz_shards(csv_path, shard_dir)
+    with recorder.stage("extract_sharded_gz", rows):
+        data_extraction(Config(csv_path=shard_dir))
+
+    cleaner = data_cleaner()
+    with recorder.stage("transform", rows):
+        batches = {
+            state: cleaner.clean_batch(cols, state)[0]
+            for state, cols in columns.items()
+        }
+    # the same rows with some rejected, which must stay about as cheap
+    for cols in columns.values():
+        cols["date"] = [
+            "2021-02-30" if i % DIRTY_EVERY == 0 else day
+            for i, day in enumerate(cols["date"])
+        ]
+    with recorder.stage("transform_dirty", rows):
+        for state, cols in columns.items():
+            _, rejected = cleaner.clean_batch(cols, state)
+            if rejected.any():
+                reasons = cleaner.reject_reasons(cols, rejected, state)
+                quarantine_rows(cols, rejected, reasons, state)
+    del columns
+
+    storage = sqlstorage(config)
+    with recorder.stage("load", rows):
+        for batch in batches.values():
+            storage.insert_records(batch)
+    with recorder.stage("load_bulk", rows):
+        with storage.bulk_load():
+            for batch in batches.values():
+                storage.insert_records(batch)
+    deriver = metric_deriver(cleaner)
+    with recorder.stage("derive", rows):
+        for state, batch in batches.items():
+            storage.insert_derived(
+                state, derived_rows(state, deriver.derive(batch)), replace=True
+            )
+    with recorder.stage("columns", rows):
+        column_store(config.db + ".columns").refresh(storage)
+    storage.close()
+
+    duck_config = None
+    if _has_duckdb():
+        duck_config = Config(
+            csv_path=csv_path, db=config.db, backend="duckdb", csv_index=True,
+            cache_entries=0, columnar=False,
+        )
+        duck = open_storage(duck_config)
+        with recorder.stage("duckdb_load", rows):
+            for batch in batches.values():
+                duck.insert_records(batch)
+        with recorder.stage("duckdb_ingest_csv", rows):
+            duck.ingest_csv(csv_path)
+        duck.close()
+    del batches
+
+    with recorder.stage("extract_indexed_one_state"):
+        indexed = data_extraction(Config(csv_path=csv_path, csv_index=True))
+    any_state = indexed.get_state_info()[0]["state"]
+    recorder.repeat(
+        "fetch_indexed_state",
+        lambda: indexed.fetch_state_columns(any_state),
+        repeats=20,
+    )
+
+    queries = {
+        "query_top_cases": lambda p: p.query_top_cases(10),
+        "query_top_deaths": lambda p: p.query_top_deaths(10),
+        "query_state": lambda p: p.query_state(any_state),
+        "query_time_series": lambda p: p.query_time_series(any_state, 30),
+        "get_summary": lambda p: p.get_summary(),
+        "query_time_series_all": lambda p: p.query_time_series(any_state, days),
+        "query_derived_avg7": lambda p: p.query_derived(any_state, "new_cases", 7, 30),
+        "query_national": lambda p: p.query_national(),
+        "query_rollups_week": lambda p: p.query_rollups("week", [any_state]),
+    }
+    uncached = query_service(Config(db=config.db, cache_entries=0))
+    cached = query_service(Config(db=config.db))
+    for name, query in queries.items():
+        recorder.repeat(name, lambda: query(uncached))
+        query(cached)
+        recorder.repeat(f"{name}_cached", lambda: query(cached))
+    # what query_national saves: grouping the raw history on every call
+    scan = sqlite3.connect(config.db)
+    recorder.repeat(
+        "national_by_scan",
+        lambda: scan.execute(
+            f"SELECT day, COUNT(*), {SUM_LIST} FROM covid_states GROUP BY day"
+        ).fetchall(),
+        repeats=20,
+    )
+    scan.close()
+    # ten states over a window: one range query vs a query per state
+    compared = [item["state"] for item in indexed.get_state_info()[:10]]
+    recorder.repeat(
+        "query_time_range_10_states",
+        lambda: dict(uncached.iter_time_range(compared, fields=["cases_total"])),
+        repeats=20,
+    )
+    recorder.repeat(
+        "query_time_series_10_states",
+        lambda: [uncached.storage.get_time_series(state, days) for state in compared],
+        repeats=20,
+    )
+    # long-range series straight from SQLite vs sliced from the column store
+    sql_only = query_service(Config(db=config.db, cache_entries=0, columnar=False))
+    if duck_config is not None:
+        duck_pipeline = etl_pipeline(duck_config)
+        for name, query in queries.items():
+            recorder.repeat(f"duckdb_{name}", lambda: query(duck_pipeline))
+        duck_pipeline.storage.close()
+    for name, pipeline in (("sqlite", sql_only), ("columnar", uncached)):
+        recorder.repeat(
+            f"series_all_{name}",
+            lambda: pipeline.series(any_state, "cases_total", days),
+            repeats=20,
+        )
+    # full-history extracts: streamed in batches vs built and dumped whole
+    columns = uncached.export_columns()
+    for fmt in EXPORT_FORMATS:
+        with recorder.stage(f"export_{fmt}", rows), open(os.devnull, "w") as out:
+            write_rows(out, fmt, columns, uncached.iter_batches())
+    with recorder.stage("export_json_list", rows), open(os.devnull, "w") as out:
+        history = [dict(zip(columns, row)) for row in uncached.storage.get_history()]
+        out.write(json.dumps(history, indent=2))
+        del history
+    uncached.close()
+    cached.close()
+    sql_only.close()
+    _bench_startup(recorder, config.db, workdir, any_state)
+    layout_bytes = _bench_layouts(recorder, config.db, workdir, any_state)
+
+    return {
+        "scale": scale,
+        "states": states,
+        "days": days,
+        "rows": rows,
+        "csv_bytes": os.path.getsize(csv_path),
+        "db_bytes": os.path.getsize(config.db),
+        "layout_bytes": layout_bytes,
+        "stages": recorder.results,
+    }
+
+
+def compare(current: List[dict], baseline: List[dict], tolerance: float) -> List[str]:
+    """Timings in current that are more than tolerance x the baseline."""
+    regressions = []
+    by_scale = {run["scale"]: run for run in baseline}
+    for run in current:
+        base = by_scale.get(run["scale"])
+        if not base:
+            continue
+        for name, result in run["stages"].items():
+            before = base["stages"].get(name, {}).get("seconds")
+            after = result["seconds"]
+            if (before and after > before * tolerance
+                    and after - before > NOISE_SECONDS):
+                regressions.append(
+                    f"{run['scale']:g}x {name}: {before:.6f}s -> {after:.6f}s "
+                    f"({after / before:.2f}x)"
+                )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--scales", type=float, nargs="+", default=[1, 10])
+    parser.add_argument("--output", help="write results as JSON to this file")
+    parser.add_argument("--baseline", help="compare against a previous results file")
+    parser.add_argument("--tolerance", type=float, default=1.5)
+    parser.add_argument("--workdir", help="keep generated data here")
+    parser.add_argument("--no-trace-memory", action="store_true",
+                        help="skip tracemalloc (it slows the timed stages)")
+    args = parser.parse_args()
+
+    logging.disable(logging.WARNING)
+    workdir = args.workdir or tempfile.mkdtemp(prefix="etl-bench-")
+    os.makedirs(workdir, exist_ok=True)
+    try:
+        runs = [
+            bench_scale(scale, workdir, trace_memory=not args.no_trace_memory)
+            for scale in args.scales
+        ]
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir)
+
+    report = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "runs": runs,
+    }
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text)
+    print(text)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(runs, json.load(f)["runs"], args.tolerance)
+        for line in regressions:
+            print(f"REGRESSION {line}", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,168 @@
+import atexit
+import logging
+import os
+import pickle
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+MISSING = object()
+
+
+class query_cache:
+    """LRU cache for query results, keyed on (query, args) and tagged with
+    the storage generation they were read at.
+
+    Entries from an older generation are never returned and are dropped as
+    soon as a newer generation is seen. A persisted cache is only reused for
+    the same namespace (the database instance it was filled from). Cached
+    values are shared between callers and must not be mutated.
+
+    A persisted cache is written after save_every changes or save_interval
+    seconds, whichever comes first, and on close() or interpreter exit.
+    """
+
+    def __init__(self, max_entries: int = 256, max_bytes: int = 16 * 1024 * 1024,
+                 path: Optional[str] = None, namespace: Hashable = None,
+                 save_every: int = 64, save_interval: float = 30.0):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.path = path
+        self.namespace = namespace
+        self.generation: Optional[int] = None
+        self._entries: "OrderedDict[Hashable, Tuple[Any, int]]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.RLock()
+        self._save_lock = threading.Lock()
+        self.save_every = save_every
+        self.save_interval = save_interval
+        self._unsaved = 0
+        self._saved_at = time.monotonic()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        if path:
+            self._load()
+            atexit.register(self.close)
+
+    def _load(self):
+        try:
+            with open(self.path, "rb") as f:
+                state = pickle.load(f)
+        except FileNotFoundError:
+            return
+        except Exception as exc:
+            logger.warning("ignoring unreadable query cache %s: %s", self.path, exc)
+            return
+        if state.get("namespace") != self.namespace:
+            return
+        self.generation = state["generation"]
+        self._entries = state["entries"]
+        self._bytes = sum(size for _, size in self._entries.values())
+        self.hits = state["hits"]
+        self.misses = state["misses"]
+        self.evictions = state["evictions"]
+
+    def save(self):
+        """Write the cache to path through a temporary file, so readers
+        never see a partial pickle."""
+        if not self.path:
+            return
+        with self._lock:
+            state = {
+                "namespace": self.namespace,
+                "generation": self.generation,
+                "entries": OrderedDict(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+            self._unsaved = 0
+            self._saved_at = time.monotonic()
+        with self._save_lock:
+            fd, tmp_path = tempfile.mkstemp(
+                dir=os.path.dirname(os.path.abspath(self.path)), suffix=".tmp")
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+                os.replace(tmp_path, self.path)
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
+
+    def _changed(self) -> bool:
+        """Count a change; True when it is time to save."""
+        self._unsaved += 1
+        return bool(self.path) and (
+            self._unsaved >= self.save_every
+            or time.monotonic() - self._saved_at >= self.save_interval)
+
+    def close(self):
+        """Save pending changes; the cache stays usable afterwards."""
+        if self._unsaved:
+            self.save()
+
+    def _set_generation(self, generation: int) -> bool:
+        """Advance to generation; False if the caller is behind the cache."""
+        if self.generation is not None and generation < self.generation:
+            return False
+        if generation != self.generation:
+            self._entries.clear()
+            self._bytes = 0
+            self.generation = generation
+        return True
+
+    def get(self, key: Hashable, generation: int) -> Any:
+        """Return the cached value or MISSING."""
+        with self._lock:
+            current = self._set_generation(generation)
+            entry = self._entries.get(key) if current else None
+            if entry is None:
+                self.misses += 1
+                return MISSING
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key: Hashable, value: Any, generation: int):
+        size = len(pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL))
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if not self._set_generation(generation):
+                return
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._bytes -= previous[1]
+            self._entries[key] = (value, size)
+            self._bytes += size
+            while (len(self._entries) > self.max_entries
+                   or self._bytes > self.max_bytes):
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self._bytes -= evicted_size
+                self.evictions += 1
+            due = self._changed()
+        if due:
+            self.save()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+        self.save()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "generation": self.generation,
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
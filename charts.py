@@ -0,0 +1,97 @@
+import logging
+import math
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Tuple
+
+logger = logging.getLogger(__name__)
+
+# panels per row in render_grid
+GRID_COLUMNS = 8
+
+# (output path, dates, values, title, y label) for one chart
+chart_task = Tuple[str, object, object, str, str]
+
+# per-process renderer for parallel runs, set up by _init_worker
+_worker_renderer = None
+
+
+class chart_renderer:
+    """Draws timeline charts on one figure, reused for every chart: only
+    the line data, limits and labels change between them.
+
+    Uses the Agg canvas directly rather than pyplot, so nothing is kept in
+    pyplot's global figure registry.
+    """
+
+    def __init__(self, figsize=(10, 5)):
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        from matplotlib.figure import Figure
+
+        self.figure = Figure(figsize=figsize)
+        FigureCanvasAgg(self.figure)
+        self.axes = self.figure.add_subplot()
+        (self.line,) = self.axes.plot([], [], marker="o")
+        self.axes.set_xlabel("Date")
+        self.axes.tick_params(axis="x", labelrotation=45)
+        self.axes.grid(True)
+
+    def render(self, path: str, dates, values, title: str, ylabel: str) -> str:
+        self.axes.xaxis.update_units(dates)
+        self.line.set_data(dates, values)
+        self.axes.relim()
+        self.axes.autoscale_view()
+        self.axes.set_title(title)
+        self.axes.set_ylabel(ylabel)
+        self.figure.tight_layout()
+        self.figure.savefig(path)
+        return path
+
+
+def _init_worker():
+    global _worker_renderer
+    _worker_renderer = chart_renderer()
+
+
+def _render_task(task: chart_task) -> str:
+    return _worker_renderer.render(*task)
+
+
+def render_charts(tasks: List[chart_task], workers: int = 0) -> List[str]:
+    """Render each task to its path; with more than one worker, in a
+    process pool where every process reuses one figure. 0 means one
+    worker per CPU."""
+    workers = min(workers or os.cpu_count() or 1, len(tasks))
+    if workers <= 1:
+        renderer = chart_renderer()
+        return [renderer.render(*task) for task in tasks]
+    logger.info("rendering %d charts in %d processes", len(tasks), workers)
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker) as pool:
+        chunksize = max(1, len(tasks) // (workers * 4))
+        return list(pool.map(_render_task, tasks, chunksize=chunksize))
+
+
+def render_grid(series: Dict[str, tuple], path: str, title: str,
+                columns: int = GRID_COLUMNS) -> str:
+    """Small multiples: one panel per state of {state: (dates, values)},
+    sharing the date axis, in a single image."""
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+
+    columns = max(1, min(columns, len(series)))
+    rows = max(1, math.ceil(len(series) / columns))
+    figure = Figure(figsize=(2.4 * columns, 1.8 * rows + 0.6))
+    FigureCanvasAgg(figure)
+    panels = list(figure.subplots(rows, columns, sharex=True, squeeze=False).flat)
+    for axes, (state, (dates, values)) in zip(panels, series.items()):
+        axes.plot(dates, values, linewidth=1)
+        axes.set_title(state, fontsize=9)
+        axes.tick_params(labelsize=6)
+        axes.tick_params(axis="x", labelrotation=45)
+        axes.grid(True, linewidth=0.3)
+    for axes in panels[len(series):]:
+        axes.set_visible(False)
+    figure.suptitle(title)
+    figure.tight_layout()
+    figure.savefig(path)
+    return path
@@ -0,0 +1,233 @@
+import json
+import logging
+import os
+import secrets
+import shutil
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from schema import METRIC_FIELDS
+
+logger = logging.getLogger(__name__)
+
+FORMAT_VERSION = 1
+META_FILE = "meta.json"
+
+
+class column_view:
+    """One published version of the column store.
+
+    dates.npy is the daily date axis (datetime64[D]) shared by every state,
+    present.npy marks the (state, day) cells that have a row, and each
+    metric is a float64 (states x days) matrix with NaN for missing values.
+    All arrays are read-only memory maps, so slices are views of the files.
+    """
+
+    def __init__(self, directory: str, meta: dict):
+        self.generation: int = meta["generation"]
+        self.instance: int = meta["instance"]
+        self.state_rows: Dict[str, int] = {
+            state: row for row, state in enumerate(meta["states"])
+        }
+        self.dates = np.load(os.path.join(directory, "dates.npy"), mmap_mode="r")
+        self.present = np.load(os.path.join(directory, "present.npy"), mmap_mode="r")
+        self.metrics = {
+            field: np.load(os.path.join(directory, f"{field}.npy"), mmap_mode="r")
+            for field in METRIC_FIELDS
+        }
+
+    def _recent(self, state: str, days: int) -> Optional[np.ndarray]:
+        """Day offsets of the state's last `days` rows, oldest first."""
+        row = self.state_rows.get(state)
+        if row is None or days < 1:
+            return None
+        offsets = np.flatnonzero(self.present[row])[-days:]
+        return offsets if len(offsets) else None
+
+    def series(self, state: str, field: str, days: int
+               ) -> Tuple[np.ndarray, np.ndarray]:
+        """Dates and values spanning the state's last `days` rows.
+
+        Both are views into the store; days without a row are NaN.
+        """
+        offsets = self._recent(state, days)
+        if offsets is None:
+            return self.dates[:0], self.metrics[field][0, :0]
+        span = slice(offsets[0], offsets[-1] + 1)
+        return self.dates[span], self.metrics[field][self.state_rows[state], span]
+
+    def records(self, state: str, days: int) -> List[dict]:
+        """Same rows as sqlstorage.get_time_series, newest first."""
+        offsets = self._recent(state, days)
+        if offsets is None:
+            return []
+        offsets = offsets[::-1]
+        row = self.state_rows[state]
+        columns = {"date": self.dates[offsets].astype(str).tolist()}
+        for field, matrix in self.metrics.items():
+            columns[field] = [
+                None if value != value else int(value)
+                for value in matrix[row, offsets].tolist()
+            ]
+        return [
+            {"state": state, **{name: values[i] for name, values in columns.items()}}
+            for i in range(len(offsets))
+        ]
+
+
+class column_store:
+    """Memory-mapped columnar copy of covid_states for time-series reads.
+
+    Each refresh writes a new version directory and then swaps meta.json to
+    point at it, so open maps always see a complete version.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._view: Optional[column_view] = None
+        self._meta_stat: Optional[Tuple[int, int]] = None
+
+    @property
+    def meta_path(self) -> str:
+        return os.path.join(self.path, META_FILE)
+
+    def _read_meta(self) -> Optional[dict]:
+        try:
+            with open(self.meta_path) as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if meta.get("version") != FORMAT_VERSION:
+            return None
+        return meta
+
+    def open(self) -> Optional[column_view]:
+        """The current version, or None if the store hasn't been written."""
+        try:
+            stat = os.stat(self.meta_path)
+        except OSError:
+            return None
+        key = (stat.st_ino, stat.st_mtime_ns)
+        if self._view is not None and key == self._meta_stat:
+            return self._view
+        meta = self._read_meta()
+        if meta is None:
+            return None
+        try:
+            view = column_view(os.path.join(self.path, meta["directory"]), meta)
+        except (OSError, ValueError) as e:
+            # replaced and removed by a concurrent refresh
+            logger.warning("could not open column store %s: %s", self.path, e)
+            return None
+        self._view, self._meta_stat = view, key
+        return view
+
+    def refresh(self, storage, states: Iterable[str] = None,
+                since_generation: int = None):
+        """Bring the store up to the database's current generation.
+
+        When the store was current as of since_generation, only the given
+        states are re-read from SQLite; otherwise everything is rebuilt.
+        """
+        generation = storage.get_generation()
+        instance = storage.get_instance_id()
+        meta = self._read_meta()
+        if (meta and meta["instance"] == instance
+                and meta["generation"] == generation):
+            return
+        if (states is not None and meta and meta["instance"] == instance
+                and meta["generation"] == since_generation
+                and self._update(meta, storage, set(states), generation)):
+            return
+        self._rebuild(storage, generation, instance)
+
+    @staticmethod
+    def _to_arrays(rows: List[tuple]):
+        states = np.array([r[0] for r in rows], dtype="U2")
+        days = np.array([r[1] for r in rows], dtype="datetime64[D]")
+        values = np.array([r[2:] for r in rows], dtype=object).reshape(
+            len(rows), len(METRIC_FIELDS)
+        )
+        nulls = np.equal(values, None)
+        values[nulls] = np.nan
+        return states, days, values.astype(np.float64)
+
+    def _rebuild(self, storage, generation: int, instance: int):
+        states, days, values = self._to_arrays(storage.get_history(iso_dates=False))
+        state_list = sorted(set(states.tolist()))
+        if len(days):
+            dates = np.arange(days.min(), days.max() + 1)
+        else:
+            dates = np.empty(0, dtype="datetime64[D]")
+        present = np.zeros((len(state_list), len(dates)), dtype=bool)
+        metrics = {
+            field: np.full((len(state_list), len(dates)), np.nan)
+            for field in METRIC_FIELDS
+        }
+        self._fill(present, metrics, dates, state_list, states, days, values)
+        self._publish(state_list, dates, present, metrics, generation, instance)
+        logger.info("rebuilt column store for %d states", len(state_list))
+
+    def _update(self, meta: dict, storage, changed: set, generation: int) -> bool:
+        """Rewrite the rows of the changed states; False if the date axis or
+        state list would have to grow."""
+        directory = os.path.join(self.path, meta["directory"])
+        state_list = meta["states"]
+        if not changed <= set(state_list):
+            return False
+        states, days, values = self._to_arrays(
+            storage.get_history(changed, iso_dates=False)
+        )
+        dates = np.load(os.path.join(directory, "dates.npy"))
+        if len(days) and (not len(dates) or days.min() < dates[0]
+                          or days.max() > dates[-1]):
+            return False
+        present = np.load(os.path.join(directory, "present.npy"))
+        metrics = {
+            field: np.load(os.path.join(directory, f"{field}.npy"))
+            for field in METRIC_FIELDS
+        }
+        rows = [state_list.index(state) for state in changed]
+        present[rows] = False
+        for matrix in metrics.values():
+            matrix[rows] = np.nan
+        self._fill(present, metrics, dates, state_list, states, days, values)
+        self._publish(state_list, dates, present, metrics, generation, meta["instance"])
+        logger.info("updated column store for %d states", len(changed))
+        return True
+
+    @staticmethod
+    def _fill(present, metrics, dates, state_list, states, days, values):
+        if not len(states):
+            return
+        rows = np.searchsorted(np.array(state_list, dtype="U2"), states)
+        cols = (days - dates[0]).astype(np.int64)
+        present[rows, cols] = True
+        for i, field in enumerate(METRIC_FIELDS):
+            metrics[field][rows, cols] = values[:, i]
+
+    def _publish(self, state_list, dates, present, metrics, generation, instance):
+        os.makedirs(self.path, exist_ok=True)
+        directory = f"v{generation}-{secrets.token_hex(4)}"
+        target = os.path.join(self.path, directory)
+        os.makedirs(target)
+        np.save(os.path.join(target, "dates.npy"), dates)
+        np.save(os.path.join(target, "present.npy"), present)
+        for field, matrix in metrics.items():
+            np.save(os.path.join(target, f"{field}.npy"), matrix)
+        meta = {
+            "version": FORMAT_VERSION,
+            "directory": directory,
+            "generation": generation,
+            "instance": instance,
+            "states": state_list,
+        }
+        tmp_path = f"{self.meta_path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(meta, f)
+        os.replace(tmp_path, self.meta_path)
+        # open maps keep unlinked files alive, so old versions can go now
+        for name in os.listdir(self.path):
+            if name.startswith("v") and name != directory:
+                shutil.rmtree(os.path.join(self.path, name), ignore_errors=True)
@@ -1,8 +1,43 @@
+import os
 from dataclasses import dataclass
+from typing import Optional
 
 @dataclass
 class Config:
+    # a CSV file, a directory of .csv/.csv.gz/.csv.zst files or a glob
     csv_path: str = "all-states-history.csv"
     db: str = "covid_data.db"
+    # "sqlite" or "duckdb"; the DuckDB file defaults to <db stem>.duckdb
+    backend: str = os.environ.get("COVID_ETL_BACKEND", "sqlite")
+    duckdb_path: Optional[str] = None
     batch: int = 200
     timeout: int = 32
+    csv_index: bool = False
+    commit_rows: int = 50000
+    # processes parsing multi-file input; 0 means one per CPU
+    parse_workers: int = 0
+    pool_size: int = 4
+    cache_size_kb: int = 32 * 1024
+    mmap_size: int = 256 * 1024 * 1024
+    statement_cache: int = 256
+    cache_entries: int = 256
+    cache_bytes: int = 16 * 1024 * 1024
+    # persist query results across CLI invocations when set
+    cache_path: Optional[str] = os.environ.get("COVID_ETL_CACHE")
+    # memory-mapped time-series copy; defaults to <db>.columns
+    columnar: bool = True
+    columns_path: Optional[str] = None
+    # base URL of the covidtracking-style JSON API; when set, data is fetched
+    # from it instead of read from csv_path
+    api: Optional[str] = os.environ.get("COVID_ETL_API")
+    http_workers: int = 8
+    # processes rendering batch charts; 0 means one per CPU
+    chart_workers: int = 0
+    http_retries: int = 3
+    http_backoff: float = 0.5
+    # ETag/Last-Modified response cache; None disables it
+    http_cache_dir: Optional[str] = os.environ.get("COVID_ETL_HTTP_CACHE", ".http_cache")
+    # keep rejected rows in rejected_records; at most reject_log_samples of
+    # them are logged individually per run, the rest only as counts
+    quarantine: bool = True
+    reject_log_samples: int = 10
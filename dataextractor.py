@@ -1,54 +1,213 @@
 # extracts data using a public covid api @ covidtracking
 import logging
 from configuration import Config
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional, Tuple
 import csv
+import glob
+import gzip
+import hashlib
+import io
+import json
+import os
 from collections import defaultdict
-import requests
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 logger = logging.getLogger(__name__)
 
+INDEX_VERSION = 2
+
+EXTRACT_FIELDS = (
+    "date",
+    "state",
+    "positive",
+    "positiveCasesViral",
+    "death",
+    "deathConfirmed",
+    "deathProbable",
+    "hospitalizedCurrently",
+    "hospitalizedCumulative",
+    "inIcuCurrently",
+    "totalTestResults",
+    "positiveIncrease",
+    "deathIncrease",
+)
+
+Columns = Dict[str, List[Optional[str]]]
+
+INPUT_SUFFIXES = (".csv", ".csv.gz", ".csv.zst")
+
+
+def input_files(csv_path: str) -> List[str]:
+    """The files csv_path names: one file, a directory of CSV/.csv.gz/.csv.zst
+    files, or a glob pattern. Sorted, so shards merge in a stable order."""
+    if os.path.isdir(csv_path):
+        files = sorted(
+            path for path in glob.glob(os.path.join(csv_path, "*"))
+            if path.endswith(INPUT_SUFFIXES)
+        )
+    elif any(char in csv_path for char in "*?["):
+        files = sorted(glob.glob(csv_path))
+    else:
+        return [csv_path]
+    if not files:
+        raise FileNotFoundError(f"no CSV input files match {csv_path}")
+    return files
+
+
+def is_indexable(csv_path: str) -> bool:
+    """Byte-offset indexes only work on a single uncompressed file."""
+    files = input_files(csv_path)
+    return len(files) == 1 and not files[0].endswith((".gz", ".zst"))
+
+
+def open_text(path: str):
+    """Text stream over a plain, gzip or zstd CSV; compressed files are
+    decompressed as they are read."""
+    if path.endswith(".gz"):
+        return gzip.open(path, "rt", newline="")
+    if path.endswith(".zst"):
+        try:
+            import zstandard
+        except ImportError as e:
+            raise ImportError(
+                "reading .zst input needs the zstandard package (pip install zstandard)"
+            ) from e
+        raw = zstandard.ZstdDecompressor().stream_reader(open(path, "rb"), closefd=True)
+        return io.TextIOWrapper(raw, newline="")
+    return open(path, newline="")
+
+
+def _parse_shard(path: str) -> Tuple[Dict[str, Columns], int]:
+    """Per-state columns of one input file in file order, and its size on
+    disk."""
+    by_state: Dict[str, Columns] = {}
+    with open_text(path) as f:
+        reader = csv.reader(f)
+        positions = data_extraction._field_positions(next(reader))
+        state_pos = positions[EXTRACT_FIELDS.index("state")]
+        for row in reader:
+            state = row[state_pos] if state_pos < len(row) else None
+            if not state:
+                continue
+            columns = by_state.get(state)
+            if columns is None:
+                columns = {field: [] for field in EXTRACT_FIELDS}
+                by_state[state] = columns
+            data_extraction._append_row(columns, row, positions)
+    return by_state, os.path.getsize(path)
+
+
+def input_fingerprint(csv_path: str) -> str:
+    """Identifies local input without reading it: the path, size and mtime
+    of every input file, as for the CSV index."""
+    digest = hashlib.blake2b(digest_size=16)
+    for path in input_files(csv_path):
+        stat = os.stat(path)
+        digest.update(
+            f"{os.path.abspath(path)}\0{stat.st_size}\0{stat.st_mtime_ns}\0".encode()
+        )
+    return digest.hexdigest()
+
 
 class data_extraction:
     def __init__(self, config: Config):
         self.config = config
-        self._data_by_state: Dict[str, List[Dict[str, Any]]] = defaultdict(list)
-        self._load_data()
+        self._columns_by_state: Dict[str, Columns] = {}
+        self._index: Optional[Dict[str, Any]] = None
+        # API states, fetched lazily; a failed fetch keeps its exception
+        self._remote_states: List[str] = []
+        self._remote_errors: Dict[str, Exception] = {}
+        self.bytes_read = 0
+        self.fetcher = None
+        if self.is_remote:
+            # requests is only imported when there is something to fetch
+            from remote import http_fetcher
+            self.fetcher = http_fetcher(
+                self.config.api,
+                cache_dir=self.config.http_cache_dir,
+                timeout=self.config.timeout,
+                retries=self.config.http_retries,
+                backoff=self.config.http_backoff,
+                pool_size=self.config.http_workers,
+            )
+            self._load_remote()
+        elif self.config.csv_index and is_indexable(self.config.csv_path):
+            self._index = self._load_index()
+        else:
+            if self.config.csv_index:
+                logger.info(
+                    "%s is compressed or spans several files; loading it in full",
+                    self.config.csv_path,
+                )
+            self._load_data()
+
+    @property
+    def is_remote(self) -> bool:
+        return bool(self.config.api)
 
     def _parse_response_payload(self, payload: Any) -> Any:
         if isinstance(payload, dict) and "data" in payload:
             return payload.get("data")
         return payload
 
+    @staticmethod
+    def _field_positions(header: List[str]) -> List[Optional[int]]:
+        return [
+            header.index(field) if field in header else None
+            for field in EXTRACT_FIELDS
+        ]
+
+    @staticmethod
+    def _append_row(columns: Columns, row: List[str],
+                    positions: List[Optional[int]]) -> None:
+        for field, pos in zip(EXTRACT_FIELDS, positions):
+            columns[field].append(
+                row[pos] if pos is not None and pos < len(row) else None
+            )
+
+    @staticmethod
+    def _sort_columns(columns: Columns) -> Columns:
+        """Order a state's columns newest date first."""
+        dates = columns["date"]
+        order = sorted(
+            range(len(dates)), key=lambda i: dates[i] or "", reverse=True
+        )
+        return {field: [values[i] for i in order] for field, values in columns.items()}
+
+    @staticmethod
+    def _rows_from_columns(columns: Columns) -> List[Dict[str, Any]]:
+        return [
+            dict(zip(EXTRACT_FIELDS, values))
+            for values in zip(*(columns[field] for field in EXTRACT_FIELDS))
+        ]
+
+    def _parse_shards(self, files: List[str]):
+        workers = self.config.parse_workers or os.cpu_count() or 1
+        workers = min(workers, len(files))
+        if workers <= 1:
+            return map(_parse_shard, files)
+        logger.info("Parsing %d input files in %d processes", len(files), workers)
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            return list(pool.map(_parse_shard, files))
+
     def _load_data(self) -> None:
         try:
-            with open(self.config.csv_path, newline="") as f:
-                reader = csv.DictReader(f)
-                for row in reader:
-                    state = row.get("state")
-                    if not state:
+            files = input_files(self.config.csv_path)
+            # shards are merged in file order, as if the files were one CSV
+            for by_state, size in self._parse_shards(files):
+                self.bytes_read += size
+                for state, shard_columns in by_state.items():
+                    columns = self._columns_by_state.get(state)
+                    if columns is None:
+                        self._columns_by_state[state] = shard_columns
                         continue
-                    filtered_row = {
-                        "date": row.get("date"),
-                        "state": state,
-                        "positive": row.get("positive"),
-                        "positiveCasesViral": row.get("positiveCasesViral"),
-                        "death": row.get("death"),
-                        "deathConfirmed": row.get("deathConfirmed"),
-                        "deathProbable": row.get("deathProbable"),
-                        "hospitalizedCurrently": row.get("hospitalizedCurrently"),
-                        "hospitalizedCumulative": row.get("hospitalizedCumulative"),
-                        "inIcuCurrently": row.get("inIcuCurrently"),
-                        "totalTestResults": row.get("totalTestResults"),
-                    }
-                    self._data_by_state[state].append(filtered_row)
-            for state, records in self._data_by_state.items():
-                self._data_by_state[state] = sorted(
-                    records, key=lambda r: r.get("date", ""), reverse=True
-                )
+                    for field, values in shard_columns.items():
+                        columns[field].extend(values)
+            for state, columns in self._columns_by_state.items():
+                self._columns_by_state[state] = self._sort_columns(columns)
             logger.info(
                 "Loaded %d states worth of data from %s",
-                len(self._data_by_state),
+                len(self._columns_by_state),
                 self.config.csv_path,
             )
         except FileNotFoundError:
@@ -58,26 +217,241 @@ class data_extraction:
             logger.error("Failed to load CSV data: %s", exc)
             raise
 
+    @staticmethod
+    def _columns_from_records(records: List[Dict[str, Any]]) -> Columns:
+        """API records as the string columns the CSV would have given.
+
+        The v1 API reports dates as YYYYMMDD integers and counts as numbers;
+        null becomes the empty string, and an absent field None, as they
+        would be for an empty cell and a missing CSV column.
+        """
+        columns = {field: [] for field in EXTRACT_FIELDS}
+        for record in records:
+            for field in EXTRACT_FIELDS:
+                if field not in record:
+                    columns[field].append(None)
+                    continue
+                value = record[field]
+                if value is None:
+                    columns[field].append("")
+                    continue
+                value = str(value)
+                if field == "date" and len(value) == 8 and value.isdigit():
+                    value = f"{value[:4]}-{value[4:6]}-{value[6:]}"
+                columns[field].append(value)
+        return columns
+
+    def _fetch_remote_state(self, state: str) -> Tuple[str, Columns]:
+        records = self._parse_response_payload(
+            self.fetcher.get_json(f"states/{state.lower()}/daily.json")
+        )
+        return state, self._sort_columns(self._columns_from_records(records or []))
+
+    def _load_remote(self) -> None:
+        """List the API's states; their histories are fetched on first use,
+        or by prefetch."""
+        import requests
+
+        try:
+            info = self._parse_response_payload(self.fetcher.get_json("states/info.json"))
+        except requests.RequestException as e:
+            logger.error("failed to fetch from %s: %s", self.config.api, e)
+            raise
+        self._remote_states = sorted(
+            {item["state"] for item in info or [] if item.get("state")}
+        )
+        self.bytes_read = self.fetcher.stats["bytes"]
+
+    def _fetch_remote_safely(self, state: str):
+        import requests
+
+        try:
+            return self._fetch_remote_state(state)
+        except requests.RequestException as e:
+            return state, e
+
+    def prefetch(self, states: List[str]) -> None:
+        """Fetch API states config.http_workers at a time. A state that
+        fails is logged and raises again from fetch_state_columns, so it
+        fails alone."""
+        if not self.is_remote:
+            return
+        wanted = [
+            state for state in states
+            if state not in self._columns_by_state and state not in self._remote_errors
+        ]
+        with ThreadPoolExecutor(max_workers=max(1, self.config.http_workers)) as pool:
+            for state, result in pool.map(self._fetch_remote_safely, wanted):
+                if isinstance(result, Exception):
+                    logger.error("failed to fetch %s from %s: %s",
+                                 state, self.config.api, result)
+                    self._remote_errors[state] = result
+                else:
+                    self._columns_by_state[state] = result
+        self.bytes_read = self.fetcher.stats["bytes"]
+        logger.info(
+            "Fetched %d states from %s (%d requests, %d not modified)",
+            len(self._columns_by_state), self.config.api,
+            self.fetcher.stats["requests"], self.fetcher.stats["not_modified"],
+        )
+
+    @property
+    def index_path(self) -> str:
+        return f"{self.config.csv_path}.idx"
+
+    def _load_index(self) -> Dict[str, Any]:
+        """Reuse the sidecar index while the CSV's size and mtime match."""
+        try:
+            stat = os.stat(self.config.csv_path)
+        except FileNotFoundError:
+            logger.error("CSV file not found at %s", self.config.csv_path)
+            raise
+        try:
+            with open(self.index_path) as f:
+                index = json.load(f)
+            if (
+                index.get("version") == INDEX_VERSION
+                and index.get("size") == stat.st_size
+                and index.get("mtime_ns") == stat.st_mtime_ns
+            ):
+                logger.info("Reusing CSV index %s", self.index_path)
+                return index
+        except (OSError, ValueError):
+            pass
+        return self._build_index(stat)
+
+    @staticmethod
+    def _read_record(f) -> bytes:
+        """The next CSV record, which runs on while a quoted field holds a
+        newline."""
+        record = f.readline()
+        while record.count(b'"') % 2:
+            line = f.readline()
+            if not line:
+                break
+            record += line
+        return record
+
+    @staticmethod
+    def _record_state(record: bytes, state_col: int) -> str:
+        fields = record.split(b",", state_col + 1)[:state_col + 1]
+        # plain or fully quoted fields split cleanly; anything else (a
+        # quoted comma, an escaped quote) goes through csv
+        if len(fields) > state_col and all(
+            field.count(b'"') == 0
+            or (field.count(b'"') == 2 and field.startswith(b'"')
+                and field.rstrip(b"\r\n").endswith(b'"'))
+            for field in fields
+        ):
+            return fields[state_col].strip(b'" \r\n').decode()
+        row = next(csv.reader(io.StringIO(record.decode())), [])
+        return row[state_col].strip() if len(row) > state_col else ""
+
+    def _build_index(self, stat: os.stat_result) -> Dict[str, Any]:
+        offsets: Dict[str, List[int]] = defaultdict(list)
+        with open(self.config.csv_path, "rb") as f:
+            header_line = self._read_record(f)
+            header = next(csv.reader(io.StringIO(header_line.decode())))
+            state_col = header.index("state")
+            position = len(header_line)
+            while True:
+                record = self._read_record(f)
+                if not record:
+                    break
+                state = self._record_state(record, state_col)
+                if state:
+                    offsets[state].append(position)
+                position += len(record)
+        self.bytes_read += position
+        index = {
+            "version": INDEX_VERSION,
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+            "header": header,
+            "states": dict(offsets),
+        }
+        tmp_path = f"{self.index_path}.tmp"
+        try:
+            with open(tmp_path, "w") as f:
+                json.dump(index, f)
+            os.replace(tmp_path, self.index_path)
+        except OSError as exc:
+            logger.warning("Could not write CSV index %s: %s", self.index_path, exc)
+        logger.info(
+            "Indexed %d states from %s", len(offsets), self.config.csv_path
+        )
+        return index
+
+    def _read_indexed_columns(self, state: str) -> Columns:
+        columns = {field: [] for field in EXTRACT_FIELDS}
+        offsets = self._index["states"].get(state, [])
+        if not offsets:
+            return columns
+        lines = []
+        with open(self.config.csv_path, "rb") as f:
+            for offset in offsets:
+                f.seek(offset)
+                record = self._read_record(f)
+                self.bytes_read += len(record)
+                lines.append(record.decode())
+        positions = self._field_positions(self._index["header"])
+        for row in csv.reader(lines):
+            self._append_row(columns, row, positions)
+        return self._sort_columns(columns)
+
     def get_state_info(self) -> List[Dict[str, str]]:
+        if self._index is not None:
+            states = self._index["states"].keys()
+        elif self.is_remote:
+            states = self._remote_states
+        else:
+            states = self._columns_by_state.keys()
         return [
             {"state": code, "state": code}
-            for code in sorted(self._data_by_state.keys())
+            for code in sorted(states)
         ]
 
+    def fetch_state_columns(self, state: str) -> Columns:
+        """Raw CSV columns for a state, newest date first."""
+        if self._index is not None:
+            return self._read_indexed_columns(state)
+        if self.is_remote and state in self._remote_errors:
+            raise self._remote_errors[state]
+        if self.is_remote and state not in self._columns_by_state:
+            if state not in self._remote_states:
+                return {field: [] for field in EXTRACT_FIELDS}
+            _, self._columns_by_state[state] = self._fetch_remote_state(state)
+            self.bytes_read = self.fetcher.stats["bytes"]
+        columns = self._columns_by_state.get(state)
+        if columns is None:
+            return {field: [] for field in EXTRACT_FIELDS}
+        return dict(columns)
+
+    def input_fingerprint(self) -> str:
+        """Identifies the input a load reads: see input_fingerprint, or for
+        API input, the data fetched so far."""
+        if not self.is_remote:
+            return input_fingerprint(self.config.csv_path)
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update(self.config.api.encode())
+        for state in sorted(self._columns_by_state):
+            digest.update(repr((state, self._columns_by_state[state])).encode())
+        return digest.hexdigest()
+
     def fetch_state_daily(self, state: str) -> List[Dict[str, Any]]:
-        return list(self._data_by_state.get(state, []))
+        return self._rows_from_columns(self.fetch_state_columns(state))
     
     def fetch_state_current(self, state: str) -> Dict[str, Any]:
-        records = self._data_by_state.get(state, [])
+        records = self.fetch_state_daily(state)
         return records[0] if records else {}
     
     def fetch_us_daily(self) -> List[Dict[str, Any]]:
-        url = f"{self.config.api}/us/daily.json"
+        if self.fetcher is None:
+            raise RuntimeError("US daily data needs a remote source; set config.api")
+        import requests
 
         try:
-            response = self.session.get(url, timeout=self.config.timeout)
-            response.raise_for_status()
-            data = self._parse_response_payload(response.json())
+            data = self._parse_response_payload(self.fetcher.get_json("us/daily.json"))
             if data is None:
                 data = []
             logger.info(f"fetched {len(data)} daily US records")
@@ -85,6 +459,7 @@ class data_extraction:
         except requests.RequestException as e:
             logger.error("failed to fetch US daily data: %s", e)
             raise
-    
+
     def close(self):
-        return None
\ No newline at end of file
+        if self.fetcher is not None:
+            self.fetcher.close()
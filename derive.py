@@ -0,0 +1,86 @@
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+
+from fields import DERIVED_FIELDS, INCREASE_SOURCES, METRIC_FIELDS, ROLLING_WINDOW
+from schema import record_batch
+from transform import data_cleaner
+
+Derived = Dict[str, np.ndarray]
+
+
+class metric_deriver:
+    """Daily increases and rolling averages of the cumulative totals.
+
+    Works on one state's cleaned history at a time. Results are float64
+    columns with NaN where a value can't be computed, plus the int32
+    epoch days they belong to, oldest first.
+    """
+
+    def __init__(self, cleaner: data_cleaner = None):
+        self.cleaner = cleaner or data_cleaner()
+
+    @staticmethod
+    def _rolling_mean(values: np.ndarray, window: int) -> np.ndarray:
+        """Trailing mean over `window` rows; NaN unless all of them are set."""
+        valid = ~np.isnan(values)
+        sums = np.concatenate(([0.0], np.cumsum(np.where(valid, values, 0.0))))
+        counts = np.concatenate(([0], np.cumsum(valid)))
+        means = np.full(len(values), np.nan)
+        if len(values) >= window:
+            full = counts[window:] - counts[:-window] == window
+            means[window - 1:] = np.where(
+                full, (sums[window:] - sums[:-window]) / window, np.nan
+            )
+        return means
+
+    def derive(self, batch: record_batch,
+               columns: Optional[Dict[str, Sequence[Optional[str]]]] = None,
+               rejected: Optional[np.ndarray] = None) -> Derived:
+        """Derived metrics for a state's batch.
+
+        columns/rejected are the raw CSV columns and clean_batch's reject
+        mask; when given, the source's own reported increases are kept too.
+        """
+        order = np.argsort(batch.days, kind="stable")
+        derived: Derived = {"days": batch.days[order]}
+        for name, (total_field, source) in INCREASE_SOURCES.items():
+            col = METRIC_FIELDS.index(total_field)
+            totals = np.where(
+                batch.nulls[order, col], np.nan, batch.values[order, col]
+            ).astype(np.float64)
+            increases = np.full(len(totals), np.nan)
+            increases[1:] = np.diff(totals)
+            derived[name] = increases
+            derived[f"{name}_avg{ROLLING_WINDOW}"] = self._rolling_mean(
+                increases, ROLLING_WINDOW
+            )
+            reported = np.full(len(totals), np.nan)
+            if columns is not None and source in columns:
+                parsed = self.cleaner._parse_ints(
+                    self.cleaner._as_str_array(columns[source])
+                )
+                keep = ~rejected if rejected is not None else slice(None)
+                parsed = parsed[keep]
+                reported = np.where(
+                    np.ma.getmaskarray(parsed), np.nan, parsed.data
+                ).astype(np.float64)[order]
+            derived[f"reported_{name}"] = reported
+        return derived
+
+
+def derived_rows(state: str, derived: Derived, since_day: int = None) -> List[tuple]:
+    """(state, iso date, *DERIVED_FIELDS) tuples for days after since_day;
+    NaN becomes None and increases become ints."""
+    keep = slice(None)
+    if since_day is not None:
+        keep = derived["days"] > since_day
+    dates = derived["days"][keep].astype("datetime64[D]").astype(str).tolist()
+    columns = []
+    for field in DERIVED_FIELDS:
+        as_int = "_avg" not in field
+        columns.append([
+            None if value != value else (int(value) if as_int else value)
+            for value in derived[field][keep].tolist()
+        ])
+    return [(state, day, *values) for day, *values in zip(dates, *columns)]
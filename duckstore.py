@@ -0,0 +1,899 @@
+import csv
+import logging
+import os
+import secrets
+import threading
+from contextlib import contextmanager
+from datetime import date
+from typing import Dict, Iterable, Iterator, List, Optional
+
+import numpy as np
+
+from backend import BATCH_ROWS, Records, storage_backend
+from configuration import Config
+from dataextractor import EXTRACT_FIELDS, input_files, open_text
+from fields import (
+    DERIVED_FIELDS, INCREASE_SOURCES, ROLLING_WINDOW, ROLLUP_PERIODS,
+)
+from quarantine import reject_log
+from schema import METRIC_FIELDS, record_batch
+from transform import METRIC_SOURCES
+
+logger = logging.getLogger(__name__)
+
+# rows per INSERT when quarantining
+QUARANTINE_CHUNK = 500
+
+# covid_states rows as the SQLite backend returns them
+ROW_COLUMNS = """* EXCLUDE (loaded_at) REPLACE (
+    strftime(date, '%Y-%m-%d') AS date
+)"""
+
+METRIC_LIST = ", ".join(METRIC_FIELDS)
+DERIVED_LIST = ", ".join(DERIVED_FIELDS)
+
+
+def _import_duckdb():
+    try:
+        import duckdb
+    except ImportError as e:
+        raise ImportError(
+            "the duckdb backend needs the duckdb package (pip install duckdb)"
+        ) from e
+    return duckdb
+
+
+def _period_rollup(period: str) -> str:
+    """Each state's week or month buckets, with the values of their last day."""
+    last_values = ", ".join(f"arg_max({f}, date) AS {f}" for f in METRIC_FIELDS)
+    return f"""
+        SELECT '{period}' AS period, state,
+               date_trunc('{period}', date)::DATE AS start_date,
+               COUNT(*) AS days, MAX(date) AS last_date, {last_values}
+        FROM covid_states
+        GROUP BY state, date_trunc('{period}', date)
+    """
+
+
+class duckdbstorage(storage_backend):
+    """DuckDB storage: same tables and queries as sqlstorage, executed by a
+    columnar engine.
+
+    latest_by_state and the rollups are views, since a windowed or grouped
+    scan of covid_states is cheap here. Each thread gets its own cursor on one shared database
+    handle; writes are serialized by a lock.
+    """
+
+    supports_csv_ingest = True
+
+    def __init__(self, config: Config, read_only: bool = False):
+        duckdb = _import_duckdb()
+        self.db = config.duckdb_path or os.path.splitext(config.db)[0] + ".duckdb"
+        if read_only and not os.path.exists(self.db):
+            raise FileNotFoundError(
+                f"no database at {self.db}; load data with `fetch` first"
+            )
+        self._conn = duckdb.connect(self.db, read_only=read_only)
+        self._write_lock = threading.RLock()
+        self._local = threading.local()
+        self._cursors = []
+        if not read_only:
+            self._init_db()
+
+    def _init_db(self):
+        with self._get_connection() as conn:
+            conn.execute(f"""
+                CREATE TABLE IF NOT EXISTS covid_states (
+                    state VARCHAR NOT NULL,
+                    date DATE NOT NULL,
+                    {", ".join(f"{field} BIGINT" for field in METRIC_FIELDS)},
+                    loaded_at TIMESTAMP DEFAULT current_localtimestamp()
+                )
+            """)
+            conn.execute("""
+                CREATE OR REPLACE VIEW latest_by_state AS
+                SELECT * FROM covid_states
+                QUALIFY row_number() OVER (PARTITION BY state ORDER BY date DESC) = 1
+            """)
+            conn.execute(f"""
+                CREATE OR REPLACE VIEW rollup_national_daily AS
+                SELECT date, COUNT(*) AS states,
+                       {", ".join(f"COALESCE(SUM({f}), 0)::BIGINT AS {f}" for f in METRIC_FIELDS)}
+                FROM covid_states
+                GROUP BY date
+            """)
+            conn.execute(
+                "CREATE OR REPLACE VIEW rollup_state_period AS "
+                + " UNION ALL ".join(map(_period_rollup, ROLLUP_PERIODS))
+            )
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS load_watermarks (
+                    state VARCHAR PRIMARY KEY,
+                    max_date VARCHAR,
+                    row_count INTEGER,
+                    source_digest VARCHAR,
+                    updated_at TIMESTAMP DEFAULT current_localtimestamp()
+                )
+            """)
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS load_row_hashes (
+                    state VARCHAR NOT NULL,
+                    date VARCHAR NOT NULL,
+                    row_hash VARCHAR NOT NULL,
+                    PRIMARY KEY (state, date)
+                )
+            """)
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS derived_metrics (
+                    state VARCHAR NOT NULL,
+                    date DATE NOT NULL,
+                    new_cases BIGINT,
+                    new_deaths BIGINT,
+                    new_cases_avg7 DOUBLE,
+                    new_deaths_avg7 DOUBLE,
+                    reported_new_cases BIGINT,
+                    reported_new_deaths BIGINT,
+                    PRIMARY KEY (state, date)
+                )
+            """)
+            conn.execute("CREATE SEQUENCE IF NOT EXISTS rejected_records_id")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS rejected_records (
+                    id BIGINT PRIMARY KEY DEFAULT nextval('rejected_records_id'),
+                    state VARCHAR NOT NULL,
+                    date VARCHAR,
+                    reason VARCHAR NOT NULL,
+                    raw VARCHAR NOT NULL UNIQUE,
+                    quarantined_at TIMESTAMP DEFAULT current_localtimestamp()
+                )
+            """)
+            conn.execute("CREATE SEQUENCE IF NOT EXISTS load_runs_id")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS load_runs (
+                    id BIGINT PRIMARY KEY DEFAULT nextval('load_runs_id'),
+                    fingerprint VARCHAR NOT NULL,
+                    mode VARCHAR NOT NULL,
+                    status VARCHAR NOT NULL DEFAULT 'running',
+                    started_at TIMESTAMP DEFAULT current_localtimestamp(),
+                    finished_at TIMESTAMP
+                )
+            """)
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS load_run_states (
+                    run_id BIGINT NOT NULL,
+                    state VARCHAR NOT NULL,
+                    records BIGINT,
+                    completed_at TIMESTAMP DEFAULT current_localtimestamp(),
+                    PRIMARY KEY (run_id, state)
+                )
+            """)
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS etl_meta (
+                    key VARCHAR PRIMARY KEY,
+                    value BIGINT
+                )
+            """)
+            conn.execute("""
+                INSERT OR IGNORE INTO etl_meta (key, value)
+                VALUES ('instance', ?)
+            """, (secrets.randbits(62),))
+            logger.info("database initialized")
+
+    def _cursor(self):
+        cursor = getattr(self._local, "cursor", None)
+        if cursor is None:
+            cursor = self._conn.cursor()
+            self._local.cursor = cursor
+            self._cursors.append(cursor)
+        return cursor
+
+    @property
+    def _session(self):
+        return getattr(self._local, "session", None)
+
+    @contextmanager
+    def _transaction(self, conn):
+        """BEGIN/COMMIT around the block unless one is already open."""
+        if getattr(self._local, "in_transaction", False):
+            yield conn
+            return
+        conn.execute("BEGIN")
+        self._local.in_transaction = True
+        try:
+            yield conn
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        finally:
+            self._local.in_transaction = False
+
+    @contextmanager
+    def _get_connection(self, readonly: bool = False):
+        if self._session is not None:
+            yield self._session
+        elif readonly:
+            yield self._cursor()
+        else:
+            with self._write_lock:
+                conn = self._cursor()
+                with self._transaction(conn):
+                    yield conn
+
+    @staticmethod
+    def _dicts(cursor) -> List[dict]:
+        names = [column[0] for column in cursor.description]
+        return [dict(zip(names, row)) for row in cursor.fetchall()]
+
+    def get_generation(self) -> int:
+        with self._get_connection(readonly=True) as conn:
+            row = conn.execute(
+                "SELECT value FROM etl_meta WHERE key = 'generation'"
+            ).fetchone()
+            return row[0] if row else 0
+
+    def get_instance_id(self) -> int:
+        with self._get_connection(readonly=True) as conn:
+            return conn.execute(
+                "SELECT value FROM etl_meta WHERE key = 'instance'"
+            ).fetchone()[0]
+
+    @staticmethod
+    def _bump_generation(conn):
+        conn.execute("""
+            INSERT INTO etl_meta (key, value) VALUES ('generation', 1)
+            ON CONFLICT (key) DO UPDATE SET value = value + 1
+        """)
+
+    @contextmanager
+    def session(self):
+        """Route this thread's calls through one cursor while holding the
+        write lock. DuckDB has no savepoints, so writes commit block by
+        block (see savepoint) rather than when the session closes."""
+        with self._write_lock:
+            self._local.session = self._cursor()
+            try:
+                yield self._session
+            finally:
+                self._local.session = None
+
+    @contextmanager
+    def savepoint(self, conn, name: str = "load_state"):
+        """Run the block in its own transaction."""
+        with self._transaction(conn):
+            yield conn
+
+    @contextmanager
+    def bulk_load(self):
+        with self.session() as conn:
+            yield conn
+            conn.execute("CHECKPOINT")
+
+    def close(self):
+        for cursor in self._cursors:
+            cursor.close()
+        self._cursors.clear()
+        self._conn.close()
+
+    def _stage(self, conn, batch: record_batch):
+        """Load a batch into the temp table staged, last duplicate wins."""
+        columns = {
+            "state": batch.states,
+            "day": batch.days,
+            "seq": np.arange(len(batch)),
+        }
+        metrics = []
+        for i, field in enumerate(METRIC_FIELDS):
+            columns[f"v{i}"] = batch.values[:, i]
+            columns[f"n{i}"] = batch.nulls[:, i]
+            metrics.append(f"CASE WHEN n{i} THEN NULL ELSE v{i} END AS {field}")
+        conn.register("batch_columns", columns)
+        try:
+            conn.execute(f"""
+                CREATE OR REPLACE TEMP TABLE staged AS
+                SELECT state, DATE '1970-01-01' + day AS date, {", ".join(metrics)}
+                FROM batch_columns
+                QUALIFY row_number() OVER (PARTITION BY state, day ORDER BY seq DESC) = 1
+            """)
+        finally:
+            conn.unregister("batch_columns")
+
+    @staticmethod
+    def _upsert_staged(conn):
+        conn.execute("""
+            DELETE FROM covid_states
+            USING staged
+            WHERE covid_states.state = staged.state
+              AND covid_states.date = staged.date
+        """)
+        conn.execute(f"""
+            INSERT INTO covid_states (state, date, {METRIC_LIST})
+            SELECT state, date, {METRIC_LIST} FROM staged
+        """)
+
+    def _forget_incremental(self, conn, states: Iterable[str]):
+        # a full load overwrites rows behind the incremental bookkeeping
+        for table in ("load_watermarks", "load_row_hashes"):
+            conn.executemany(
+                f"DELETE FROM {table} WHERE state = ?",
+                [(state,) for state in states],
+            )
+
+    def insert_records(self, records: Records):
+        if not isinstance(records, record_batch):
+            records = record_batch.from_rows(list(self._iter_rows(records)))
+        with self._get_connection() as conn, self._transaction(conn):
+            self._stage(conn, records)
+            self._upsert_staged(conn)
+            self._bump_generation(conn)
+            self._forget_incremental(conn, self._states_of(records))
+            logger.info(f"Inserted {len(records)} records")
+
+    def ingest_csv(self, csv_path: str, states: Iterable[str] = None) -> int:
+        """Read, clean and load the CSV input in one statement, with the
+        same rules as data_cleaner: strict dates, int(float(x)) metrics,
+        blanks and junk as NULL, rows with a bad state or date or a negative
+        metric quarantined in rejected_records.
+        csv_path is anything input_files accepts; DuckDB decompresses .gz
+        and .zst files itself."""
+        files = input_files(csv_path)
+        header = set()
+        for path in files:
+            with open_text(path) as f:
+                header.update(next(csv.reader(f), []))
+
+        def parse_int(source: str, name: str) -> str:
+            # like the extractor, a missing column reads as blank
+            if source not in header:
+                return f"NULL::BIGINT AS {name}"
+            return f'TRY_CAST(trunc(TRY_CAST("{source}" AS DOUBLE)) AS BIGINT) AS {name}'
+
+        metrics = ",\n".join(
+            parse_int(source, field) for field, source in METRIC_SOURCES.items()
+        )
+        reported = ",\n".join(
+            parse_int(source, f"reported_{name}")
+            for name, (_, source) in INCREASE_SOURCES.items()
+        )
+        # the same reason codes, in the same order, as data_cleaner.reject_reasons
+        reason = " ".join(
+            [f"WHEN length(state) != 2 THEN 'bad_state'",
+             "WHEN date IS NULL THEN 'bad_date'"]
+            + [f"WHEN {field} < 0 THEN 'negative_{field}'" for field in METRIC_FIELDS]
+        )
+        # raw values ride along as r0..rN; only rejected rows turn them into JSON
+        raw_columns = ",\n".join(
+            f'"{field}" AS r{i}' if field in header else f"NULL::VARCHAR AS r{i}"
+            for i, field in enumerate(EXTRACT_FIELDS)
+        )
+        raw_json = ", ".join(
+            f"'{field}', r{i}" for i, field in enumerate(EXTRACT_FIELDS)
+        )
+        # like the extractor, rows without a state are skipped, not rejected
+        where = "state IS NOT NULL AND state != ''"
+        params: list = [files]
+        if states is not None:
+            states = sorted({state.upper() for state in states})
+            where += f" AND state IN ({', '.join('?' * len(states))})"
+            params += states
+        with self._get_connection() as conn, self._transaction(conn):
+            conn.execute(f"""
+                CREATE OR REPLACE TEMP TABLE parsed AS
+                SELECT * EXCLUDE ({", ".join(f"r{i}" for i in range(len(EXTRACT_FIELDS)))}),
+                       CASE WHEN reason IS NOT NULL
+                            THEN CAST(json_object({raw_json}) AS VARCHAR) END AS raw
+                FROM (
+                    SELECT *, CASE {reason} END AS reason FROM (
+                        SELECT upper(state) AS state,
+                               TRY_STRPTIME(date, '%Y-%m-%d')::DATE AS date,
+                               {metrics},
+                               {reported},
+                               row_number() OVER () AS seq,
+                               {raw_columns}
+                        FROM read_csv(?, header = true, all_varchar = true,
+                                      union_by_name = true)
+                    )
+                    WHERE {where}
+                )
+            """, params)
+            conn.execute(f"""
+                CREATE OR REPLACE TEMP TABLE staged AS
+                SELECT state, date, {METRIC_LIST},
+                       reported_new_cases, reported_new_deaths
+                FROM parsed
+                WHERE reason IS NULL
+                QUALIFY row_number() OVER (PARTITION BY state, date ORDER BY seq DESC) = 1
+            """)
+            self._quarantine_parsed(conn)
+            loaded = conn.execute("SELECT count(*) FROM staged").fetchone()[0]
+            loaded_states = [
+                row[0] for row in conn.execute("SELECT DISTINCT state FROM staged").fetchall()
+            ]
+            self._upsert_staged(conn)
+            self._derive_staged_states(conn)
+            self._bump_generation(conn)
+            self._forget_incremental(conn, loaded_states)
+        logger.info("ingested %d records from %s", loaded, csv_path)
+        return loaded
+
+    def csv_states(self, csv_path: str) -> List[str]:
+        """Only the state column is read, so the extractor needn't parse
+        the input before an ingest."""
+        with self._get_connection(readonly=True) as conn:
+            return [row[0] for row in conn.execute("""
+                SELECT DISTINCT state
+                FROM read_csv(?, header = true, all_varchar = true,
+                              union_by_name = true)
+                WHERE state IS NOT NULL AND state != ''
+                ORDER BY state
+            """, [input_files(csv_path)]).fetchall()]
+
+    @staticmethod
+    def _quarantine_parsed(conn):
+        """Move parsed's rejected rows to rejected_records and log their
+        counts per state and reason."""
+        counts = conn.execute("""
+            SELECT state, reason, count(*) FROM parsed
+            WHERE reason IS NOT NULL
+            GROUP BY ALL
+        """).fetchall()
+        if not counts:
+            return
+        conn.execute("""
+            INSERT INTO rejected_records (state, date, reason, raw)
+            SELECT state, r_date, reason, raw FROM (
+                SELECT state, json_extract_string(raw, '$.date') AS r_date,
+                       reason, raw, seq
+                FROM parsed
+                WHERE reason IS NOT NULL
+            )
+            QUALIFY row_number() OVER (PARTITION BY raw ORDER BY seq DESC) = 1
+            ON CONFLICT (raw) DO UPDATE SET
+                reason = excluded.reason,
+                quarantined_at = current_localtimestamp()
+        """)
+        tally = reject_log(max_samples=0)
+        for state, reason, count in counts:
+            tally.count(state, reason, count)
+        tally.report()
+
+    @staticmethod
+    def _derive_staged_states(conn):
+        """Recompute derived_metrics for every state in staged, in SQL;
+        the same definitions as metric_deriver."""
+        window = f"""(PARTITION BY state ORDER BY date
+                      ROWS BETWEEN {ROLLING_WINDOW - 1} PRECEDING AND CURRENT ROW)"""
+        conn.execute("""
+            DELETE FROM derived_metrics
+            WHERE state IN (SELECT DISTINCT state FROM staged)
+        """)
+        conn.execute(f"""
+            INSERT INTO derived_metrics (state, date, {DERIVED_LIST})
+            SELECT state, date, new_cases, new_deaths,
+                   CASE WHEN count(new_cases) OVER w = {ROLLING_WINDOW}
+                        THEN avg(new_cases) OVER w END,
+                   CASE WHEN count(new_deaths) OVER w = {ROLLING_WINDOW}
+                        THEN avg(new_deaths) OVER w END,
+                   reported_new_cases, reported_new_deaths
+            FROM (
+                SELECT c.state, c.date,
+                       c.cases_total - lag(c.cases_total)
+                           OVER (PARTITION BY c.state ORDER BY c.date) AS new_cases,
+                       c.deaths_total - lag(c.deaths_total)
+                           OVER (PARTITION BY c.state ORDER BY c.date) AS new_deaths,
+                       s.reported_new_cases, s.reported_new_deaths
+                FROM covid_states c
+                LEFT JOIN staged s ON s.state = c.state AND s.date = c.date
+                WHERE c.state IN (SELECT DISTINCT state FROM staged)
+            )
+            WINDOW w AS {window}
+        """)
+
+    def insert_derived(self, state: str, rows: List[tuple], replace: bool = False):
+        """Write (state, date, *DERIVED_FIELDS) rows; replace drops the
+        state's existing rows first."""
+        with self._get_connection() as conn, self._transaction(conn):
+            if replace:
+                conn.execute("DELETE FROM derived_metrics WHERE state = ?", (state,))
+            elif rows:
+                conn.execute(
+                    "DELETE FROM derived_metrics WHERE state = ? AND date >= CAST(? AS DATE)",
+                    (state, min(row[1] for row in rows)),
+                )
+            if rows:
+                conn.executemany(f"""
+                    INSERT INTO derived_metrics (state, date, {DERIVED_LIST})
+                    VALUES ({", ".join("?" * (len(DERIVED_FIELDS) + 2))})
+                """, rows)
+            self._bump_generation(conn)
+
+    def get_derived_watermark(self, state: str) -> Optional[str]:
+        with self._get_connection(readonly=True) as conn:
+            return conn.execute("""
+                SELECT strftime(MAX(date), '%Y-%m-%d') FROM derived_metrics
+                WHERE state = ?
+            """, (state,)).fetchone()[0]
+
+    def get_derived_series(self, state: str, days: int = 30,
+                           fields: Iterable[str] = DERIVED_FIELDS) -> List[dict]:
+        """Newest-first derived rows for a state, limited to `fields`."""
+        fields = [f for f in fields if f in DERIVED_FIELDS]
+        with self._get_connection(readonly=True) as conn:
+            return self._dicts(conn.execute(f"""
+                SELECT {", ".join(["state", "strftime(date, '%Y-%m-%d') AS date", *fields])}
+                FROM derived_metrics
+                WHERE state = ?
+                ORDER BY date DESC
+                LIMIT ?
+            """, (state.upper(), days)))
+
+    def quarantine(self, rows: List[tuple]):
+        """Write (state, date, reason, raw) rows to rejected_records; a row
+        that is already quarantined keeps its id and takes the new reason."""
+        # one statement per chunk, and DuckDB won't upsert a key twice in one
+        latest = list({row[3]: row for row in rows}.values())
+        with self._get_connection() as conn, self._transaction(conn):
+            for start in range(0, len(latest), QUARANTINE_CHUNK):
+                chunk = latest[start:start + QUARANTINE_CHUNK]
+                conn.execute(f"""
+                    INSERT INTO rejected_records (state, date, reason, raw)
+                    VALUES {", ".join(["(?, ?, ?, ?)"] * len(chunk))}
+                    ON CONFLICT (raw) DO UPDATE SET
+                        reason = excluded.reason,
+                        quarantined_at = current_localtimestamp()
+                """, [value for row in chunk for value in row])
+
+    @staticmethod
+    def _rejected_filter(state: Optional[str], reason: Optional[str]):
+        clauses, params = [], []
+        if state is not None:
+            clauses.append("state = ?")
+            params.append(state.upper())
+        if reason is not None:
+            clauses.append("reason = ?")
+            params.append(reason)
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+        return where, params
+
+    def get_rejected(self, state: str = None, reason: str = None,
+                     limit: int = None) -> List[dict]:
+        where, params = self._rejected_filter(state, reason)
+        if limit is not None:
+            params.append(limit)
+        with self._get_connection(readonly=True) as conn:
+            return self._dicts(conn.execute(f"""
+                SELECT id, state, date, reason, raw,
+                       strftime(quarantined_at, '%Y-%m-%d %H:%M:%S') AS quarantined_at
+                FROM rejected_records {where}
+                ORDER BY id
+                {"LIMIT ?" if limit is not None else ""}
+            """, params))
+
+    def get_rejected_counts(self, state: str = None) -> List[dict]:
+        where, params = self._rejected_filter(state, None)
+        with self._get_connection(readonly=True) as conn:
+            return self._dicts(conn.execute(f"""
+                SELECT state, reason, count(*) AS rows
+                FROM rejected_records {where}
+                GROUP BY state, reason
+                ORDER BY state, reason
+            """, params))
+
+    def delete_rejected(self, ids: Iterable[int]):
+        ids = list(ids)
+        if not ids:
+            return
+        with self._get_connection() as conn, self._transaction(conn):
+            conn.execute(
+                "DELETE FROM rejected_records WHERE id IN (SELECT unnest(?))", [ids]
+            )
+
+    def get_watermark(self, state: str) -> Optional[dict]:
+        with self._get_connection(readonly=True) as conn:
+            rows = self._dicts(conn.execute(
+                "SELECT * FROM load_watermarks WHERE state = ?", (state.upper(),)
+            ))
+            return rows[0] if rows else None
+
+    def insert_records_incremental(self, records: Records, state: str,
+                                   source_digest: Optional[str] = None
+                                   ) -> Dict[str, int]:
+        """Write only rows that are new or whose content changed."""
+        state = state.upper()
+        with self._get_connection() as conn, self._transaction(conn):
+            known = dict(conn.execute("""
+                SELECT date, row_hash FROM load_row_hashes WHERE state = ?
+            """, (state,)).fetchall())
+            rows = list(self._iter_rows(records))
+            hashed = set(known)
+            # rows written by a full load or an ingest have no hash yet:
+            # compare them with what covid_states holds instead
+            if any(values[1] not in hashed for values in rows):
+                for stored in conn.execute(f"""
+                    SELECT state, strftime(date, '%Y-%m-%d'), {METRIC_LIST}
+                    FROM covid_states WHERE state = ?
+                """, (state,)).fetchall():
+                    known.setdefault(stored[1], self._row_hash(tuple(stored)))
+            changed = []
+            hashes = []
+            inserted = updated = skipped = 0
+            max_date = None
+            for values in rows:
+                row_hash = self._row_hash(values)
+                day = values[1]
+                if max_date is None or day > max_date:
+                    max_date = day
+                previous = known.get(day)
+                if previous == row_hash:
+                    skipped += 1
+                    if day not in hashed:
+                        hashes.append((values[0], day, row_hash))
+                    continue
+                if previous is None:
+                    inserted += 1
+                else:
+                    updated += 1
+                changed.append(values)
+                hashes.append((values[0], day, row_hash))
+
+            if changed:
+                self._stage(conn, record_batch.from_rows(changed))
+                self._upsert_staged(conn)
+                self._bump_generation(conn)
+            if hashes:
+                conn.executemany("""
+                    INSERT OR REPLACE INTO load_row_hashes (state, date, row_hash)
+                    VALUES (?, ?, ?)
+                """, hashes)
+            conn.execute("""
+                INSERT OR REPLACE INTO load_watermarks
+                (state, max_date, row_count, source_digest)
+                VALUES (?, ?, ?, ?)
+            """, (state, max_date, len(records), source_digest))
+        stats = {
+            "inserted": inserted, "updated": updated, "skipped": skipped,
+            "first_changed": min((values[1] for values in changed), default=None),
+        }
+        logger.info(
+            "Incremental load for %s: %d inserted, %d updated, %d skipped",
+            state, inserted, updated, skipped,
+        )
+        return stats
+
+    def begin_load_run(self, fingerprint: str, mode: str,
+                       resume: bool = False) -> int:
+        """Start a run, or with resume reopen the latest run on the same
+        input, keeping the states it completed."""
+        with self._get_connection() as conn, self._transaction(conn):
+            row = None
+            if resume:
+                row = conn.execute("""
+                    SELECT id FROM load_runs WHERE fingerprint = ?
+                    ORDER BY id DESC LIMIT 1
+                """, (fingerprint,)).fetchone()
+            if row is not None:
+                conn.execute("""
+                    UPDATE load_runs
+                    SET status = 'running', mode = ?, finished_at = NULL
+                    WHERE id = ?
+                """, (mode, row[0]))
+                return row[0]
+            return conn.execute("""
+                INSERT INTO load_runs (fingerprint, mode) VALUES (?, ?)
+                RETURNING id
+            """, (fingerprint, mode)).fetchone()[0]
+
+    def get_completed_states(self, run_id: int) -> Dict[str, Optional[int]]:
+        with self._get_connection(readonly=True) as conn:
+            return dict(conn.execute("""
+                SELECT state, records FROM load_run_states WHERE run_id = ?
+            """, (run_id,)).fetchall())
+
+    def complete_state(self, run_id: int, state: str,
+                       records: Optional[int]):
+        """Checkpoint a state; inside a savepoint it commits with the
+        state's rows."""
+        with self._get_connection() as conn, self._transaction(conn):
+            conn.execute("""
+                INSERT OR REPLACE INTO load_run_states (run_id, state, records)
+                VALUES (?, ?, ?)
+            """, (run_id, state.upper(), records))
+
+    def finish_load_run(self, run_id: int, status: str):
+        with self._get_connection() as conn, self._transaction(conn):
+            conn.execute("""
+                UPDATE load_runs
+                SET status = ?, finished_at = current_localtimestamp()
+                WHERE id = ?
+            """, (status, run_id))
+
+    def get_load_runs(self, limit: int = 10) -> List[dict]:
+        """Newest runs first, with how many states each has completed."""
+        with self._get_connection(readonly=True) as conn:
+            return self._dicts(conn.execute("""
+                SELECT r.id, r.fingerprint, r.mode, r.status,
+                       strftime(r.started_at, '%Y-%m-%d %H:%M:%S') AS started_at,
+                       strftime(r.finished_at, '%Y-%m-%d %H:%M:%S') AS finished_at,
+                       count(s.state) AS states, sum(s.records)::BIGINT AS records
+                FROM load_runs r
+                LEFT JOIN load_run_states s ON s.run_id = r.id
+                GROUP BY ALL
+                ORDER BY r.id DESC
+                LIMIT ?
+            """, (limit,)))
+
+    def check_latest(self) -> List[str]:
+        """latest_by_state is a view here, so it is never out of date."""
+        return []
+
+    def rebuild_latest(self):
+        with self._get_connection() as conn:
+            self._bump_generation(conn)
+
+    def rebuild_rollups(self):
+        """The rollups are views here; only invalidates cached results."""
+        with self._get_connection() as conn:
+            self._bump_generation(conn)
+
+    @staticmethod
+    def _date_bounds(column: str, start, end):
+        clauses, params = [], []
+        if start is not None:
+            clauses.append(f"{column} >= CAST(? AS DATE)")
+            params.append(start)
+        if end is not None:
+            clauses.append(f"{column} <= CAST(? AS DATE)")
+            params.append(end)
+        return clauses, params
+
+    def get_national_daily(self, start=None, end=None) -> List[dict]:
+        _, start, end = self._range_filter(None, start, end)
+        clauses, params = self._date_bounds("date", start, end)
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+        with self._get_connection(readonly=True) as conn:
+            return self._dicts(conn.execute(f"""
+                SELECT strftime(date, '%Y-%m-%d') AS date, states, {METRIC_LIST}
+                FROM rollup_national_daily {where}
+                ORDER BY date
+            """, params))
+
+    def get_rollups(self, period: str, states: Iterable[str] = None,
+                    start=None, end=None) -> List[dict]:
+        if period not in ROLLUP_PERIODS:
+            raise ValueError(f"period must be one of {', '.join(ROLLUP_PERIODS)}")
+        states, start, end = self._range_filter(states, start, end)
+        clauses, params = ["period = ?"], [period]
+        if states is not None:
+            if not states:
+                return []
+            clauses.append(f"state IN ({', '.join('?' * len(states))})")
+            params.extend(states)
+        bounds, bound_params = self._date_bounds("start_date", start, end)
+        outer = f"WHERE {' AND '.join(bounds)}" if bounds else ""
+        with self._get_connection(readonly=True) as conn:
+            return self._dicts(conn.execute(f"""
+                SELECT period, state, strftime(start_date, '%Y-%m-%d') AS start,
+                       days, strftime(last_date, '%Y-%m-%d') AS last_date,
+                       {METRIC_LIST}, new_cases, new_deaths
+                FROM (
+                    SELECT *,
+                           cases_total - LAG(cases_total) OVER w AS new_cases,
+                           deaths_total - LAG(deaths_total) OVER w AS new_deaths
+                    FROM rollup_state_period
+                    WHERE {' AND '.join(clauses)}
+                    WINDOW w AS (PARTITION BY state ORDER BY start_date)
+                ) {outer}
+                ORDER BY state, start_date
+            """, (*params, *bound_params)))
+
+    def get_latest_by_state(self, state: str) -> Optional[dict]:
+        with self._get_connection(readonly=True) as conn:
+            rows = self._dicts(conn.execute(f"""
+                SELECT {ROW_COLUMNS} FROM latest_by_state WHERE state = ?
+            """, (state,)))
+            return rows[0] if rows else None
+
+    def get_top_states_by_cases(self, limit: int = 10,
+                                as_of_date: date = None) -> List[dict]:
+        with self._get_connection(readonly=True) as conn:
+            if as_of_date:
+                cursor = conn.execute(f"""
+                    SELECT {ROW_COLUMNS} FROM covid_states
+                    WHERE date = CAST(? AS DATE)
+                    ORDER BY cases_total DESC
+                    LIMIT ?
+                """, (str(as_of_date), limit))
+            else:
+                cursor = conn.execute(f"""
+                    SELECT {ROW_COLUMNS} FROM latest_by_state
+                    ORDER BY cases_total DESC
+                    LIMIT ?
+                """, (limit,))
+            return self._dicts(cursor)
+
+    def get_top_states_by_deaths(self, limit: int = 10) -> List[dict]:
+        with self._get_connection(readonly=True) as conn:
+            return self._dicts(conn.execute(f"""
+                SELECT {ROW_COLUMNS} FROM latest_by_state
+                ORDER BY deaths_total DESC
+                LIMIT ?
+            """, (limit,)))
+
+    def get_time_series(self, state: str, days: int = 30) -> List[dict]:
+        with self._get_connection(readonly=True) as conn:
+            return self._dicts(conn.execute(f"""
+                SELECT {ROW_COLUMNS} FROM covid_states
+                WHERE state = ?
+                ORDER BY date DESC
+                LIMIT ?
+            """, (state.upper(), days)))
+
+    def iter_batches(self, table: str = "states", states: Iterable[str] = None,
+                     start=None, end=None, fields: Iterable[str] = None,
+                     size: int = BATCH_ROWS) -> Iterator[List[tuple]]:
+        """Fetched `size` rows at a time on a cursor of its own, so other
+        queries on this thread don't cut the stream short."""
+        table, fields = self._export_table(table, fields)
+        columns = ["state", "strftime(date, '%Y-%m-%d')", *fields]
+        states, start, end = self._range_filter(states, start, end)
+        clauses, params = [], []
+        if states is not None:
+            if not states:
+                return
+            clauses.append(f"state IN ({', '.join('?' * len(states))})")
+            params.extend(states)
+        if start is not None:
+            clauses.append("date >= CAST(? AS DATE)")
+            params.append(start)
+        if end is not None:
+            clauses.append("date <= CAST(? AS DATE)")
+            params.append(end)
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+        with self._get_connection(readonly=True) as conn:
+            cursor = conn.cursor()
+            try:
+                cursor.execute(f"""
+                    SELECT {", ".join(columns)} FROM {table}
+                    {where}
+                    ORDER BY state, date
+                """, params)
+                while True:
+                    rows = cursor.fetchmany(size)
+                    if not rows:
+                        return
+                    yield rows
+            finally:
+                cursor.close()
+
+    def get_history(self, states: Iterable[str] = None,
+                    iso_dates: bool = True) -> List[tuple]:
+        """(state, date, *METRIC_FIELDS) tuples ordered by state and date;
+        dates are epoch days unless iso_dates."""
+        day = "strftime(date, '%Y-%m-%d')" if iso_dates else "date - DATE '1970-01-01'"
+        query = f"""
+            SELECT state, {day}, {METRIC_LIST}
+            FROM covid_states
+        """
+        params: tuple = ()
+        if states is not None:
+            states = sorted(states)
+            if not states:
+                return []
+            query += f" WHERE state IN ({', '.join('?' * len(states))})"
+            params = tuple(states)
+        with self._get_connection(readonly=True) as conn:
+            return conn.execute(query + " ORDER BY state, date", params).fetchall()
+
+    def get_summary_stats(self) -> dict:
+        with self._get_connection(readonly=True) as conn:
+            rows = self._dicts(conn.execute("""
+                SELECT
+                    COUNT(state) as total_states,
+                    SUM(cases_total)::BIGINT as total_cases,
+                    SUM(deaths_total)::BIGINT as total_deaths,
+                    SUM(hospitalized_currently)::BIGINT as total_hospitalized,
+                    AVG(cases_total) as avg_cases_per_state,
+                    strftime(MAX(date), '%Y-%m-%d') as latest_date
+                FROM latest_by_state
+            """))
+            return rows[0]
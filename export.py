@@ -0,0 +1,97 @@
+import csv
+import gzip
+import io
+import json
+import sys
+from contextlib import contextmanager
+from typing import Iterable, List, Optional, Sequence, TextIO
+
+EXPORT_FORMATS = ("ndjson", "csv")
+COMPRESSIONS = ("gzip", "zstd")
+
+_encoder = json.JSONEncoder(separators=(",", ":"))
+
+
+def compression_for(path: Optional[str], compression: Optional[str] = None
+                    ) -> Optional[str]:
+    """The compression asked for, else the one the output suffix names
+    (.gz, .zst)."""
+    if compression is None and path not in (None, "-"):
+        if path.endswith(".gz"):
+            return "gzip"
+        if path.endswith(".zst"):
+            return "zstd"
+    return compression
+
+
+@contextmanager
+def open_output(path: Optional[str] = None, compression: Optional[str] = None):
+    """Text stream to path, or stdout for None or "-", compressed as it is
+    written; stdout stays open afterwards."""
+    if compression not in (None, *COMPRESSIONS):
+        raise ValueError(f"unknown compression {compression!r}")
+    to_stdout = path in (None, "-")
+    raw = sys.stdout.buffer if to_stdout else open(path, "wb")
+    stream = raw
+    try:
+        if compression == "gzip":
+            stream = gzip.GzipFile(fileobj=raw, mode="wb")
+        elif compression == "zstd":
+            try:
+                import zstandard
+            except ImportError as e:
+                raise ImportError(
+                    "zstd output needs the zstandard package (pip install zstandard)"
+                ) from e
+            stream = zstandard.ZstdCompressor().stream_writer(raw, closefd=False)
+        text = io.TextIOWrapper(stream, encoding="utf-8", newline="")
+        try:
+            yield text
+        finally:
+            text.flush()
+            text.detach()
+            # ends the gzip member or zstd frame without closing raw
+            if stream is not raw:
+                stream.close()
+    finally:
+        if to_stdout:
+            raw.flush()
+        else:
+            raw.close()
+
+
+def write_ndjson(out: TextIO, columns: Sequence[str],
+                 batches: Iterable[List[tuple]]) -> int:
+    """One JSON object per line; returns the rows written."""
+    rows = 0
+    for batch in batches:
+        out.write("".join(
+            _encoder.encode(dict(zip(columns, values))) + "\n" for values in batch
+        ))
+        rows += len(batch)
+    return rows
+
+
+def write_csv(out: TextIO, columns: Sequence[str],
+              batches: Iterable[List[tuple]]) -> int:
+    """A header line, then one line per row with missing values empty;
+    returns the rows written."""
+    writer = csv.writer(out, lineterminator="\n")
+    writer.writerow(columns)
+    rows = 0
+    for batch in batches:
+        writer.writerows(batch)
+        rows += len(batch)
+    return rows
+
+
+WRITERS = {"ndjson": write_ndjson, "csv": write_csv}
+
+
+def write_rows(out: TextIO, fmt: str, columns: Sequence[str],
+               batches: Iterable[List[tuple]]) -> int:
+    """Write batches of tuples as `fmt`, one batch at a time, so memory
+    stays at one batch whatever the result size."""
+    if fmt not in WRITERS:
+        raise ValueError(f"unknown format {fmt!r}; use one of {', '.join(WRITERS)}")
+    return WRITERS[fmt](out, columns, batches)
@@ -0,0 +1,41 @@
+# column names shared by the storage backends and the numpy code; kept free
+# of heavy imports so query commands can load them cheaply
+
+METRIC_FIELDS = (
+    "cases_total",
+    "cases_confirmed",
+    "deaths_total",
+    "deaths_confirmed",
+    "deaths_probable",
+    "hospitalized_currently",
+    "hospitalized_cumulative",
+    "in_icu_currently",
+    "tests_total",
+)
+
+# trailing window, in rows (one per day), of the rolling averages
+ROLLING_WINDOW = 7
+
+DERIVED_FIELDS = (
+    "new_cases",
+    "new_deaths",
+    f"new_cases_avg{ROLLING_WINDOW}",
+    f"new_deaths_avg{ROLLING_WINDOW}",
+    "reported_new_cases",
+    "reported_new_deaths",
+)
+
+# derived daily increase -> (cumulative metric, CSV column the source reports it in)
+INCREASE_SOURCES = {
+    "new_cases": ("cases_total", "positiveIncrease"),
+    "new_deaths": ("deaths_total", "deathIncrease"),
+}
+
+# per-state rollup buckets: ISO weeks (from Monday) and calendar months
+ROLLUP_PERIODS = ("week", "month")
+
+# row sets `export` streams: name -> (table, columns after state and date)
+EXPORT_TABLES = {
+    "states": ("covid_states", METRIC_FIELDS),
+    "derived": ("derived_metrics", DERIVED_FIELDS),
+}
@@ -0,0 +1,203 @@
+import json
+import os
+import resource
+import sys
+import time
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+from typing import Dict, Optional
+
+COUNTERS = ("rows_in", "rows_rejected", "rows_written", "bytes_read")
+
+
+def peak_rss_bytes() -> int:
+    """High-water RSS of this process or of any finished worker process."""
+    peak = max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    )
+    # bytes on macOS, kilobytes elsewhere
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def current_rss_bytes() -> int:
+    """RSS of this process now; where /proc isn't available, its
+    high-water mark so far."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+
+
+class run_metrics:
+    """Per-state and whole-run stage timers and row/byte counters.
+
+    Each timed stage also records the process RSS when it ended (the most
+    seen for that stage) and how much RSS grew while it ran, so memory can
+    be traced to a state and stage. Parallel states are measured in the
+    worker that ran them.
+    """
+
+    enabled = True
+
+    def __init__(self):
+        self.stages: Dict[str, Dict[str, float]] = defaultdict(lambda: defaultdict(float))
+        self.counters: Dict[str, Dict[str, int]] = defaultdict(lambda: defaultdict(int))
+        self.rss: Dict[str, Dict[str, int]] = defaultdict(lambda: defaultdict(int))
+        self.rss_growth: Dict[str, Dict[str, int]] = defaultdict(lambda: defaultdict(int))
+        self.started: Optional[float] = None
+        self.wall_seconds: Optional[float] = None
+
+    @contextmanager
+    def timer(self, stage: str, state: str = "all"):
+        started = time.perf_counter()
+        rss_before = current_rss_bytes()
+        try:
+            yield
+        finally:
+            self.stages[state][stage] += time.perf_counter() - started
+            rss = current_rss_bytes()
+            self.rss[state][stage] = max(self.rss[state][stage], rss)
+            self.rss_growth[state][stage] += max(0, rss - rss_before)
+
+    def count(self, name: str, value: int, state: str = "all"):
+        self.counters[state][name] += value
+
+    def start_run(self):
+        self.started = time.perf_counter()
+
+    def finish_run(self):
+        if self.started is not None:
+            self.wall_seconds = time.perf_counter() - self.started
+
+    def state_report(self, state: str) -> dict:
+        return {
+            "stages": dict(self.stages.get(state, {})),
+            "counters": dict(self.counters.get(state, {})),
+            "rss_bytes": dict(self.rss.get(state, {})),
+            "rss_growth_bytes": dict(self.rss_growth.get(state, {})),
+        }
+
+    def merge_state(self, state: str, report: dict):
+        """Fold in a state_report taken in another process."""
+        for stage, seconds in report["stages"].items():
+            self.stages[state][stage] += seconds
+        for name, value in report["counters"].items():
+            self.counters[state][name] += value
+        for stage, rss in report["rss_bytes"].items():
+            self.rss[state][stage] = max(self.rss[state][stage], rss)
+        for stage, growth in report["rss_growth_bytes"].items():
+            self.rss_growth[state][stage] += growth
+
+    def report(self) -> dict:
+        totals_stages: Dict[str, float] = defaultdict(float)
+        totals_counters: Dict[str, int] = {name: 0 for name in COUNTERS}
+        totals_rss: Dict[str, int] = defaultdict(int)
+        states = sorted(set(self.stages) | set(self.counters))
+        for state in states:
+            for stage, seconds in self.stages.get(state, {}).items():
+                totals_stages[stage] += seconds
+            for stage, rss in self.rss.get(state, {}).items():
+                totals_rss[stage] = max(totals_rss[stage], rss)
+            for name, value in self.counters.get(state, {}).items():
+                totals_counters[name] = totals_counters.get(name, 0) + value
+        return {
+            "run": {
+                "wall_seconds": self.wall_seconds,
+                "peak_rss_bytes": peak_rss_bytes(),
+                "stages": dict(totals_stages),
+                "counters": totals_counters,
+                "rss_bytes": dict(totals_rss),
+            },
+            "states": {
+                state: self.state_report(state) for state in states if state != "all"
+            },
+        }
+
+    def write_json(self, path: str):
+        _write_atomic(path, json.dumps(self.report(), indent=2))
+
+    def write_prometheus(self, path: str):
+        """Write a node_exporter textfile-collector file."""
+        report = self.report()
+        lines = [
+            "# HELP etl_stage_seconds Time spent in each pipeline stage.",
+            "# TYPE etl_stage_seconds gauge",
+        ]
+        for state, data in report["states"].items():
+            for stage, seconds in data["stages"].items():
+                lines.append(
+                    f'etl_stage_seconds{{stage="{stage}",state="{state}"}} {seconds:.6f}'
+                )
+        for stage, seconds in report["run"]["stages"].items():
+            lines.append(f'etl_stage_seconds{{stage="{stage}",state="all"}} {seconds:.6f}')
+        lines += [
+            "# HELP etl_rows Rows and bytes handled by the last run.",
+            "# TYPE etl_rows gauge",
+        ]
+        for state, data in report["states"].items():
+            for name, value in data["counters"].items():
+                lines.append(f'etl_rows{{counter="{name}",state="{state}"}} {value}')
+        for name, value in report["run"]["counters"].items():
+            lines.append(f'etl_rows{{counter="{name}",state="all"}} {value}')
+        lines += [
+            "# HELP etl_stage_rss_bytes Resident set size at the end of each stage.",
+            "# TYPE etl_stage_rss_bytes gauge",
+        ]
+        for state, data in report["states"].items():
+            for stage, rss in data["rss_bytes"].items():
+                lines.append(f'etl_stage_rss_bytes{{stage="{stage}",state="{state}"}} {rss}')
+        for stage, rss in report["run"]["rss_bytes"].items():
+            lines.append(f'etl_stage_rss_bytes{{stage="{stage}",state="all"}} {rss}')
+        lines += [
+            "# HELP etl_stage_rss_growth_bytes Resident set size growth during each stage.",
+            "# TYPE etl_stage_rss_growth_bytes gauge",
+        ]
+        for state, data in report["states"].items():
+            for stage, growth in data["rss_growth_bytes"].items():
+                lines.append(
+                    f'etl_stage_rss_growth_bytes{{stage="{stage}",state="{state}"}} {growth}'
+                )
+        lines += [
+            "# HELP etl_peak_rss_bytes Peak resident set size of the run.",
+            "# TYPE etl_peak_rss_bytes gauge",
+            f"etl_peak_rss_bytes {report['run']['peak_rss_bytes']}",
+        ]
+        if report["run"]["wall_seconds"] is not None:
+            lines += [
+                "# HELP etl_run_seconds Wall time of the last run.",
+                "# TYPE etl_run_seconds gauge",
+                f"etl_run_seconds {report['run']['wall_seconds']:.6f}",
+            ]
+        _write_atomic(path, "\n".join(lines) + "\n")
+
+
+class _disabled_metrics:
+    """Stand-in used when metrics are off; every hook is a no-op."""
+
+    enabled = False
+    _timer = nullcontext()
+
+    def timer(self, stage: str, state: str = "all"):
+        return self._timer
+
+    def count(self, name: str, value: int, state: str = "all"):
+        pass
+
+    def start_run(self):
+        pass
+
+    def finish_run(self):
+        pass
+
+
+NULL_METRICS = _disabled_metrics()
+
+
+def _write_atomic(path: str, text: str):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        f.write(text)
+    os.replace(tmp_path, path)
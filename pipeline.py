@@ -1,7 +1,17 @@
+import hashlib
 import logging 
-from dataextractor import data_extraction
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from dataclasses import replace
+from typing import Optional
+from dataextractor import data_extraction, input_fingerprint, is_indexable
 from transform import data_cleaner
-from store import sqlstorage
+from derive import metric_deriver, derived_rows
+from fields import INCREASE_SOURCES
+from quarantine import columns_from_raw, quarantine_rows, reject_log
+from schema import record_batch
+from queries import query_service
+from metrics import run_metrics, NULL_METRICS
 from configuration import Config
 
 logging.basicConfig(
@@ -10,55 +20,238 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# per-process state for parallel runs, set up by _init_worker
+_worker_extractor = None
+_worker_transformer = None
+_worker_deriver = None
 
-class etl_pipeline:    
-    def __init__(self, config: Config = None):
-        self.config = config or Config()
-        self.extractor = data_extraction(self.config)
+
+def _source_digest(raw_data) -> str:
+    return hashlib.blake2b(repr(raw_data).encode(), digest_size=16).hexdigest()
+
+
+def _extract_and_clean(extractor, transformer, state: str,
+                       incremental: bool = False, known_digest: str = None,
+                       metrics=NULL_METRICS, deriver: metric_deriver = None,
+                       raw_data=None):
+    """Returns (digest, raw row count, batch, derived metrics, rejects).
+    The digest is only computed for incremental runs; batch, derived and
+    rejects are None when it matches known_digest, and derived is None
+    without a deriver. rejects are the quarantine tuples of rejected rows.
+    raw_data, if given, are the state's already extracted columns."""
+    if raw_data is None:
+        bytes_before = extractor.bytes_read
+        with metrics.timer("extract", state):
+            raw_data = extractor.fetch_state_columns(state)
+        metrics.count("bytes_read", extractor.bytes_read - bytes_before, state)
+    raw_count = len(raw_data["date"])
+    metrics.count("rows_in", raw_count, state)
+    digest = _source_digest(raw_data) if incremental else None
+    if known_digest is not None and known_digest == digest:
+        return digest, raw_count, None, None, None
+    with metrics.timer("transform", state):
+        cleaned_data, rejected = transformer.clean_batch(raw_data, state)
+        rejects = []
+        # clean input stops at this check
+        if rejected.any():
+            reasons = transformer.reject_reasons(raw_data, rejected, state)
+            rejects = quarantine_rows(raw_data, rejected, reasons, state)
+    metrics.count("rows_rejected", len(rejects), state)
+    derived = None
+    if deriver is not None:
+        with metrics.timer("derive", state):
+            derived = deriver.derive(cleaned_data, raw_data, rejected)
+    return digest, raw_count, cleaned_data, derived, rejects
+
+
+def _init_worker(config: Optional[Config]):
+    """Without a config, tasks are handed their states' columns."""
+    global _worker_extractor, _worker_transformer, _worker_deriver
+    _worker_extractor = data_extraction(config) if config is not None else None
+    _worker_transformer = data_cleaner()
+    _worker_deriver = metric_deriver(_worker_transformer)
+
+
+def _worker_task(state: str, incremental: bool, known_digest: str = None,
+                 collect_metrics: bool = False, raw_data=None):
+    """Returns the _extract_and_clean result and this state's metrics."""
+    metrics = run_metrics() if collect_metrics else NULL_METRICS
+    result = _extract_and_clean(
+        _worker_extractor, _worker_transformer, state, incremental,
+        known_digest, metrics, _worker_deriver, raw_data,
+    )
+    return result, metrics.state_report(state) if collect_metrics else None
+
+
+class etl_pipeline(query_service):
+    """The load path; queries are inherited from query_service."""
+
+    def __init__(self, config: Config = None, metrics: run_metrics = None):
+        config = config or Config()
+        self.metrics = metrics or NULL_METRICS
+        self.metrics.start_run()
+        self._extractor = None
         self.transformer = data_cleaner()
-        self.storage = sqlstorage(self.config)
+        self.deriver = metric_deriver(self.transformer)
+        super().__init__(config, read_only=False)
+        self.rejects = reject_log(self.config.reject_log_samples)
+        self.load_stats = {}
+        # the load_runs row of the current all-states run, and the states
+        # it failed to load
+        self.run_id = None
+        self.failed_states = []
+
+    @property
+    def extractor(self) -> data_extraction:
+        """Built on first use, so replays and queries never read the source."""
+        if self._extractor is None:
+            self._build_extractor(self.config)
+        return self._extractor
+
+    def _build_extractor(self, config: Config):
+        with self.metrics.timer("extract"):
+            self._extractor = data_extraction(config)
+        self.metrics.count("bytes_read", self._extractor.bytes_read)
+
+    def _prefetch(self, states):
+        """Fetch API states concurrently; a state that fails to fetch fails
+        on its own when it is loaded."""
+        if not self.config.api:
+            return
+        bytes_before = self.extractor.bytes_read
+        with self.metrics.timer("extract"):
+            self.extractor.prefetch(states)
+        self.metrics.count("bytes_read", self.extractor.bytes_read - bytes_before)
+
+    def _indexable(self) -> bool:
+        """Local input that workers can seek into through the CSV index."""
+        return not self.config.api and is_indexable(self.config.csv_path)
+
+    def _known_digest(self, state: str, incremental: bool):
+        if not incremental:
+            return None
+        watermark = self.storage.get_watermark(state)
+        return watermark["source_digest"] if watermark else None
+
+    def _store(self, state: str, digest: str, raw_count: int, cleaned_data,
+               incremental: bool, derived=None, rejects=None) -> int:
+        """Load a state's cleaned rows; returns how many were written."""
+        state = state.upper()
+        if rejects:
+            self.rejects.add(state, rejects)
+            if self.config.quarantine:
+                self.storage.quarantine(rejects)
+        if cleaned_data is None:
+            logger.info("%s unchanged since last load, skipping", state)
+            self.load_stats[state] = {
+                "inserted": 0, "updated": 0, "skipped": raw_count,
+            }
+            return 0
+        if not len(cleaned_data):
+            logger.warning("no valid records found for %s", state)
+            return 0
+        logger.info("loading cleaned data into storage")
+        with self.metrics.timer("load", state):
+            if incremental:
+                stats = self.storage.insert_records_incremental(
+                    cleaned_data, state, source_digest=digest
+                )
+                self.load_stats[state] = stats
+                written = stats["inserted"] + stats["updated"]
+            else:
+                self.storage.insert_records(cleaned_data)
+                written = len(cleaned_data)
+            if derived is not None:
+                self._store_derived(
+                    state, derived, incremental and not stats["updated"],
+                    stats["first_changed"] if incremental else None,
+                )
+        self.metrics.count("rows_written", written, state)
+        logger.info(f"completed for {state}")
+        return written
     
-    def run_for_state(self, state: str):
+    def run_for_state(self, state: str, incremental: bool = False) -> int:
+        """Load one state; returns the rows written."""
+        generation = self.storage.get_generation()
+        written = self._load_state(state, incremental)
+        self._refresh_columns([state.upper()], generation)
+        self.rejects.report()
+        return written
+
+    def _load_state(self, state: str, incremental: bool = False) -> int:
         try:
             logger.info(f"starting ETL pipeline for {state}")
-            logger.info(f"extracting data for {state}")
-            raw_data = self.extractor.fetch_state_daily(state.upper())
-            logger.info("cleaning data")
-            cleaned_data = self.transformer.clean_and_validate(
-                raw_data, state
+            logger.info(f"extracting and cleaning data for {state}")
+            digest, raw_count, cleaned_data, derived, rejects = _extract_and_clean(
+                self.extractor, self.transformer, state.upper(),
+                incremental, self._known_digest(state, incremental), self.metrics,
+                self.deriver,
+            )
+            return self._store(
+                state, digest, raw_count, cleaned_data, incremental, derived,
+                rejects,
             )
-            if not cleaned_data:
-                logger.warning("no valid records found for %s", state)
-                return []
-            logger.info("cleaning data")
-            logger.info("loading cleaned data into storage")
-            self.storage.insert_records(cleaned_data)
-            logger.info(f"completed for {state}")
-            return cleaned_data            
         except Exception as e:
             logger.error(f"pipeline failed for {state}: {e}")
             raise
     
-    def run_for_all_states(self,limit: int = None):
+    def run_for_all_states(self,limit: int = None, incremental: bool = False,
+                           workers: int = 1, bulk: bool = False,
+                           resume: bool = False):
+        """Load every state, checkpointing each one in load_runs as it
+        commits. With resume, states the latest run on the same input
+        already committed are skipped."""
+        if bulk and incremental:
+            raise ValueError("bulk loads rewrite every row; use bulk or incremental")
+        self.run_id = None
+        self.failed_states = []
+        status = "failed"
         try:
             logger.info("starting pipeline for all states")
-            states_info = self.extractor.get_state_info()
-            
+            # the engine reads the CSV itself, so the extractor isn't built
+            ingest = bulk and self.storage.supports_csv_ingest and not self.config.api
+            if ingest:
+                states = self.storage.csv_states(self.config.csv_path)
+                fingerprint = input_fingerprint(self.config.csv_path)
+            else:
+                if workers > 1 and self._extractor is None and self._indexable():
+                    # workers parse their own states, so this process only
+                    # needs the index for the state list, not a full parse
+                    self._build_extractor(replace(self.config, csv_index=True))
+                states = [
+                    s.get("state") for s in self.extractor.get_state_info()
+                    if s.get("state")
+                ]
             if limit:
-                states_info = states_info[:limit]
-            total_records = 0
-            for state in states_info:
-                state = state.get("state")
-                if not state:
-                    continue
-                
-                try:
-                    records = self.run_for_state(state)
-                    total_records += len(records)
-                except Exception as e:
-                    logger.error(f"failed to process {state}: {e}")
-                    continue
-            
+                states = states[:limit]
+            if not ingest:
+                self._prefetch(states)
+                fingerprint = self.extractor.input_fingerprint()
+            mode = "bulk" if bulk else "incremental" if incremental else "full"
+            self.run_id = self.storage.begin_load_run(fingerprint, mode, resume)
+            if resume:
+                done = self.storage.get_completed_states(self.run_id)
+                remaining = [state for state in states if state.upper() not in done]
+                logger.info(
+                    "resuming run %d: %d of %d states already loaded",
+                    self.run_id, len(states) - len(remaining), len(states),
+                )
+                states = remaining
+            generation = self.storage.get_generation()
+            if not states:
+                total_records = 0
+            elif ingest:
+                total_records = self._run_ingest(states)
+            elif workers > 1:
+                total_records = self._run_parallel(states, incremental, workers, bulk)
+            elif bulk:
+                total_records = self._run_bulk(states)
+            else:
+                total_records = self._run_sequential(states, incremental)
+            self._refresh_columns([state.upper() for state in states], generation)
+            self.rejects.report()
+            status = "partial" if self.failed_states else "complete"
+
             logger.info(f"pipeline completed. Loaded {total_records} total records")
             return total_records
             
@@ -66,20 +259,226 @@ class etl_pipeline:
             logger.error(f"pipeline failed: {e}")
             raise
         finally:
-            self.extractor.close()
-    
-    def query_top_cases(self, limit: int = 10):
-        return self.storage.get_top_states_by_cases(limit)
-    
-    def query_top_deaths(self, limit: int = 10):
-        return self.storage.get_top_states_by_deaths(limit)
-    
-    def query_state(self, state: str):
-        return self.storage.get_latest_by_state(state)
-    
-    def query_time_series(self, state: str, days: int = 30):
-        return self.storage.get_time_series(state.upper(), days)
+            if self.run_id is not None:
+                self.storage.finish_load_run(self.run_id, status)
+            if self._extractor is not None:
+                self._extractor.close()
+            self.metrics.finish_run()
+
+    def _checkpoint(self, state: str, records):
+        """Mark a state done in the current run; called inside the state's
+        savepoint, so the mark commits with its rows."""
+        if self.run_id is not None:
+            self.storage.complete_state(self.run_id, state, records)
+
+    def _failed(self, state: str, error: Exception):
+        logger.error(f"failed to process {state}: {error}")
+        self.failed_states.append(state.upper())
+
+    def _store_derived(self, state: str, derived, append_only: bool,
+                       first_changed: str = None):
+        """Write derived metrics. When only new dates after what is already
+        stored were loaded, just those dates are written; otherwise (e.g.
+        a backfilled older date, first_changed, shifts every later rolling
+        average) the state's derived rows are replaced."""
+        since_day = None
+        if append_only:
+            latest = self.storage.get_derived_watermark(state)
+            if latest is not None and (first_changed is None or first_changed > latest):
+                since_day = int(np.datetime64(latest, "D").astype(np.int64))
+        rows = derived_rows(state, derived, since_day)
+        if rows or since_day is None:
+            self.storage.insert_derived(state, rows, replace=since_day is None)
+
+    def _run_ingest(self, states) -> int:
+        """Bulk load by having the storage engine read the CSV itself."""
+        with self.metrics.timer("load"):
+            total_records = self.storage.ingest_csv(self.config.csv_path, states)
+        self.metrics.count("rows_written", total_records)
+        # one statement loads every state, so there are no per-state counts
+        for state in states:
+            self._checkpoint(state, None)
+        return total_records
+
+    def _run_sequential(self, states, incremental: bool) -> int:
+        """One state at a time, each committed with its checkpoint."""
+        total_records = 0
+        with self.storage.session() as conn:
+            for state in states:
+                try:
+                    with self.storage.savepoint(conn):
+                        written = self._load_state(state, incremental=incremental)
+                        self._checkpoint(state, written)
+                except Exception as e:
+                    self._failed(state, e)
+                    continue
+                self.storage.commit_session(conn)
+                total_records += written
+        return total_records
+
+    def _run_bulk(self, states) -> int:
+        """Checkpoints commit with the rest of the bulk transaction."""
+        total_records = 0
+        with self.storage.bulk_load() as conn:
+            for state in states:
+                try:
+                    with self.storage.savepoint(conn):
+                        written = self._load_state(state)
+                        self._checkpoint(state, written)
+                    total_records += written
+                except Exception as e:
+                    self._failed(state, e)
+                    continue
+        return total_records
+
+    def _run_parallel(self, states, incremental: bool, workers: int,
+                      bulk: bool = False) -> int:
+        """Extract and clean states in a process pool; this process is the
+        only writer and commits every config.commit_rows rows (or once, at
+        the end of a bulk load)."""
+        # workers seek to their states through the CSV index; build it once
+        # here so they don't race to write the sidecar. Compressed and
+        # multi-file input can't be indexed, and API data is fetched once,
+        # so then this process hands each worker its state's columns.
+        worker_config = None
+        if self._indexable():
+            worker_config = replace(self.config, csv_index=True)
+            data_extraction(worker_config).close()
+
+        total_records = 0
+        uncommitted = 0
+        queued = iter(states)
+        pending = {}
+        session = self.storage.bulk_load() if bulk else self.storage.session()
+        with ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=_init_worker,
+            initargs=(worker_config,),
+        ) as pool, session as conn:
+
+            def submit_next():
+                for state in queued:
+                    known = self._known_digest(state, incremental)
+                    raw_data = None
+                    if worker_config is None:
+                        try:
+                            raw_data = self.extractor.fetch_state_columns(state)
+                        except Exception as e:
+                            self._failed(state, e)
+                            continue
+                    future = pool.submit(
+                        _worker_task, state, incremental, known,
+                        self.metrics.enabled, raw_data,
+                    )
+                    pending[future] = state
+                    return
+
+            # at most two results per worker wait for the writer
+            for _ in range(workers * 2):
+                submit_next()
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    state = pending.pop(future)
+                    submit_next()
+                    try:
+                        result, report = future.result()
+                        digest, raw_count, cleaned_data, derived, rejects = result
+                        if report is not None:
+                            self.metrics.merge_state(state.upper(), report)
+                        with self.storage.savepoint(conn):
+                            written = self._store(
+                                state, digest, raw_count, cleaned_data,
+                                incremental, derived, rejects,
+                            )
+                            self._checkpoint(state, written)
+                    except Exception as e:
+                        self._failed(state, e)
+                        continue
+                    total_records += written
+                    uncommitted += written
+                    if not bulk and uncommitted >= self.config.commit_rows:
+                        self.storage.commit_session(conn)
+                        uncommitted = 0
+        return total_records
     
-    def get_summary(self):
-        return self.storage.get_summary_stats()
+    def _refresh_columns(self, states, since_generation: int):
+        """Update the column store after a load; queries fall back to SQLite
+        while it is stale, so a failure here doesn't fail the load."""
+        if self.columns is None:
+            return
+        try:
+            with self.metrics.timer("columns"):
+                self.columns.refresh(self.storage, states, since_generation)
+        except Exception as e:
+            logger.warning(f"column store refresh failed: {e}")
+
+    def replay_rejected(self, state: str = None, reason: str = None) -> dict:
+        """Re-clean quarantined rows, e.g. after the cleaner or the rows in
+        rejected_records were fixed. Rows that pass now are loaded and leave
+        the quarantine; the rest are quarantined again with their current
+        reason."""
+        by_state = {}
+        for row in self.storage.get_rejected(state, reason):
+            by_state.setdefault(row["state"], []).append(row)
+        generation = self.storage.get_generation()
+        totals = {"replayed": 0, "rejected": 0}
+        changed = []
+        with self.storage.session() as conn:
+            for code, rows in by_state.items():
+                columns = columns_from_raw([row["raw"] for row in rows])
+                batch, rejected = self.transformer.clean_batch(columns, code)
+                with self.storage.savepoint(conn):
+                    self.storage.delete_rejected(row["id"] for row in rows)
+                    if rejected.any():
+                        reasons = self.transformer.reject_reasons(columns, rejected, code)
+                        rejects = quarantine_rows(columns, rejected, reasons, code)
+                        self.storage.quarantine(rejects)
+                        self.rejects.add(code, rejects)
+                    if len(batch):
+                        self.storage.insert_records(batch)
+                        self._rederive(code, batch, columns, rejected)
+                        changed.append(code)
+                totals["replayed"] += len(batch)
+                totals["rejected"] += int(rejected.sum())
+        self._refresh_columns(changed, generation)
+        self.rejects.report()
+        logger.info(
+            "replayed %d quarantined rows, %d still rejected",
+            totals["replayed"], totals["rejected"],
+        )
+        return totals
+
+    def _rederive(self, state: str, batch, columns, rejected):
+        """Recompute a state's derived metrics from its stored history after
+        rows were added outside a load. Reported increases only exist in
+        source rows: the new rows' come from their raw columns, the others
+        are kept from derived_metrics."""
+        history = record_batch.from_rows(
+            self.storage.get_history([state], iso_dates=False)
+        )
+        derived = self.deriver.derive(history)
+        added = self.deriver.derive(batch, columns, rejected)
+        reported = [f"reported_{name}" for name in INCREASE_SOURCES]
+        stored = self.storage.get_derived_series(state, len(history), reported)
+        stored_days = np.array(
+            [row["date"] for row in stored], dtype="datetime64[D]"
+        ).astype(np.int64).tolist()
+        for field in reported:
+            known = {
+                day: np.nan if row[field] is None else row[field]
+                for day, row in zip(stored_days, stored)
+            }
+            known.update(zip(added["days"].tolist(), added[field].tolist()))
+            derived[field] = np.array(
+                [known.get(day, np.nan) for day in derived["days"].tolist()],
+                dtype=np.float64,
+            )
+        self.storage.insert_derived(state, derived_rows(state, derived), replace=True)
 
+    def load_totals(self) -> dict:
+        totals = {"inserted": 0, "updated": 0, "skipped": 0}
+        for stats in self.load_stats.values():
+            for key in totals:
+                totals[key] += stats.get(key, 0)
+        return totals
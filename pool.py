@@ -0,0 +1,102 @@
+import logging
+import queue
+import sqlite3
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+
+from configuration import Config
+
+logger = logging.getLogger(__name__)
+
+
+class connection_pool:
+    """Long-lived SQLite connections for one database file.
+
+    A single writer connection is shared behind a lock, and up to
+    config.pool_size read-only connections are handed out to concurrent
+    readers. The database runs in WAL mode so readers never wait for the
+    writer. Connections keep their page and statement caches between calls.
+    A read_only pool never opens the file for writing, so writes through
+    writer() fail instead of creating or changing the database.
+    """
+
+    def __init__(self, config: Config, read_only: bool = False):
+        self.db = config.db
+        self.config = config
+        self.read_only = read_only
+        self._readers: "queue.LifoQueue[sqlite3.Connection]" = queue.LifoQueue()
+        self._reader_slots = threading.BoundedSemaphore(config.pool_size)
+        self._writer = None
+        self._writer_lock = threading.RLock()
+        self._all = []
+        self._all_lock = threading.Lock()
+
+    def connect(self, readonly: bool = False) -> sqlite3.Connection:
+        """Open a configured connection that is not tracked by the pool."""
+        if readonly:
+            uri = f"{Path(self.db).resolve().as_uri()}?mode=ro"
+            conn = sqlite3.connect(
+                uri, uri=True, timeout=self.config.timeout,
+                check_same_thread=False,
+                cached_statements=self.config.statement_cache,
+            )
+        else:
+            conn = sqlite3.connect(
+                self.db, timeout=self.config.timeout,
+                check_same_thread=False,
+                cached_statements=self.config.statement_cache,
+            )
+            conn.execute("PRAGMA journal_mode = WAL")
+        conn.row_factory = sqlite3.Row
+        conn.execute(f"PRAGMA cache_size = -{int(self.config.cache_size_kb)}")
+        conn.execute(f"PRAGMA mmap_size = {int(self.config.mmap_size)}")
+        return conn
+
+    def _track(self, conn: sqlite3.Connection) -> sqlite3.Connection:
+        with self._all_lock:
+            self._all.append(conn)
+        return conn
+
+    @contextmanager
+    def writer(self):
+        with self._writer_lock:
+            if self._writer is None:
+                self._writer = self._track(self.connect(readonly=self.read_only))
+            try:
+                yield self._writer
+            except BaseException:
+                self._writer.rollback()
+                raise
+
+    @contextmanager
+    def reader(self):
+        # the writer connection must exist first: it switches the file to WAL
+        # and read-only connections cannot create the database
+        if self._writer is None and not self.read_only:
+            with self.writer():
+                pass
+        self._reader_slots.acquire()
+        try:
+            try:
+                conn = self._readers.get_nowait()
+            except queue.Empty:
+                conn = self._track(self.connect(readonly=True))
+            try:
+                yield conn
+            finally:
+                if conn.in_transaction:
+                    conn.rollback()
+                self._readers.put(conn)
+        finally:
+            self._reader_slots.release()
+
+    def close(self):
+        with self._all_lock:
+            # readers first: only a read-write connection closing last
+            # checkpoints and removes the -wal/-shm files
+            for conn in reversed(self._all):
+                conn.close()
+            self._all.clear()
+        self._writer = None
+        self._readers = queue.LifoQueue()
@@ -0,0 +1,82 @@
+import json
+import logging
+from collections import Counter
+from typing import Dict, List, Optional, Sequence
+
+logger = logging.getLogger(__name__)
+
+# (state, raw date, reason, raw row as JSON), as written to rejected_records
+Reject = tuple
+
+_encoder = json.JSONEncoder(separators=(",", ":"))
+
+
+def quarantine_rows(columns: Dict[str, Sequence[Optional[str]]], rejected,
+                    reasons: List[str], state: Optional[str] = None
+                    ) -> List[Reject]:
+    """Quarantine tuples for the rejected rows of a batch of raw columns;
+    reasons come from data_cleaner.reject_reasons."""
+    names = list(columns)
+    rows = []
+    for i, reason in zip(rejected.nonzero()[0].tolist(), reasons):
+        raw = {name: columns[name][i] for name in names}
+        rows.append((
+            (state or raw.get("state") or "").upper(),
+            raw.get("date"),
+            reason,
+            _encoder.encode(raw),
+        ))
+    return rows
+
+
+def columns_from_raw(raws: Sequence[str]) -> Dict[str, List[Optional[str]]]:
+    """Raw columns back from quarantined rows' JSON, for re-cleaning."""
+    records = [json.loads(raw) for raw in raws]
+    names = list(dict.fromkeys(name for record in records for name in record))
+    return {name: [record.get(name) for record in records] for name in names}
+
+
+class reject_log:
+    """Per-run tally of rejected rows.
+
+    Logs at most max_samples individual rows per run, then one line per
+    state with its counts by reason when the run is reported.
+    """
+
+    def __init__(self, max_samples: int = 10):
+        self.max_samples = max_samples
+        self.counts: Counter = Counter()
+        self.sampled = 0
+
+    def count(self, state: str, reason: str, rows: int = 1):
+        self.counts[(state, reason)] += rows
+
+    def add(self, state: str, rows: List[Reject]):
+        for row in rows:
+            self.count(state, row[2])
+            if self.sampled < self.max_samples:
+                self.sampled += 1
+                logger.warning("rejected %s row for %s: %s", row[2], state, row[3])
+
+    def total(self) -> int:
+        return sum(self.counts.values())
+
+    def by_state(self) -> Dict[str, Dict[str, int]]:
+        states: Dict[str, Dict[str, int]] = {}
+        for (state, reason), count in sorted(self.counts.items()):
+            states.setdefault(state, {})[reason] = count
+        return states
+
+    def report(self):
+        """Log the run's counts and start a new run."""
+        if self.counts:
+            logger.warning(
+                "rejected %d rows (%d logged individually)", self.total(), self.sampled
+            )
+            for state, reasons in self.by_state().items():
+                logger.warning(
+                    "rejected %s: %s", state,
+                    ", ".join(f"{reason}={count}" for reason, count in reasons.items()),
+                )
+        self.counts.clear()
+        self.sampled = 0
@@ -0,0 +1,202 @@
+import logging
+from itertools import groupby
+from operator import itemgetter
+
+from backend import BATCH_ROWS, open_storage
+from cache import query_cache, MISSING
+from configuration import Config
+from fields import ROLLING_WINDOW, INCREASE_SOURCES
+
+logger = logging.getLogger(__name__)
+
+
+def _range_key(states, start, end) -> tuple:
+    """Cache key parts for a states/date-range query."""
+    return (
+        None if states is None else tuple(sorted({s.upper() for s in states})),
+        None if start is None else str(start),
+        None if end is None else str(end),
+    )
+
+
+class query_service:
+    """The read path: cached queries over an existing database.
+
+    Opens storage read-only by default, so it neither parses the source
+    data nor runs schema DDL, and leaves numpy unimported until a
+    time-series query needs the column store.
+    """
+
+    def __init__(self, config: Config = None, read_only: bool = True):
+        self.config = config or Config()
+        self.storage = open_storage(self.config, read_only=read_only)
+        self.instance_id = self.storage.get_instance_id()
+        self.cache = query_cache(
+            max_entries=self.config.cache_entries,
+            max_bytes=self.config.cache_bytes,
+            path=self.config.cache_path,
+            namespace=self.instance_id,
+        )
+        self._columns = None
+
+    @property
+    def columns(self):
+        """The column store, or None when config.columnar is off."""
+        if self._columns is None and self.config.columnar:
+            from columnar import column_store
+            self._columns = column_store(
+                self.config.columns_path or self.storage.db + ".columns"
+            )
+        return self._columns
+
+    def _column_view(self, generation: int = None):
+        """The column store if it matches the database, else None."""
+        if self.columns is None:
+            return None
+        view = self.columns.open()
+        if view is None or view.instance != self.instance_id:
+            return None
+        if generation is None:
+            generation = self.storage.get_generation()
+        return view if view.generation == generation else None
+
+    def _cached(self, name: str, query, *args):
+        generation = self.storage.get_generation()
+        key = (name, args)
+        result = self.cache.get(key, generation)
+        if result is MISSING:
+            result = query(*args)
+            self.cache.put(key, result, generation)
+        return result
+
+    def cache_stats(self) -> dict:
+        return self.cache.stats()
+
+    def query_top_cases(self, limit: int = 10):
+        return self._cached("top_cases", self.storage.get_top_states_by_cases, limit)
+
+    def query_top_deaths(self, limit: int = 10):
+        return self._cached("top_deaths", self.storage.get_top_states_by_deaths, limit)
+
+    def query_state(self, state: str):
+        return self._cached("state", self.storage.get_latest_by_state, state)
+
+    def query_time_series(self, state: str, days: int = 30):
+        return self._cached("time_series", self._time_series, state.upper(), days)
+
+    def _time_series(self, state: str, days: int):
+        view = self._column_view()
+        if view is not None:
+            return view.records(state, days)
+        return self.storage.get_time_series(state, days)
+
+    def iter_time_range(self, states=None, start=None, end=None, fields=None):
+        """(state, rows) pairs for several states between start and end
+        (inclusive dates; None leaves a side open), rows oldest first with
+        state, date and `fields` (default: every metric). Streamed from a
+        single query, one state at a time."""
+        rows = self.storage.iter_time_range(states, start, end, fields)
+        for state, group in groupby(rows, key=itemgetter("state")):
+            yield state, list(group)
+
+    def query_time_range(self, states=None, start=None, end=None, fields=None):
+        """iter_time_range collected into {state: rows}, cached."""
+        return self._cached(
+            "time_range", self._time_range, *_range_key(states, start, end),
+            None if fields is None else tuple(fields),
+        )
+
+    def _time_range(self, states, start, end, fields):
+        return dict(self.iter_time_range(states, start, end, fields))
+
+    def export_columns(self, table: str = "states", fields=None):
+        return self.storage.export_columns(table, fields)
+
+    def iter_batches(self, table: str = "states", states=None, start=None,
+                     end=None, fields=None, size: int = BATCH_ROWS):
+        """Uncached: batches of row tuples streamed from the cursor, for
+        exports too large to hold."""
+        return self.storage.iter_batches(table, states, start, end, fields, size)
+
+    def query_derived(self, state: str, metric: str, rolling: int = 1,
+                      days: int = 30):
+        """Newest-first daily increases (or their rolling average) for a
+        state, read from derived_metrics."""
+        if metric not in INCREASE_SOURCES:
+            raise ValueError(f"unknown derived metric {metric!r}")
+        if rolling not in (1, ROLLING_WINDOW):
+            raise ValueError(f"rolling must be 1 or {ROLLING_WINDOW}")
+        field = metric if rolling == 1 else f"{metric}_avg{rolling}"
+        return self._cached(
+            "derived", self.storage.get_derived_series, state.upper(), days, (field,)
+        )
+
+    def series(self, state: str, field: str, days: int = 30):
+        """(dates, values) arrays spanning the state's last `days` rows,
+        oldest first; views into the column store when it is current."""
+        import numpy as np
+
+        state = state.upper()
+        view = self._column_view()
+        if view is not None:
+            return view.series(state, field, days)
+        records = self.storage.get_time_series(state, days)[::-1]
+        dates = np.array([r["date"] for r in records], dtype="datetime64[D]")
+        values = np.array(
+            [np.nan if r[field] is None else r[field] for r in records],
+            dtype=np.float64,
+        )
+        return dates, values
+
+    def series_by_state(self, states, field: str, start=None, end=None) -> dict:
+        """{state: (dates, values)} arrays for several states between start
+        and end, oldest first, read with one iter_time_range query."""
+        import numpy as np
+
+        series = {}
+        for state, rows in self.iter_time_range(states, start, end, [field]):
+            dates = np.array([r["date"] for r in rows], dtype="datetime64[D]")
+            values = np.array(
+                [np.nan if r[field] is None else r[field] for r in rows],
+                dtype=np.float64,
+            )
+            series[state] = (dates, values)
+        return series
+
+    def query_national(self, start=None, end=None):
+        """US totals per day from rollup_national_daily, oldest first."""
+        _, start, end = _range_key(None, start, end)
+        return self._cached("national", self.storage.get_national_daily, start, end)
+
+    def query_rollups(self, period: str, states=None, start=None, end=None):
+        """Per-state week or month buckets from rollup_state_period."""
+        return self._cached(
+            "rollups", self.storage.get_rollups, period,
+            *_range_key(states, start, end),
+        )
+
+    def rebuild_rollups(self):
+        self.storage.rebuild_rollups()
+
+    def get_summary(self):
+        return self._cached("summary", self.storage.get_summary_stats)
+
+    def get_rejected(self, state: str = None, reason: str = None,
+                     limit: int = None):
+        return self.storage.get_rejected(state, reason, limit)
+
+    def get_rejected_counts(self, state: str = None):
+        return self.storage.get_rejected_counts(state)
+
+    def get_load_runs(self, limit: int = 10):
+        return self.storage.get_load_runs(limit)
+
+    def check_latest(self):
+        return self.storage.check_latest()
+
+    def rebuild_latest(self):
+        self.storage.rebuild_latest()
+
+    def close(self):
+        self.cache.close()
+        self.storage.close()
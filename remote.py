@@ -0,0 +1,132 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from typing import Any, Optional, Tuple
+from urllib.parse import urljoin
+
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+# responses worth another attempt; anything else fails straight away
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class http_fetcher:
+    """GETs JSON from the API with one pooled session.
+
+    Failed requests (connection errors, timeouts, RETRY_STATUSES) are
+    retried with exponential backoff. With a cache_dir, responses that
+    carried an ETag or Last-Modified are kept on disk and revalidated with
+    If-None-Match/If-Modified-Since, so unchanged endpoints cost a 304.
+    Safe to share between threads.
+    """
+
+    def __init__(self, base_url: str, cache_dir: Optional[str] = None,
+                 timeout: float = 32, retries: int = 3, backoff: float = 0.5,
+                 pool_size: int = 8):
+        self.base_url = base_url.rstrip("/") + "/"
+        self.cache_dir = cache_dir
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self._lock = threading.Lock()
+        self.stats = {"requests": 0, "not_modified": 0, "retries": 0, "bytes": 0}
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def _count(self, name: str, value: int = 1):
+        with self._lock:
+            self.stats[name] += value
+
+    def _cache_paths(self, url: str) -> Tuple[str, str]:
+        key = hashlib.sha1(url.encode()).hexdigest()
+        base = os.path.join(self.cache_dir, key)
+        return base + ".meta", base + ".body"
+
+    def _cache_read(self, url: str) -> Optional[Tuple[dict, bytes]]:
+        if not self.cache_dir:
+            return None
+        meta_path, body_path = self._cache_paths(url)
+        try:
+            with open(meta_path) as f:
+                meta = json.load(f)
+            with open(body_path, "rb") as f:
+                body = f.read()
+        except (OSError, ValueError):
+            return None
+        if meta.get("url") != url or meta.get("size") != len(body):
+            return None
+        return meta, body
+
+    def _cache_write(self, url: str, response: requests.Response):
+        etag = response.headers.get("ETag")
+        last_modified = response.headers.get("Last-Modified")
+        if not self.cache_dir or not (etag or last_modified):
+            return
+        meta_path, body_path = self._cache_paths(url)
+        meta = {
+            "url": url,
+            "etag": etag,
+            "last_modified": last_modified,
+            "size": len(response.content),
+        }
+        # body first: a meta file only ever describes a complete body
+        for path, data, mode in ((body_path, response.content, "wb"),
+                                 (meta_path, json.dumps(meta), "w")):
+            tmp_path = f"{path}.{threading.get_ident()}.tmp"
+            with open(tmp_path, mode) as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+
+    def _wait(self, attempt: int, response: Optional[requests.Response] = None):
+        delay = self.backoff * 2 ** attempt
+        retry_after = response.headers.get("Retry-After") if response is not None else None
+        if retry_after and retry_after.isdigit():
+            delay = max(delay, int(retry_after))
+        self._count("retries")
+        time.sleep(delay)
+
+    def get_json(self, path: str) -> Any:
+        url = urljoin(self.base_url, path)
+        cached = self._cache_read(url)
+        headers = {}
+        if cached is not None:
+            meta = cached[0]
+            if meta.get("etag"):
+                headers["If-None-Match"] = meta["etag"]
+            if meta.get("last_modified"):
+                headers["If-Modified-Since"] = meta["last_modified"]
+        for attempt in range(self.retries + 1):
+            last_try = attempt == self.retries
+            try:
+                self._count("requests")
+                response = self.session.get(url, headers=headers, timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if last_try:
+                    raise
+                logger.warning("GET %s failed (%s), retrying", url, e)
+                self._wait(attempt)
+                continue
+            if response.status_code == 304 and cached is not None:
+                self._count("not_modified")
+                return json.loads(cached[1])
+            if response.status_code in RETRY_STATUSES and not last_try:
+                logger.warning("GET %s returned %d, retrying", url, response.status_code)
+                self._wait(attempt, response)
+                continue
+            response.raise_for_status()
+            self._count("bytes", len(response.content))
+            self._cache_write(url, response)
+            return response.json()
+
+    def close(self):
+        self.session.close()
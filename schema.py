@@ -2,6 +2,13 @@ from datetime import date
 from typing import Optional
 from dataclasses import dataclass
 
+import numpy as np
+
+from fields import METRIC_FIELDS
+
+# how many rows record_batch.rows() turns into Python objects at once
+ROW_CHUNK = 4096
+
 @dataclass
 class covid_schema:
     state: str
@@ -35,4 +42,77 @@ class covid_schema:
         ]:
             value = getattr(self, field_name)
             if value is not None and value < 0:
-                raise ValueError(f"{field_name} must be non-negative")
\ No newline at end of file
+                raise ValueError(f"{field_name} must be non-negative")
+
+
+class record_batch:
+    """Column-oriented records: int32 epoch-day dates, an int64 metric
+    matrix and a matching null mask, one row per (state, date)."""
+
+    __slots__ = ("states", "days", "values", "nulls")
+
+    def __init__(self, states, days, values, nulls):
+        self.states = np.asarray(states, dtype="U2")
+        self.days = np.asarray(days, dtype=np.int32)
+        self.values = np.asarray(values, dtype=np.int64)
+        self.nulls = np.asarray(nulls, dtype=bool)
+
+    @classmethod
+    def empty(cls) -> "record_batch":
+        width = len(METRIC_FIELDS)
+        return cls(
+            np.empty(0, dtype="U2"),
+            np.empty(0, dtype=np.int32),
+            np.empty((0, width), dtype=np.int64),
+            np.empty((0, width), dtype=bool),
+        )
+
+    @classmethod
+    def from_rows(cls, rows: list) -> "record_batch":
+        """Batch from (state, date, *metrics) tuples; dates may be ISO
+        strings or epoch days."""
+        if not rows:
+            return cls.empty()
+        days = np.array([r[1] for r in rows], dtype="datetime64[D]").astype(np.int32)
+        values = np.array([r[2:] for r in rows], dtype=object)
+        nulls = np.equal(values, None)
+        values[nulls] = 0
+        return cls([r[0] for r in rows], days, values.astype(np.int64), nulls)
+
+    def __len__(self) -> int:
+        return len(self.days)
+
+    def dates(self):
+        return self.days.astype("datetime64[D]")
+
+    def metric(self, name: str):
+        col = METRIC_FIELDS.index(name)
+        return np.ma.MaskedArray(self.values[:, col], mask=self.nulls[:, col])
+
+    def select(self, mask) -> "record_batch":
+        return record_batch(
+            self.states[mask], self.days[mask], self.values[mask], self.nulls[mask]
+        )
+
+    def rows(self, iso_dates: bool = True):
+        """Yield (state, date, *metrics) tuples with None for nulls; dates
+        are YYYY-MM-DD strings, or epoch days unless iso_dates."""
+        # sqlite3's executemany binds one parameter sequence per row, so the
+        # tuples can't be skipped; converting ROW_CHUNK rows at a time keeps
+        # the Python objects to one chunk instead of the whole batch.
+        dates = self.dates().astype(str) if iso_dates else self.days
+        for start in range(0, len(self), ROW_CHUNK):
+            stop = start + ROW_CHUNK
+            values = self.values[start:stop].astype(object)
+            values[self.nulls[start:stop]] = None
+            yield from zip(
+                self.states[start:stop].tolist(),
+                dates[start:stop].tolist(),
+                *values.T.tolist(),
+            )
+
+    def to_records(self) -> list:
+        return [
+            covid_schema(state, date.fromisoformat(day), *metrics)
+            for state, day, *metrics in self.rows()
+        ]
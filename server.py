@@ -0,0 +1,308 @@
+import asyncio
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+from datetime import date
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+from urllib.parse import parse_qs, urlsplit
+
+logger = logging.getLogger(__name__)
+
+REASONS = {
+    200: "OK",
+    400: "Bad Request",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    413: "Payload Too Large",
+    431: "Request Header Fields Too Large",
+    500: "Internal Server Error",
+}
+
+MAX_HEADER_LINES = 100
+# rows per chunk when streaming list results
+STREAM_BATCH = 100
+
+
+class http_error(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+class row_stream:
+    """A list result read from a storage cursor a batch at a time."""
+
+    def __init__(self, batches: Iterator[List[Any]]):
+        self.batches = batches
+
+
+class query_server:
+    """Asyncio HTTP/JSON front end for the pipeline's query methods.
+
+    Routes:
+        GET /top?metric=cases|deaths&limit=N
+        GET /state/<code>
+        GET /timeline/<code>?days=N[&metric=new_cases|new_deaths&rolling=1|7]
+        GET /timeline/<code>?from=YYYY-MM-DD&to=YYYY-MM-DD
+        GET /summary
+        GET /stats
+
+    SQLite work runs on a thread pool no larger than the storage read pool,
+    and at most max_concurrency requests are processed at once; the rest
+    wait for a slot. List results are sent with chunked encoding; date
+    ranges are read from the storage cursor as they are sent.
+    """
+
+    def __init__(self, pipeline, host: str = "127.0.0.1", port: int = 8080,
+                 max_concurrency: int = 256, workers: Optional[int] = None):
+        self.pipeline = pipeline
+        self.host = host
+        self.port = port
+        self.max_concurrency = max_concurrency
+        self.executor = ThreadPoolExecutor(
+            max_workers=workers or pipeline.config.pool_size,
+            thread_name_prefix="query",
+        )
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._server: Optional[asyncio.AbstractServer] = None
+        self.requests_served = 0
+
+    async def start(self) -> asyncio.AbstractServer:
+        self._slots = asyncio.Semaphore(self.max_concurrency)
+        self._server = await asyncio.start_server(
+            self._handle_connection, self.host, self.port
+        )
+        self.port = self._server.sockets[0].getsockname()[1]
+        logger.info("serving queries on http://%s:%d", self.host, self.port)
+        return self._server
+
+    async def serve_forever(self):
+        server = await self.start()
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            self.executor.shutdown(wait=False)
+
+    async def close(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+        self.executor.shutdown(wait=False)
+
+    async def _read_request(self, reader: asyncio.StreamReader
+                            ) -> Optional[Tuple[str, str, Dict[str, str]]]:
+        request_line = await self._readline(reader)
+        if not request_line.strip():
+            return None
+        try:
+            method, target, _ = request_line.decode("latin-1").split(" ", 2)
+        except ValueError:
+            raise http_error(400, "malformed request line")
+        headers = {}
+        for _ in range(MAX_HEADER_LINES):
+            line = await self._readline(reader)
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+        else:
+            raise http_error(413, "too many headers")
+        return method, target, headers
+
+    @staticmethod
+    async def _readline(reader: asyncio.StreamReader) -> bytes:
+        try:
+            return await reader.readline()
+        except (ValueError, asyncio.LimitOverrunError):
+            # longer than the stream limit; the rest of it can't be skipped
+            raise http_error(431, "request line or header too long")
+
+    async def _handle_connection(self, reader: asyncio.StreamReader,
+                                 writer: asyncio.StreamWriter):
+        try:
+            while True:
+                try:
+                    request = await self._read_request(reader)
+                except http_error as exc:
+                    await self._send_json(writer, exc.status, {"error": str(exc)},
+                                          keep_alive=False)
+                    break
+                if request is None:
+                    break
+                method, target, headers = request
+                keep_alive = headers.get("connection", "").lower() != "close"
+                async with self._slots:
+                    await self._respond(writer, method, target, keep_alive)
+                self.requests_served += 1
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+
+    async def _respond(self, writer: asyncio.StreamWriter, method: str,
+                       target: str, keep_alive: bool):
+        try:
+            if method != "GET":
+                raise http_error(405, f"method {method} not allowed")
+            result = await self._dispatch(target)
+        except http_error as exc:
+            await self._send_json(writer, exc.status, {"error": str(exc)}, keep_alive)
+            return
+        except Exception as exc:
+            logger.error("query %s failed: %s", target, exc)
+            await self._send_json(writer, 500, {"error": "internal error"}, keep_alive)
+            return
+        if isinstance(result, row_stream):
+            await self._stream_json_list(writer, result.batches, keep_alive)
+        elif isinstance(result, list):
+            await self._stream_json_list(writer, self._batched(result), keep_alive)
+        else:
+            await self._send_json(writer, 200, result, keep_alive)
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, func, *args)
+
+    @staticmethod
+    def _int_param(params: Dict[str, List[str]], name: str, default: int) -> int:
+        try:
+            value = int(params.get(name, [default])[0])
+        except ValueError:
+            raise http_error(400, f"{name} must be an integer")
+        if value < 1:
+            raise http_error(400, f"{name} must be positive")
+        return value
+
+    async def _dispatch(self, target: str) -> Any:
+        url = urlsplit(target)
+        params = parse_qs(url.query)
+        parts = [p for p in url.path.split("/") if p]
+        if parts == ["top"]:
+            metric = params.get("metric", ["cases"])[0]
+            limit = self._int_param(params, "limit", 10)
+            if metric == "cases":
+                return await self._run(self.pipeline.query_top_cases, limit)
+            if metric == "deaths":
+                return await self._run(self.pipeline.query_top_deaths, limit)
+            raise http_error(400, "metric must be cases or deaths")
+        if len(parts) == 2 and parts[0] == "state":
+            result = await self._run(self.pipeline.query_state, parts[1].upper())
+            if not result:
+                raise http_error(404, f"no data found for {parts[1]}")
+            return result
+        if len(parts) == 2 and parts[0] == "timeline":
+            if "from" in params or "to" in params:
+                return self._time_range(parts[1], params)
+            days = self._int_param(params, "days", 30)
+            if "metric" in params:
+                rolling = self._int_param(params, "rolling", 1)
+                try:
+                    return await self._run(
+                        self.pipeline.query_derived, parts[1],
+                        params["metric"][0], rolling, days,
+                    )
+                except ValueError as exc:
+                    raise http_error(400, str(exc))
+            return await self._run(
+                self.pipeline.query_time_series, parts[1].upper(), days
+            )
+        if parts == ["summary"]:
+            return await self._run(self.pipeline.get_summary)
+        if parts == ["stats"]:
+            return {
+                "requests_served": self.requests_served,
+                "cache": self.pipeline.cache_stats(),
+            }
+        raise http_error(404, f"unknown path {url.path}")
+
+    @staticmethod
+    def _date_param(params: Dict[str, List[str]], name: str) -> Optional[str]:
+        if name not in params:
+            return None
+        try:
+            return date.fromisoformat(params[name][0]).isoformat()
+        except ValueError:
+            raise http_error(400, f"{name} must be a YYYY-MM-DD date")
+
+    def _time_range(self, state: str, params: Dict[str, List[str]]) -> row_stream:
+        """A state's rows between from and to, oldest first, uncached and
+        streamed from the storage cursor."""
+        start = self._date_param(params, "from")
+        end = self._date_param(params, "to")
+        columns = self.pipeline.export_columns("states")
+        batches = self.pipeline.iter_batches(
+            "states", [state.upper()], start, end, size=STREAM_BATCH
+        )
+
+        def dicts():
+            with closing(batches):
+                for batch in batches:
+                    yield [dict(zip(columns, values)) for values in batch]
+
+        return row_stream(dicts())
+
+    @staticmethod
+    def _batched(rows: List[Any]) -> Iterator[List[Any]]:
+        for start in range(0, len(rows), STREAM_BATCH):
+            yield rows[start:start + STREAM_BATCH]
+
+    @staticmethod
+    def _headers(status: int, keep_alive: bool, extra: Dict[str, str]) -> bytes:
+        lines = [f"HTTP/1.1 {status} {REASONS.get(status, '')}",
+                 "Content-Type: application/json",
+                 f"Connection: {'keep-alive' if keep_alive else 'close'}"]
+        lines.extend(f"{name}: {value}" for name, value in extra.items())
+        return ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
+
+    async def _send_json(self, writer: asyncio.StreamWriter, status: int,
+                         payload: Any, keep_alive: bool = True):
+        body = json.dumps(payload, default=str).encode()
+        writer.write(self._headers(
+            status, keep_alive, {"Content-Length": str(len(body))}
+        ))
+        writer.write(body)
+        await writer.drain()
+
+    async def _stream_json_list(self, writer: asyncio.StreamWriter,
+                                batches: Iterator[List[Any]], keep_alive: bool = True):
+        """Send a JSON array with chunked encoding, one chunk per batch.
+        Batches are pulled on the query pool, since reading one may wait on
+        the database. A failure after the headers are sent can't become an
+        error response, so the connection is dropped instead."""
+        writer.write(self._headers(200, keep_alive, {"Transfer-Encoding": "chunked"}))
+        prefix = "["
+        try:
+            while True:
+                batch = await self._run(next, batches, None)
+                if batch is None:
+                    break
+                if not batch:
+                    continue
+                chunk = (prefix + ",".join(
+                    json.dumps(row, default=str) for row in batch
+                )).encode()
+                prefix = ","
+                writer.write(f"{len(chunk):x}\r\n".encode() + chunk + b"\r\n")
+                await writer.drain()
+        except ConnectionError:
+            raise
+        except Exception as exc:
+            logger.error("streaming response failed: %s", exc)
+            writer.transport.abort()
+            raise ConnectionResetError("response aborted") from exc
+        finally:
+            # hands a cursor's connection back to the pool if the client left
+            close = getattr(batches, "close", None)
+            if close is not None:
+                await self._run(close)
+        chunk = b"[]" if prefix == "[" else b"]"
+        writer.write(f"{len(chunk):x}\r\n".encode() + chunk + b"\r\n0\r\n\r\n")
+        await writer.drain()
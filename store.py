@@ -1,95 +1,758 @@
+import os
+import secrets
 import sqlite3
-from typing import List, Optional, Dict
+import threading
+from typing import List, Optional, Dict, Iterable, Iterator
 from contextlib import contextmanager
 from datetime import date
-from schema import covid_schema
 from configuration import Config
+from pool import connection_pool
+from fields import DERIVED_FIELDS, METRIC_FIELDS, ROLLUP_PERIODS
+from backend import BATCH_ROWS, EPOCH_ORDINAL, Records, storage_backend
 
 import logging
 
 logger = logging.getLogger(__name__)
 
-class sqlstorage:    
-    def __init__(self, config: Config):
+# covid_states v2 stores dates as epoch days (days since 1970-01-01),
+# clustered on (state, day); 2440587.5 is the Julian day of the epoch
+SCHEMA_VERSION = 2
+JULIAN_EPOCH = 2440587.5
+DAY_PARAM = f"CAST(julianday(?) - {JULIAN_EPOCH} AS INTEGER)"
+
+
+def _iso(column: str) -> str:
+    """SQL for an epoch-day expression as a YYYY-MM-DD string."""
+    return f"date({column} + {JULIAN_EPOCH})"
+
+
+METRIC_LIST = ", ".join(METRIC_FIELDS)
+# a covid_states or latest_by_state row as the API returns it
+ROW_COLUMNS = f"state, {_iso('day')} AS date, {METRIC_LIST}"
+
+# secondary indexes on covid_states; bulk loads drop and rebuild them.
+# Time series read the clustered primary key directly; top-N on a given
+# day walks this index in order and stops after N rows.
+SECONDARY_INDEXES = {
+    "idx_day_cases": """
+        CREATE INDEX IF NOT EXISTS idx_day_cases
+        ON covid_states(day, cases_total DESC)
+    """,
+}
+
+# schema 1 indexes, dropped by the migration
+V1_INDEXES = ("idx_state", "idx_date", "idx_cases", "idx_deaths")
+
+# every table _init_db creates; read-only opens upgrade databases missing any
+SCHEMA_TABLES = (
+    "covid_states", "latest_by_state", "load_watermarks", "load_row_hashes",
+    "derived_metrics", "etl_meta", "rejected_records",
+    "rollup_national_daily", "rollup_state_period", "rollup_dirty",
+    "load_runs", "load_run_states",
+)
+
+# national totals count a missing metric as 0
+SUM_LIST = ", ".join(f"COALESCE(SUM({field}), 0)" for field in METRIC_FIELDS)
+# first and last epoch day of the week (from Monday; day 0 was a Thursday)
+# and of the month that `day` falls in
+PERIOD_BOUNDS = {
+    "week": ("day - (day + 3) % 7", "day - (day + 3) % 7 + 6"),
+    "month": tuple(
+        f"CAST(julianday(date(day + {JULIAN_EPOCH}, 'start of month'{shift}))"
+        f" - {JULIAN_EPOCH} AS INTEGER)"
+        for shift in ("", ", '+1 month', '-1 day'")
+    ),
+}
+
+class sqlstorage(storage_backend):
+    def __init__(self, config: Config, read_only: bool = False):
         self.db= config.db
-        self._init_db()
+        self.pool = connection_pool(config, read_only)
+        # per-thread session connection, see session()
+        self._local = threading.local()
+        if read_only:
+            if not os.path.exists(self.db):
+                raise FileNotFoundError(
+                    f"no database at {self.db}; load data with `fetch` first"
+                )
+            if not self._schema_current():
+                # written by an older version: upgrade it once, read-write
+                logger.info("upgrading schema of %s", self.db)
+                sqlstorage(config).close()
+        else:
+            self._init_db()
     
     def _init_db(self):
         with self._get_connection() as conn:
+            migrated = self._migrate(conn)
+            self._create_tables(conn)
+            # identifies this database file, so caches outlive neither it
+            # nor its generation counter
             conn.execute("""
-                CREATE TABLE IF NOT EXISTS covid_states (
-                    state TEXT NOT NULL,
-                    date DATE NOT NULL,
-                    cases_total INTEGER,
-                    cases_confirmed INTEGER,
-                    deaths_total INTEGER,
-                    deaths_confirmed INTEGER,
-                    deaths_probable INTEGER,
-                    hospitalized_currently INTEGER,
-                    hospitalized_cumulative INTEGER,
-                    in_icu_currently INTEGER,
-                    tests_total INTEGER,
-                    loaded_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    PRIMARY KEY (state, date)
-                )
-            """)
-            
+                INSERT OR IGNORE INTO etl_meta (key, value)
+                VALUES ('instance', ?)
+            """, (secrets.randbits(62),))
             conn.execute("""
-                CREATE INDEX IF NOT EXISTS idx_state 
-                ON covid_states(state)
-            """)
-            conn.execute("""
-                CREATE INDEX IF NOT EXISTS idx_date 
-                ON covid_states(date DESC)
+                INSERT OR REPLACE INTO etl_meta (key, value)
+                VALUES ('schema_version', ?)
+            """, (SCHEMA_VERSION,))
+
+            # databases created before latest_by_state or the rollups existed
+            if migrated or not conn.execute(
+                "SELECT 1 FROM latest_by_state LIMIT 1"
+            ).fetchone():
+                self._refresh_latest(conn)
+            if not conn.execute(
+                "SELECT 1 FROM rollup_national_daily LIMIT 1"
+            ).fetchone():
+                self._rebuild_rollups(conn)
+            # marks left by a load that stopped before refreshing them
+            self._refresh_rollups(conn)
+            if migrated:
+                self._bump_generation(conn)
+            
+            conn.commit()
+            if migrated:
+                conn.execute("VACUUM")
+                conn.execute("ANALYZE")
+            logger.info("database initialized")
+
+    def _create_tables(self, conn: sqlite3.Connection):
+        conn.execute(f"""
+            CREATE TABLE IF NOT EXISTS covid_states (
+                state TEXT NOT NULL,
+                day INTEGER NOT NULL,
+                {", ".join(f"{field} INTEGER" for field in METRIC_FIELDS)},
+                PRIMARY KEY (state, day)
+            ) WITHOUT ROWID
+        """)
+        self._create_indexes(conn)
+
+        conn.execute(f"""
+            CREATE TABLE IF NOT EXISTS latest_by_state (
+                state TEXT PRIMARY KEY,
+                day INTEGER NOT NULL,
+                {", ".join(f"{field} INTEGER" for field in METRIC_FIELDS)}
+            ) WITHOUT ROWID
+        """)
+
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS load_watermarks (
+                state TEXT PRIMARY KEY,
+                max_date DATE,
+                row_count INTEGER,
+                source_digest TEXT,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS load_row_hashes (
+                state TEXT NOT NULL,
+                day INTEGER NOT NULL,
+                row_hash TEXT NOT NULL,
+                PRIMARY KEY (state, day)
+            ) WITHOUT ROWID
+        """)
+
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS derived_metrics (
+                state TEXT NOT NULL,
+                day INTEGER NOT NULL,
+                new_cases INTEGER,
+                new_deaths INTEGER,
+                new_cases_avg7 REAL,
+                new_deaths_avg7 REAL,
+                reported_new_cases INTEGER,
+                reported_new_deaths INTEGER,
+                PRIMARY KEY (state, day)
+            ) WITHOUT ROWID
+        """)
+        # rows the cleaner rejected, kept for inspection and replay;
+        # raw is the source row as JSON and identifies it
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS rejected_records (
+                id INTEGER PRIMARY KEY,
+                state TEXT NOT NULL,
+                date TEXT,
+                reason TEXT NOT NULL,
+                raw TEXT NOT NULL UNIQUE,
+                quarantined_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        conn.execute("""
+            CREATE INDEX IF NOT EXISTS idx_rejected_state
+            ON rejected_records(state, reason)
+        """)
+        # aggregates kept current by every write: US totals per day, and
+        # each state's values at the end of every week and month
+        conn.execute(f"""
+            CREATE TABLE IF NOT EXISTS rollup_national_daily (
+                day INTEGER PRIMARY KEY,
+                states INTEGER NOT NULL,
+                {", ".join(f"{field} INTEGER NOT NULL" for field in METRIC_FIELDS)}
+            )
+        """)
+        conn.execute(f"""
+            CREATE TABLE IF NOT EXISTS rollup_state_period (
+                period TEXT NOT NULL,
+                state TEXT NOT NULL,
+                start_day INTEGER NOT NULL,
+                days INTEGER NOT NULL,
+                last_day INTEGER NOT NULL,
+                {", ".join(f"{field} INTEGER" for field in METRIC_FIELDS)},
+                PRIMARY KEY (period, state, start_day)
+            ) WITHOUT ROWID
+        """)
+        # state buckets written since the rollups were last refreshed
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS rollup_dirty (
+                period TEXT NOT NULL,
+                state TEXT NOT NULL,
+                start_day INTEGER NOT NULL,
+                end_day INTEGER NOT NULL,
+                PRIMARY KEY (period, state, start_day)
+            ) WITHOUT ROWID
+        """)
+        # all-states loads and the states each one has committed, so a
+        # stopped run can resume where it left off on the same input
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS load_runs (
+                id INTEGER PRIMARY KEY,
+                fingerprint TEXT NOT NULL,
+                mode TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'running',
+                started_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                finished_at TIMESTAMP
+            )
+        """)
+        conn.execute("""
+            CREATE INDEX IF NOT EXISTS idx_load_runs_fingerprint
+            ON load_runs(fingerprint, id)
+        """)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS load_run_states (
+                run_id INTEGER NOT NULL,
+                state TEXT NOT NULL,
+                records INTEGER,
+                completed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (run_id, state)
+            ) WITHOUT ROWID
+        """)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS etl_meta (
+                key TEXT PRIMARY KEY,
+                value INTEGER
+            )
+        """)
+
+    def _migrate(self, conn: sqlite3.Connection) -> bool:
+        """Rewrite a schema 1 database (text dates, rowid tables and a
+        loaded_at column) in the current layout; False if there was none.
+
+        Row hashes and watermarks are dropped rather than converted, so the
+        next incremental load rewrites each state once.
+        """
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(covid_states)")}
+        if "date" not in columns:
+            return False
+        logger.info("migrating %s to schema version %d", self.db, SCHEMA_VERSION)
+        for name in V1_INDEXES:
+            conn.execute(f"DROP INDEX IF EXISTS {name}")
+        tables = {
+            row[0] for row in conn.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'table'"
+            )
+        }
+        copied = [("covid_states", METRIC_LIST)]
+        if "derived_metrics" in tables:
+            copied.append(("derived_metrics", ", ".join(DERIVED_FIELDS)))
+        for table, _ in copied:
+            conn.execute(f"ALTER TABLE {table} RENAME TO {table}_v1")
+        for table in ("latest_by_state", "load_row_hashes", "load_watermarks"):
+            conn.execute(f"DROP TABLE IF EXISTS {table}")
+        self._create_tables(conn)
+        for table, fields in copied:
+            conn.execute(f"""
+                INSERT INTO {table} (state, day, {fields})
+                SELECT state, CAST(julianday(date) - {JULIAN_EPOCH} AS INTEGER),
+                       {fields}
+                FROM {table}_v1
             """)
+            conn.execute(f"DROP TABLE {table}_v1")
+        return True
+
+    def _schema_current(self) -> bool:
+        with self._get_connection(readonly=True) as conn:
+            found = conn.execute(f"""
+                SELECT COUNT(*) FROM sqlite_master
+                WHERE type = 'table'
+                  AND name IN ({", ".join("?" * len(SCHEMA_TABLES))})
+            """, SCHEMA_TABLES).fetchone()[0]
+            if found != len(SCHEMA_TABLES):
+                return False
+            version = conn.execute(
+                "SELECT value FROM etl_meta WHERE key = 'schema_version'"
+            ).fetchone()
+        return version is not None and version[0] >= SCHEMA_VERSION
+
+    @staticmethod
+    def _create_indexes(conn: sqlite3.Connection):
+        for ddl in SECONDARY_INDEXES.values():
+            conn.execute(ddl)
+
+    @staticmethod
+    def _refresh_latest(conn: sqlite3.Connection, states: Iterable[str] = None):
+        """Recompute latest_by_state for the given states (default: all)."""
+        if states is None:
+            conn.execute("DELETE FROM latest_by_state")
             conn.execute("""
-                CREATE INDEX IF NOT EXISTS idx_cases 
-                ON covid_states(cases_total DESC)
+                INSERT INTO latest_by_state
+                SELECT cs.* FROM covid_states cs
+                INNER JOIN (
+                    SELECT state, MAX(day) as max_day
+                    FROM covid_states
+                    GROUP BY state
+                ) latest ON cs.state = latest.state
+                       AND cs.day = latest.max_day
             """)
+            return
+        for state in states:
+            conn.execute("DELETE FROM latest_by_state WHERE state = ?", (state,))
             conn.execute("""
-                CREATE INDEX IF NOT EXISTS idx_deaths 
-                ON covid_states(deaths_total DESC)
-            """)
-            
+                INSERT INTO latest_by_state
+                SELECT * FROM covid_states
+                WHERE state = ?
+                ORDER BY day DESC
+                LIMIT 1
+            """, (state,))
+
+    @staticmethod
+    def _bump_generation(conn: sqlite3.Connection):
+        """Mark a write so cached query results taken before it go stale."""
+        conn.execute("""
+            INSERT INTO etl_meta (key, value) VALUES ('generation', 1)
+            ON CONFLICT (key) DO UPDATE SET value = value + 1
+        """)
+
+    def _write_rows(self, conn: sqlite3.Connection, rows: List[tuple]):
+        """Upsert (state, day, *metrics) rows into covid_states.
+
+        The rows are staged in a temp table first, so their difference from
+        the rows they replace goes into rollup_national_daily in one
+        statement, and the week and month buckets they fall in are queued
+        in rollup_dirty for _refresh_rollups. Inside bulk_load the rows go
+        straight in and the rollups are rebuilt once at the end instead.
+        """
+        if getattr(self._local, "bulk", False):
+            conn.executemany(f"""
+                INSERT OR REPLACE INTO covid_states (state, day, {METRIC_LIST})
+                VALUES ({", ".join("?" * (len(METRIC_FIELDS) + 2))})
+            """, rows)
+            return
+        conn.execute(f"""
+            CREATE TEMP TABLE IF NOT EXISTS incoming_rows (
+                state TEXT NOT NULL,
+                day INTEGER NOT NULL,
+                {", ".join(f"{field} INTEGER" for field in METRIC_FIELDS)},
+                PRIMARY KEY (state, day)
+            ) WITHOUT ROWID
+        """)
+        conn.executemany(f"""
+            INSERT OR REPLACE INTO temp.incoming_rows
+            VALUES ({", ".join("?" * (len(METRIC_FIELDS) + 2))})
+        """, rows)
+        # upsert from a join: WHERE true keeps ON CONFLICT unambiguous
+        deltas = ", ".join(
+            f"SUM(COALESCE(i.{f}, 0) - COALESCE(cs.{f}, 0))" for f in METRIC_FIELDS
+        )
+        conn.execute(f"""
+            INSERT INTO rollup_national_daily (day, states, {METRIC_LIST})
+            SELECT i.day, SUM(cs.state IS NULL), {deltas}
+            FROM temp.incoming_rows i
+            LEFT JOIN covid_states cs ON cs.state = i.state AND cs.day = i.day
+            WHERE true
+            GROUP BY i.day
+            ON CONFLICT (day) DO UPDATE SET
+                states = states + excluded.states,
+                {", ".join(f"{f} = {f} + excluded.{f}" for f in METRIC_FIELDS)}
+        """)
+        conn.execute(f"""
+            INSERT OR REPLACE INTO covid_states (state, day, {METRIC_LIST})
+            SELECT state, day, {METRIC_LIST} FROM temp.incoming_rows
+        """)
+        for period, (first, last) in PERIOD_BOUNDS.items():
+            conn.execute(f"""
+                INSERT OR IGNORE INTO rollup_dirty (period, state, start_day, end_day)
+                SELECT DISTINCT ?, state, {first}, {last} FROM temp.incoming_rows
+            """, (period,))
+        conn.execute("DELETE FROM temp.incoming_rows")
+
+    @staticmethod
+    def _refresh_rollups(conn: sqlite3.Connection):
+        """Recompute the queued state buckets from covid_states."""
+        if not conn.execute("SELECT 1 FROM rollup_dirty LIMIT 1").fetchone():
+            return
+        conn.execute("""
+            DELETE FROM rollup_state_period
+            WHERE (period, state, start_day) IN (
+                SELECT period, state, start_day FROM rollup_dirty
+            )
+        """)
+        # the bare metric columns come from the row with MAX(day)
+        conn.execute(f"""
+            INSERT INTO rollup_state_period
+            (period, state, start_day, days, last_day, {METRIC_LIST})
+            SELECT d.period, d.state, d.start_day, COUNT(*), MAX(cs.day),
+                   {METRIC_LIST}
+            FROM rollup_dirty d
+            JOIN covid_states cs
+              ON cs.state = d.state AND cs.day BETWEEN d.start_day AND d.end_day
+            GROUP BY d.period, d.state, d.start_day
+        """)
+        conn.execute("DELETE FROM rollup_dirty")
+
+    @staticmethod
+    def _rebuild_rollups(conn: sqlite3.Connection):
+        """Recompute every rollup from a full scan of covid_states."""
+        conn.execute("DELETE FROM rollup_dirty")
+        conn.execute("DELETE FROM rollup_national_daily")
+        conn.execute(f"""
+            INSERT INTO rollup_national_daily (day, states, {METRIC_LIST})
+            SELECT day, COUNT(*), {SUM_LIST} FROM covid_states GROUP BY day
+        """)
+        conn.execute("DELETE FROM rollup_state_period")
+        for period, (start, _) in PERIOD_BOUNDS.items():
+            conn.execute(f"""
+                INSERT INTO rollup_state_period
+                (period, state, start_day, days, last_day, {METRIC_LIST})
+                SELECT ?, state, {start}, COUNT(*), MAX(day), {METRIC_LIST}
+                FROM covid_states
+                GROUP BY state, {start}
+            """, (period,))
+
+    def rebuild_rollups(self):
+        with self._get_connection() as conn:
+            self._rebuild_rollups(conn)
+            self._bump_generation(conn)
+            self._commit(conn)
+            logger.info("rebuilt rollups")
+
+    def get_generation(self) -> int:
+        with self._get_connection(readonly=True) as conn:
+            row = conn.execute(
+                "SELECT value FROM etl_meta WHERE key = 'generation'"
+            ).fetchone()
+            return row[0] if row else 0
+
+    def get_instance_id(self) -> int:
+        with self._get_connection(readonly=True) as conn:
+            return conn.execute(
+                "SELECT value FROM etl_meta WHERE key = 'instance'"
+            ).fetchone()[0]
+
+    @property
+    def _session(self) -> Optional[sqlite3.Connection]:
+        return getattr(self._local, "session", None)
+
+    @contextmanager
+    def _get_connection(self, readonly: bool = False):
+        if self._session is not None:
+            yield self._session
+        elif readonly:
+            with self.pool.reader() as conn:
+                yield conn
+        else:
+            with self.pool.writer() as conn:
+                yield conn
+
+    def _commit(self, conn: sqlite3.Connection):
+        # inside a session the session owner decides when to commit, and
+        # the rollups are refreshed once, when it closes
+        if self._session is None:
+            self._refresh_rollups(conn)
             conn.commit()
-            logger.info("database initialized")
 
     @contextmanager
-    def _get_connection(self):
-        conn = sqlite3.connect(self.db)
-        conn.row_factory = sqlite3.Row
+    def session(self):
+        """Route this thread's calls through one dedicated connection;
+        commit when it closes."""
+        conn = self.pool.connect()
+        self._local.session = conn
         try:
             yield conn
+            self._refresh_rollups(conn)
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
         finally:
+            self._local.session = None
             conn.close()
+
+    def commit_session(self, conn: sqlite3.Connection):
+        self._refresh_rollups(conn)
+        conn.commit()
+
+    def close(self):
+        self.pool.close()
+
+    @contextmanager
+    def savepoint(self, conn: sqlite3.Connection, name: str = "load_state"):
+        """Undo only this block's writes if it fails, without committing."""
+        # keep an outer transaction open so releasing the savepoint
+        # doesn't commit
+        if not conn.in_transaction:
+            conn.execute("BEGIN")
+        conn.execute(f"SAVEPOINT {name}")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute(f"ROLLBACK TO {name}")
+            raise
+        finally:
+            conn.execute(f"RELEASE {name}")
+
+    @contextmanager
+    def bulk_load(self):
+        """Session for full reloads.
+
+        Everything runs in one transaction with fsync off; the secondary
+        indexes are dropped for the load and rebuilt before the commit,
+        along with the rollups; the table is analyzed afterwards.
+        """
+        with self.session() as conn:
+            conn.execute("PRAGMA journal_mode = WAL")
+            conn.execute("PRAGMA synchronous = OFF")
+            conn.execute("PRAGMA temp_store = MEMORY")
+            conn.execute("PRAGMA cache_size = -262144")
+            conn.execute("BEGIN")
+            for name in SECONDARY_INDEXES:
+                conn.execute(f"DROP INDEX IF EXISTS {name}")
+            self._local.bulk = True
+            try:
+                yield conn
+            finally:
+                self._local.bulk = False
+            logger.info("rebuilding indexes and rollups after bulk load")
+            self._create_indexes(conn)
+            self._rebuild_rollups(conn)
+        with self._get_connection() as conn:
+            conn.execute("ANALYZE")
     
-    def insert_records(self, records: List[covid_schema]):
+    def insert_records(self, records: Records):
         with self._get_connection() as conn:
-            conn.executemany("""
-                INSERT OR REPLACE INTO covid_states 
-                (state, date, cases_total, cases_confirmed,
-                deaths_total, deaths_confirmed, deaths_probable,
-                hospitalized_currently, hospitalized_cumulative,
-                in_icu_currently, tests_total)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-            """, [
-                (r.state, r.date, r.cases_total,
-                 r.cases_confirmed, r.deaths_total, r.deaths_confirmed,
-                 r.deaths_probable, r.hospitalized_currently,
-                 r.hospitalized_cumulative, r.in_icu_currently, r.tests_total)
-                for r in records
-            ])
-            conn.commit()
+            self._write_rows(conn, self._iter_rows(records, iso_dates=False))
+            states = self._states_of(records)
+            self._refresh_latest(conn, states)
+            self._bump_generation(conn)
+            # a full load overwrites rows behind the incremental bookkeeping
+            conn.executemany(
+                "DELETE FROM load_watermarks WHERE state = ?",
+                [(state,) for state in states],
+            )
+            conn.executemany(
+                "DELETE FROM load_row_hashes WHERE state = ?",
+                [(state,) for state in states],
+            )
+            self._commit(conn)
             logger.info(f"Inserted {len(records)} records")
+
+    def get_watermark(self, state: str) -> Optional[dict]:
+        with self._get_connection(readonly=True) as conn:
+            cursor = conn.execute("""
+                SELECT * FROM load_watermarks WHERE state = ?
+            """, (state.upper(),))
+            row = cursor.fetchone()
+            return dict(row) if row else None
+
+    def insert_records_incremental(self,
+                                   records: Records,
+                                   state: str,
+                                   source_digest: Optional[str] = None
+                                   ) -> Dict[str, int]:
+        """Write only rows that are new or whose content changed."""
+        state = state.upper()
+        with self._get_connection() as conn:
+            known = {
+                row["day"]: row["row_hash"]
+                for row in conn.execute("""
+                    SELECT day, row_hash FROM load_row_hashes
+                    WHERE state = ?
+                """, (state,))
+            }
+            rows = list(self._iter_rows(records, iso_dates=False))
+            hashed = set(known)
+            # rows written by a full or bulk load have no hash yet: compare
+            # them with what covid_states holds instead
+            if any(values[1] not in hashed for values in rows):
+                for stored in conn.execute(f"""
+                    SELECT state, day, {METRIC_LIST} FROM covid_states
+                    WHERE state = ?
+                """, (state,)):
+                    known.setdefault(stored[1], self._row_hash(tuple(stored)))
+            changed = []
+            hashes = []
+            inserted = updated = skipped = 0
+            max_day = None
+            for values in rows:
+                row_hash = self._row_hash(values)
+                day = values[1]
+                if max_day is None or day > max_day:
+                    max_day = day
+                previous = known.get(day)
+                if previous == row_hash:
+                    skipped += 1
+                    if day not in hashed:
+                        hashes.append((values[0], day, row_hash))
+                    continue
+                if previous is None:
+                    inserted += 1
+                else:
+                    updated += 1
+                changed.append(values)
+                hashes.append((values[0], day, row_hash))
+
+            self._write_rows(conn, changed)
+            conn.executemany("""
+                INSERT OR REPLACE INTO load_row_hashes (state, day, row_hash)
+                VALUES (?, ?, ?)
+            """, hashes)
+            if changed:
+                self._refresh_latest(conn, {values[0] for values in changed})
+                self._bump_generation(conn)
+            conn.execute("""
+                INSERT OR REPLACE INTO load_watermarks
+                (state, max_date, row_count, source_digest)
+                VALUES (?, ?, ?, ?)
+            """, (
+                state,
+                None if max_day is None
+                else date.fromordinal(EPOCH_ORDINAL + max_day).isoformat(),
+                len(records),
+                source_digest,
+            ))
+            self._commit(conn)
+        stats = {
+            "inserted": inserted, "updated": updated, "skipped": skipped,
+            "first_changed": None if not changed else date.fromordinal(
+                EPOCH_ORDINAL + min(values[1] for values in changed)
+            ).isoformat(),
+        }
+        logger.info(
+            "Incremental load for %s: %d inserted, %d updated, %d skipped",
+            state, inserted, updated, skipped,
+        )
+        return stats
     
-    def get_latest_by_state(self, state: str) -> Optional[dict]:
-        """Get most recent data for a state"""
+    def begin_load_run(self, fingerprint: str, mode: str,
+                       resume: bool = False) -> int:
+        """Start a run, or with resume reopen the latest run on the same
+        input, keeping the states it completed."""
+        with self._get_connection() as conn:
+            row = None
+            if resume:
+                row = conn.execute("""
+                    SELECT id FROM load_runs WHERE fingerprint = ?
+                    ORDER BY id DESC LIMIT 1
+                """, (fingerprint,)).fetchone()
+            if row is not None:
+                run_id = row["id"]
+                conn.execute("""
+                    UPDATE load_runs
+                    SET status = 'running', mode = ?, finished_at = NULL
+                    WHERE id = ?
+                """, (mode, run_id))
+            else:
+                run_id = conn.execute("""
+                    INSERT INTO load_runs (fingerprint, mode) VALUES (?, ?)
+                """, (fingerprint, mode)).lastrowid
+            self._commit(conn)
+            return run_id
+
+    def get_completed_states(self, run_id: int) -> Dict[str, Optional[int]]:
+        with self._get_connection(readonly=True) as conn:
+            return dict(conn.execute("""
+                SELECT state, records FROM load_run_states WHERE run_id = ?
+            """, (run_id,)).fetchall())
+
+    def complete_state(self, run_id: int, state: str,
+                       records: Optional[int]):
+        """Checkpoint a state; inside a session it commits with the
+        state's rows."""
         with self._get_connection() as conn:
+            conn.execute("""
+                INSERT OR REPLACE INTO load_run_states (run_id, state, records)
+                VALUES (?, ?, ?)
+            """, (run_id, state.upper(), records))
+            self._commit(conn)
+
+    def finish_load_run(self, run_id: int, status: str):
+        with self._get_connection() as conn:
+            conn.execute("""
+                UPDATE load_runs
+                SET status = ?, finished_at = CURRENT_TIMESTAMP
+                WHERE id = ?
+            """, (status, run_id))
+            self._commit(conn)
+
+    def get_load_runs(self, limit: int = 10) -> List[dict]:
+        """Newest runs first, with how many states each has completed."""
+        with self._get_connection(readonly=True) as conn:
+            cursor = conn.execute("""
+                SELECT r.id, r.fingerprint, r.mode, r.status, r.started_at,
+                       r.finished_at, COUNT(s.state) AS states,
+                       SUM(s.records) AS records
+                FROM load_runs r
+                LEFT JOIN load_run_states s ON s.run_id = r.id
+                GROUP BY r.id
+                ORDER BY r.id DESC
+                LIMIT ?
+            """, (limit,))
+            return [dict(row) for row in cursor.fetchall()]
+
+    def check_latest(self) -> List[str]:
+        """States whose latest_by_state row disagrees with covid_states."""
+        with self._get_connection(readonly=True) as conn:
             cursor = conn.execute("""
-                SELECT * FROM covid_states 
+                SELECT cs.state FROM covid_states cs
+                INNER JOIN (
+                    SELECT state, MAX(day) as max_day
+                    FROM covid_states
+                    GROUP BY state
+                ) latest ON cs.state = latest.state
+                       AND cs.day = latest.max_day
+                LEFT JOIN latest_by_state lbs ON lbs.state = cs.state
+                WHERE lbs.state IS NULL
+                   OR lbs.day IS NOT cs.day
+                   OR lbs.cases_total IS NOT cs.cases_total
+                   OR lbs.cases_confirmed IS NOT cs.cases_confirmed
+                   OR lbs.deaths_total IS NOT cs.deaths_total
+                   OR lbs.deaths_confirmed IS NOT cs.deaths_confirmed
+                   OR lbs.deaths_probable IS NOT cs.deaths_probable
+                   OR lbs.hospitalized_currently IS NOT cs.hospitalized_currently
+                   OR lbs.hospitalized_cumulative IS NOT cs.hospitalized_cumulative
+                   OR lbs.in_icu_currently IS NOT cs.in_icu_currently
+                   OR lbs.tests_total IS NOT cs.tests_total
+                UNION
+                SELECT state FROM latest_by_state
+                WHERE state NOT IN (SELECT DISTINCT state FROM covid_states)
+                ORDER BY 1
+            """)
+            return [row[0] for row in cursor.fetchall()]
+
+    def rebuild_latest(self):
+        with self._get_connection() as conn:
+            self._refresh_latest(conn)
+            self._bump_generation(conn)
+            self._commit(conn)
+            logger.info("rebuilt latest_by_state")
+
+    def get_latest_by_state(self, state: str) -> Optional[dict]:
+        """Get most recent data for a state"""
+        with self._get_connection(readonly=True) as conn:
+            cursor = conn.execute(f"""
+                SELECT {ROW_COLUMNS} FROM latest_by_state
                 WHERE state = ?
-                ORDER BY date DESC
-                LIMIT 1
             """, (state,))
             row = cursor.fetchone()
             return dict(row) if row else None
@@ -97,71 +760,248 @@ class sqlstorage:
     def get_top_states_by_cases(self, limit: int = 10, 
                                as_of_date: date = None) -> List[dict]:
         """Get states with highest total cases"""
-        with self._get_connection() as conn:
+        with self._get_connection(readonly=True) as conn:
             if as_of_date:
-                cursor = conn.execute("""
-                    SELECT * FROM covid_states 
-                    WHERE date = ?
+                cursor = conn.execute(f"""
+                    SELECT {ROW_COLUMNS} FROM covid_states
+                    WHERE day = {DAY_PARAM}
                     ORDER BY cases_total DESC
                     LIMIT ?
-                """, (as_of_date, limit))
+                """, (str(as_of_date), limit))
             else:
-                cursor = conn.execute("""
-                    SELECT cs.* FROM covid_states cs
-                    INNER JOIN (
-                        SELECT state, MAX(date) as max_date
-                        FROM covid_states
-                        GROUP BY state
-                    ) latest ON cs.state = latest.state 
-                           AND cs.date = latest.max_date
-                    ORDER BY cs.cases_total DESC
+                cursor = conn.execute(f"""
+                    SELECT {ROW_COLUMNS} FROM latest_by_state
+                    ORDER BY cases_total DESC
                     LIMIT ?
                 """, (limit,))
             return [dict(row) for row in cursor.fetchall()]
     
     def get_top_states_by_deaths(self, limit: int = 10) -> List[dict]:
-        with self._get_connection() as conn:
-            cursor = conn.execute("""
-                SELECT cs.* FROM covid_states cs
-                INNER JOIN (
-                    SELECT state, MAX(date) as max_date
-                    FROM covid_states
-                    GROUP BY state
-                ) latest ON cs.state = latest.state 
-                       AND cs.date = latest.max_date
-                ORDER BY cs.deaths_total DESC
+        with self._get_connection(readonly=True) as conn:
+            cursor = conn.execute(f"""
+                SELECT {ROW_COLUMNS} FROM latest_by_state
+                ORDER BY deaths_total DESC
                 LIMIT ?
             """, (limit,))
             return [dict(row) for row in cursor.fetchall()]
     
     def get_time_series(self, state: str,days: int = 30) -> List[dict]:
-        with self._get_connection() as conn:
-            cursor = conn.execute("""
-                SELECT * FROM covid_states
+        with self._get_connection(readonly=True) as conn:
+            cursor = conn.execute(f"""
+                SELECT {ROW_COLUMNS} FROM covid_states
                 WHERE state = ?
-                ORDER BY date DESC
+                ORDER BY day DESC
                 LIMIT ?
             """, (state.upper(), days))
             return [dict(row) for row in cursor.fetchall()]
     
-    def get_summary_stats(self) -> dict:
+    def iter_batches(self, table: str = "states", states: Iterable[str] = None,
+                     start=None, end=None, fields: Iterable[str] = None,
+                     size: int = BATCH_ROWS) -> Iterator[List[tuple]]:
+        """One query over the (state, day) primary key, fetched `size` rows
+        at a time as plain tuples; the reader goes back to the pool once
+        iteration ends."""
+        table, fields = self._export_table(table, fields)
+        states, start, end = self._range_filter(states, start, end)
+        clauses, params = self._day_bounds("day", start, end)
+        if states is not None:
+            clauses.insert(0, f"state IN ({', '.join('?' * len(states))})")
+            params[:0] = states
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+        with self._get_connection(readonly=True) as conn:
+            cursor = conn.cursor()
+            cursor.row_factory = None
+            cursor.execute(f"""
+                SELECT {", ".join(["state", _iso("day"), *fields])} FROM {table}
+                {where}
+                ORDER BY state, day
+            """, params)
+            try:
+                while True:
+                    rows = cursor.fetchmany(size)
+                    if not rows:
+                        return
+                    yield rows
+            finally:
+                cursor.close()
+
+    def insert_derived(self, state: str, rows: List[tuple], replace: bool = False):
+        """Write (state, date, *DERIVED_FIELDS) rows; replace drops the
+        state's existing rows first."""
+        with self._get_connection() as conn:
+            if replace:
+                conn.execute("DELETE FROM derived_metrics WHERE state = ?", (state,))
+            conn.executemany(f"""
+                INSERT OR REPLACE INTO derived_metrics
+                (state, day, {", ".join(DERIVED_FIELDS)})
+                VALUES (?, {DAY_PARAM}, {", ".join("?" * len(DERIVED_FIELDS))})
+            """, rows)
+            self._bump_generation(conn)
+            self._commit(conn)
+
+    def get_derived_watermark(self, state: str) -> Optional[str]:
+        with self._get_connection(readonly=True) as conn:
+            return conn.execute(
+                f"SELECT {_iso('MAX(day)')} FROM derived_metrics WHERE state = ?",
+                (state,),
+            ).fetchone()[0]
+
+    def get_derived_series(self, state: str, days: int = 30,
+                           fields: Iterable[str] = DERIVED_FIELDS) -> List[dict]:
+        """Newest-first derived rows for a state, limited to `fields`."""
+        fields = [f for f in fields if f in DERIVED_FIELDS]
+        with self._get_connection(readonly=True) as conn:
+            cursor = conn.execute(f"""
+                SELECT {", ".join(["state", f"{_iso('day')} AS date", *fields])}
+                FROM derived_metrics
+                WHERE state = ?
+                ORDER BY day DESC
+                LIMIT ?
+            """, (state.upper(), days))
+            return [dict(row) for row in cursor.fetchall()]
+
+    def quarantine(self, rows: List[tuple]):
+        """Write (state, date, reason, raw) rows to rejected_records; a row
+        that is already quarantined keeps its id and takes the new reason."""
+        if not rows:
+            return
         with self._get_connection() as conn:
+            conn.executemany("""
+                INSERT INTO rejected_records (state, date, reason, raw)
+                VALUES (?, ?, ?, ?)
+                ON CONFLICT (raw) DO UPDATE SET
+                    reason = excluded.reason,
+                    quarantined_at = CURRENT_TIMESTAMP
+            """, rows)
+            self._commit(conn)
+
+    @staticmethod
+    def _rejected_filter(state: Optional[str], reason: Optional[str]):
+        clauses, params = [], []
+        if state is not None:
+            clauses.append("state = ?")
+            params.append(state.upper())
+        if reason is not None:
+            clauses.append("reason = ?")
+            params.append(reason)
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+        return where, params
+
+    def get_rejected(self, state: str = None, reason: str = None,
+                     limit: int = None) -> List[dict]:
+        where, params = self._rejected_filter(state, reason)
+        with self._get_connection(readonly=True) as conn:
+            cursor = conn.execute(f"""
+                SELECT id, state, date, reason, raw, quarantined_at
+                FROM rejected_records {where}
+                ORDER BY id
+                LIMIT ?
+            """, (*params, -1 if limit is None else limit))
+            return [dict(row) for row in cursor.fetchall()]
+
+    def get_rejected_counts(self, state: str = None) -> List[dict]:
+        where, params = self._rejected_filter(state, None)
+        with self._get_connection(readonly=True) as conn:
+            cursor = conn.execute(f"""
+                SELECT state, reason, COUNT(*) AS rows
+                FROM rejected_records {where}
+                GROUP BY state, reason
+                ORDER BY state, reason
+            """, params)
+            return [dict(row) for row in cursor.fetchall()]
+
+    def delete_rejected(self, ids: Iterable[int]):
+        with self._get_connection() as conn:
+            conn.executemany(
+                "DELETE FROM rejected_records WHERE id = ?", [(i,) for i in ids]
+            )
+            self._commit(conn)
+
+    def get_history(self, states: Iterable[str] = None,
+                    iso_dates: bool = True) -> List[tuple]:
+        """(state, date, *METRIC_FIELDS) tuples ordered by state and date;
+        dates are epoch days unless iso_dates."""
+        query = f"""
+            SELECT state, {_iso('day') if iso_dates else 'day'}, {METRIC_LIST}
+            FROM covid_states
+        """
+        params: tuple = ()
+        if states is not None:
+            states = sorted(states)
+            query += f" WHERE state IN ({', '.join('?' * len(states))})"
+            params = tuple(states)
+        with self._get_connection(readonly=True) as conn:
+            cursor = conn.cursor()
+            cursor.row_factory = None
+            return cursor.execute(query + " ORDER BY state, day", params).fetchall()
+
+    @staticmethod
+    def _day_bounds(column: str, start, end):
+        clauses, params = [], []
+        if start is not None:
+            clauses.append(f"{column} >= {DAY_PARAM}")
+            params.append(start)
+        if end is not None:
+            clauses.append(f"{column} <= {DAY_PARAM}")
+            params.append(end)
+        return clauses, params
+
+    def get_national_daily(self, start=None, end=None) -> List[dict]:
+        """US totals per day, oldest first; states is how many reported."""
+        _, start, end = self._range_filter(None, start, end)
+        clauses, params = self._day_bounds("day", start, end)
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+        with self._get_connection(readonly=True) as conn:
+            cursor = conn.execute(f"""
+                SELECT {_iso('day')} AS date, states, {METRIC_LIST}
+                FROM rollup_national_daily {where}
+                ORDER BY day
+            """, params)
+            return [dict(row) for row in cursor.fetchall()]
+
+    def get_rollups(self, period: str, states: Iterable[str] = None,
+                    start=None, end=None) -> List[dict]:
+        """Per-state week or month buckets starting between start and end,
+        by state then oldest first: each bucket's values on its last day,
+        and new_cases/new_deaths since the previous bucket."""
+        if period not in ROLLUP_PERIODS:
+            raise ValueError(f"period must be one of {', '.join(ROLLUP_PERIODS)}")
+        states, start, end = self._range_filter(states, start, end)
+        clauses, params = ["period = ?"], [period]
+        if states is not None:
+            clauses.append(f"state IN ({', '.join('?' * len(states))})")
+            params.extend(states)
+        bounds, bound_params = self._day_bounds("start_day", start, end)
+        outer = f"WHERE {' AND '.join(bounds)}" if bounds else ""
+        with self._get_connection(readonly=True) as conn:
+            cursor = conn.execute(f"""
+                SELECT period, state, {_iso('start_day')} AS start, days,
+                       {_iso('last_day')} AS last_date, {METRIC_LIST},
+                       new_cases, new_deaths
+                FROM (
+                    SELECT *,
+                           cases_total - LAG(cases_total) OVER w AS new_cases,
+                           deaths_total - LAG(deaths_total) OVER w AS new_deaths
+                    FROM rollup_state_period
+                    WHERE {' AND '.join(clauses)}
+                    WINDOW w AS (PARTITION BY state ORDER BY start_day)
+                ) {outer}
+                ORDER BY state, start_day
+            """, (*params, *bound_params))
+            return [dict(row) for row in cursor.fetchall()]
+
+    def get_summary_stats(self) -> dict:
+        with self._get_connection(readonly=True) as conn:
             
-            cursor = conn.execute("""
+            cursor = conn.execute(f"""
                 SELECT
-                    COUNT(DISTINCT cs.state) as total_states,
-                    SUM(cs.cases_total) as total_cases,
-                    SUM(cs.deaths_total) as total_deaths,
-                    SUM(cs.hospitalized_currently) as total_hospitalized,
-                    AVG(cs.cases_total) as avg_cases_per_state,
-                    MAX(cs.date) as latest_date
-                FROM covid_states cs
-                INNER JOIN (
-                    SELECT state, MAX(date) as max_date
-                    FROM covid_states
-                    GROUP BY state
-                    ) latest ON cs.state = latest.state
-                       AND cs.date = latest.max_date
+                    COUNT(state) as total_states,
+                    SUM(cases_total) as total_cases,
+                    SUM(deaths_total) as total_deaths,
+                    SUM(hospitalized_currently) as total_hospitalized,
+                    AVG(cases_total) as avg_cases_per_state,
+                    {_iso('MAX(day)')} as latest_date
+                FROM latest_by_state
             """)
         
             return dict(cursor.fetchone())
@@ -0,0 +1,62 @@
+import os
+import tempfile
+import unittest
+
+from cache import query_cache, MISSING
+
+
+class QueryCacheTests(unittest.TestCase):
+    def test_hit_miss_and_generation_invalidation(self):
+        cache = query_cache()
+        self.assertIs(cache.get(("top", (10,)), 1), MISSING)
+        cache.put(("top", (10,)), [{"state": "CA"}], 1)
+        self.assertEqual(cache.get(("top", (10,)), 1), [{"state": "CA"}])
+        self.assertIs(cache.get(("top", (10,)), 2), MISSING)
+        stats = cache.stats()
+        self.assertEqual((stats["hits"], stats["misses"]), (1, 2))
+        self.assertEqual(stats["entries"], 0)
+
+    def test_lru_eviction_by_count(self):
+        cache = query_cache(max_entries=2)
+        for key in ("a", "b"):
+            cache.put(key, key, 1)
+        cache.get("a", 1)
+        cache.put("c", "c", 1)
+        self.assertIs(cache.get("b", 1), MISSING)
+        self.assertEqual(cache.get("a", 1), "a")
+        self.assertEqual(cache.stats()["evictions"], 1)
+
+    def test_persists_across_instances(self):
+        fd, path = tempfile.mkstemp(suffix=".cache")
+        os.close(fd)
+        os.remove(path)
+        try:
+            cache = query_cache(path=path, namespace=1)
+            cache.put("summary", {"total_states": 3}, 7)
+            self.assertFalse(os.path.exists(path))
+            cache.close()
+            reloaded = query_cache(path=path, namespace=1)
+            self.assertEqual(reloaded.get("summary", 7), {"total_states": 3})
+            self.assertIs(reloaded.get("summary", 8), MISSING)
+            other_db = query_cache(path=path, namespace=2)
+            self.assertIs(other_db.get("summary", 8), MISSING)
+        finally:
+            os.remove(path)
+
+    def test_saves_after_save_every_puts(self):
+        fd, path = tempfile.mkstemp(suffix=".cache")
+        os.close(fd)
+        os.remove(path)
+        try:
+            cache = query_cache(path=path, namespace=1, save_every=3)
+            cache.put("a", "a", 1)
+            cache.put("b", "b", 1)
+            self.assertFalse(os.path.exists(path))
+            cache.put("c", "c", 1)
+            self.assertEqual(query_cache(path=path, namespace=1).stats()["entries"], 3)
+        finally:
+            os.remove(path)
+
+
+if __name__ == "__main__":
+    unittest.main()
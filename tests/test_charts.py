@@ -0,0 +1,64 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+try:
+    import matplotlib
+except ImportError:
+    matplotlib = None
+
+
+@unittest.skipIf(matplotlib is None, "matplotlib is not installed")
+class ChartTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        dates = np.arange("2021-03-01", "2021-03-08", dtype="datetime64[D]")
+        self.series = {
+            "CA": (dates, np.linspace(100, 400, len(dates))),
+            "NY": (dates[2:], np.array([1.0, np.nan, 3.0, 4.0, 5.0])),
+            "TX": (dates, np.arange(len(dates), dtype=np.float64)),
+        }
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _tasks(self):
+        return [
+            (os.path.join(self.tmpdir, f"{state}.png"), dates, values, state, "cases")
+            for state, (dates, values) in self.series.items()
+        ]
+
+    def test_reused_figure_rescales_per_chart(self):
+        from charts import chart_renderer
+
+        renderer = chart_renderer()
+        for path, dates, values, title, ylabel in self._tasks():
+            renderer.render(path, dates, values, title, ylabel)
+            low, high = renderer.axes.get_ylim()
+            self.assertLessEqual(low, np.nanmin(values))
+            self.assertGreaterEqual(high, np.nanmax(values))
+            self.assertLess(high - low, 2 * (np.nanmax(values) - np.nanmin(values)))
+            self.assertEqual(renderer.axes.get_title(), title)
+        self.assertEqual(len(renderer.figure.axes), 1)
+
+    def test_render_charts_in_processes(self):
+        from charts import render_charts
+
+        tasks = self._tasks()
+        self.assertEqual(render_charts(tasks, workers=2), [t[0] for t in tasks])
+        for path, *_ in tasks:
+            self.assertGreater(os.path.getsize(path), 0)
+
+    def test_grid_writes_one_image(self):
+        from charts import render_grid
+
+        path = os.path.join(self.tmpdir, "grid.png")
+        render_grid(self.series, path, "cases", columns=2)
+        self.assertGreater(os.path.getsize(path), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,92 @@
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import date
+
+import numpy as np
+
+from columnar import column_store
+from configuration import Config
+from pipeline import etl_pipeline
+from schema import covid_schema
+
+
+class ColumnStoreTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.csv_path = os.path.join(self.tmpdir, "history.csv")
+        with open(Config().csv_path) as src, open(self.csv_path, "w") as dst:
+            for _ in range(400):
+                dst.write(src.readline())
+        self.config = Config(
+            csv_path=self.csv_path, db=os.path.join(self.tmpdir, "columns.db"),
+            cache_entries=0,
+        )
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _without_loaded_at(self, rows):
+        return [{k: v for k, v in row.items() if k != "loaded_at"} for row in rows]
+
+    def test_time_series_matches_sqlite(self):
+        pipeline = etl_pipeline(self.config)
+        pipeline.run_for_all_states()
+        self.assertIsNotNone(pipeline._column_view())
+        for state in ("CA", "NY", "AK"):
+            self.assertEqual(
+                pipeline.query_time_series(state, 5),
+                self._without_loaded_at(pipeline.storage.get_time_series(state, 5)),
+            )
+        pipeline.storage.close()
+
+    def test_series_is_a_view_of_the_store(self):
+        pipeline = etl_pipeline(self.config)
+        pipeline.run_for_all_states()
+        dates, values = pipeline.series("ca", "cases_total", 7)
+        self.assertEqual(len(dates), 7)
+        self.assertIsInstance(values.base, np.memmap)
+        expected = [r["cases_total"] for r in pipeline.storage.get_time_series("CA", 7)]
+        self.assertEqual(values.tolist(), expected[::-1])
+        pipeline.storage.close()
+
+    def test_single_state_load_updates_in_place(self):
+        pipeline = etl_pipeline(self.config)
+        pipeline.run_for_all_states()
+        before = pipeline.columns.open().generation
+        pipeline.storage.insert_records([
+            covid_schema(state="CA", date=date(2021, 3, 7), cases_total=1)
+        ])
+        self.assertIsNone(pipeline._column_view())
+        self.assertEqual(pipeline.query_time_series("CA", 1)[0]["cases_total"], 1)
+        pipeline.run_for_state("CA")
+        view = pipeline._column_view()
+        self.assertIsNotNone(view)
+        self.assertGreater(view.generation, before)
+        self.assertEqual(
+            view.records("CA", 3),
+            self._without_loaded_at(pipeline.storage.get_time_series("CA", 3)),
+        )
+        versions = [n for n in os.listdir(pipeline.columns.path) if n.startswith("v")]
+        self.assertEqual(len(versions), 1)
+        pipeline.storage.close()
+
+    def test_store_from_another_database_is_ignored(self):
+        pipeline = etl_pipeline(self.config)
+        pipeline.run_for_state("CA")
+        pipeline.storage.close()
+        other = etl_pipeline(Config(
+            csv_path=self.csv_path, db=os.path.join(self.tmpdir, "other.db"),
+            columns_path=pipeline.columns.path,
+        ))
+        self.assertIsNone(other._column_view())
+        self.assertEqual(other.query_time_series("CA", 3), [])
+        other.storage.close()
+
+    def test_missing_store_opens_as_none(self):
+        self.assertIsNone(column_store(os.path.join(self.tmpdir, "none")).open())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,8 +1,17 @@
+import gzip
+import os
+import shutil
+import tempfile
 import unittest
 from datetime import datetime
 
 from configuration import Config
-from dataextractor import data_extraction
+from dataextractor import data_extraction, input_files, is_indexable
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 class DataExtractionTests(unittest.TestCase):
     def setUp(self):
@@ -35,5 +44,108 @@ class DataExtractionTests(unittest.TestCase):
         self.assertEqual(parsed_dates, sorted(parsed_dates, reverse=True))
 
 
+class IndexedExtractionTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.csv_path = os.path.join(self.tmpdir, "history.csv")
+        with open(Config().csv_path) as src, open(self.csv_path, "w") as dst:
+            for _ in range(400):
+                dst.write(src.readline())
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_indexed_matches_full_load(self):
+        full = data_extraction(Config(csv_path=self.csv_path))
+        indexed = data_extraction(Config(csv_path=self.csv_path, csv_index=True))
+        self.assertTrue(os.path.exists(indexed.index_path))
+        self.assertEqual(indexed.get_state_info(), full.get_state_info())
+        for item in full.get_state_info():
+            state = item["state"]
+            self.assertEqual(
+                indexed.fetch_state_daily(state), full.fetch_state_daily(state)
+            )
+
+    def test_index_rebuilt_when_csv_changes(self):
+        data_extraction(Config(csv_path=self.csv_path, csv_index=True))
+        with open(self.csv_path, "a") as f:
+            f.write('"2021-03-08","ZZ",1\n')
+        extractor = data_extraction(Config(csv_path=self.csv_path, csv_index=True))
+        self.assertEqual(len(extractor.fetch_state_daily("ZZ")), 1)
+
+    def test_index_handles_quoted_commas_and_newlines(self):
+        csv_path = os.path.join(self.tmpdir, "quoted.csv")
+        with open(csv_path, "w") as f:
+            f.write('note,date,state,positive\n')
+            f.write('"revised, see ""notes""",2021-03-07,CA,10\n')
+            f.write('"two\nlines",2021-03-06,CA,9\n')
+            f.write('plain,2021-03-07,NY,20\n')
+        full = data_extraction(Config(csv_path=csv_path))
+        indexed = data_extraction(Config(csv_path=csv_path, csv_index=True))
+        self.assertEqual(indexed.get_state_info(), [{"state": "CA"}, {"state": "NY"}])
+        for state in ("CA", "NY"):
+            self.assertEqual(
+                indexed.fetch_state_daily(state), full.fetch_state_daily(state)
+            )
+        self.assertEqual(len(indexed.fetch_state_daily("CA")), 2)
+
+
+class MultiFileExtractionTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        with open(Config().csv_path) as src:
+            lines = [src.readline() for _ in range(400)]
+        self.csv_path = os.path.join(self.tmpdir, "history.csv")
+        with open(self.csv_path, "w") as f:
+            f.writelines(lines)
+        self.shard_dir = os.path.join(self.tmpdir, "shards")
+        os.mkdir(self.shard_dir)
+        header, rows = lines[0], lines[1:]
+        shards = [rows[:130], rows[130:260], rows[260:]]
+        with open(os.path.join(self.shard_dir, "part-0.csv"), "w") as f:
+            f.writelines([header] + shards[0])
+        with gzip.open(os.path.join(self.shard_dir, "part-1.csv.gz"), "wt") as f:
+            f.writelines([header] + shards[1])
+        if zstandard is not None:
+            path = os.path.join(self.shard_dir, "part-2.csv.zst")
+            with open(path, "wb") as f:
+                f.write(zstandard.ZstdCompressor().compress(
+                    "".join([header] + shards[2]).encode()
+                ))
+        else:
+            with gzip.open(os.path.join(self.shard_dir, "part-2.csv.gz"), "wt") as f:
+                f.writelines([header] + shards[2])
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _assert_same_columns(self, extractor, expected):
+        self.assertEqual(extractor.get_state_info(), expected.get_state_info())
+        for item in expected.get_state_info():
+            state = item["state"]
+            self.assertEqual(
+                extractor.fetch_state_columns(state), expected.fetch_state_columns(state)
+            )
+
+    def test_directory_and_glob_match_single_file(self):
+        expected = data_extraction(Config(csv_path=self.csv_path))
+        for path in (self.shard_dir, os.path.join(self.shard_dir, "part-*")):
+            for workers in (1, 2):
+                extractor = data_extraction(Config(csv_path=path, parse_workers=workers))
+                self._assert_same_columns(extractor, expected)
+                self.assertGreater(extractor.bytes_read, 0)
+
+    def test_index_falls_back_to_full_load(self):
+        self.assertTrue(is_indexable(self.csv_path))
+        self.assertFalse(is_indexable(self.shard_dir))
+        extractor = data_extraction(Config(csv_path=self.shard_dir, csv_index=True))
+        self._assert_same_columns(extractor, data_extraction(Config(csv_path=self.csv_path)))
+        self.assertEqual(len(input_files(self.shard_dir)), 3)
+
+    def test_empty_glob_raises(self):
+        with self.assertRaises(FileNotFoundError):
+            data_extraction(Config(csv_path=os.path.join(self.tmpdir, "none-*.csv")))
+
+
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,43 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from benchmarks.datagen import dimensions, generate_csv
+from configuration import Config
+from dataextractor import data_extraction
+from transform import data_cleaner
+
+
+class DataGenTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_scales_grow_states_then_history(self):
+        self.assertEqual(dimensions(1), (56, 371))
+        states, days = dimensions(100)
+        self.assertEqual(states, 26 * 26)
+        self.assertGreater(days, 371)
+
+    def test_generated_csv_loads_cleanly(self):
+        path = os.path.join(self.tmpdir, "synthetic.csv")
+        rows = generate_csv(path, scale=0.1)
+        extractor = data_extraction(Config(csv_path=path))
+        states = [item["state"] for item in extractor.get_state_info()]
+        self.assertEqual(len(states), dimensions(0.1)[0])
+        cleaner = data_cleaner()
+        total = 0
+        for state in states:
+            batch, rejected = cleaner.clean_batch(
+                extractor.fetch_state_columns(state), state
+            )
+            self.assertFalse(rejected.any())
+            total += len(batch)
+        self.assertEqual(total, rows)
+
+
+if __name__ == "__main__":
+    unittest.main()
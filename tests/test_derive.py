@@ -0,0 +1,66 @@
+import unittest
+
+import numpy as np
+
+from derive import metric_deriver, derived_rows
+from schema import METRIC_FIELDS, record_batch
+
+
+def _batch(days, cases, deaths):
+    width = len(METRIC_FIELDS)
+    values = np.zeros((len(days), width), dtype=np.int64)
+    nulls = np.ones((len(days), width), dtype=bool)
+    for col, series in ((METRIC_FIELDS.index("cases_total"), cases),
+                        (METRIC_FIELDS.index("deaths_total"), deaths)):
+        for i, value in enumerate(series):
+            if value is not None:
+                values[i, col] = value
+                nulls[i, col] = False
+    return record_batch(["CA"] * len(days), days, values, nulls)
+
+
+class MetricDeriverTests(unittest.TestCase):
+    def test_increases_follow_date_order(self):
+        # newest first, as the extractor hands them over
+        batch = _batch([3, 2, 1, 0], [16, 9, 4, 1], [3, None, 1, 0])
+        derived = metric_deriver().derive(batch)
+        self.assertEqual(derived["days"].tolist(), [0, 1, 2, 3])
+        self.assertTrue(np.isnan(derived["new_cases"][0]))
+        self.assertEqual(derived["new_cases"][1:].tolist(), [3, 5, 7])
+        self.assertTrue(np.isnan(derived["new_deaths"][2:]).all())
+
+    def test_rolling_average_needs_a_full_window(self):
+        days = list(range(10))
+        batch = _batch(days, [d * d for d in days], [0] * 10)
+        derived = metric_deriver().derive(batch)
+        averages = derived["new_cases_avg7"]
+        self.assertTrue(np.isnan(averages[:7]).all())
+        # increases are 2d - 1; days 1..7 average to 7
+        self.assertEqual(averages[7], 7.0)
+        self.assertEqual(averages[9], 11.0)
+
+    def test_reported_increases_skip_rejected_rows(self):
+        batch = _batch([1, 0], [5, 2], [1, 1])
+        columns = {"positiveIncrease": ["3", "bad-row", "2"]}
+        rejected = np.array([False, True, False])
+        derived = metric_deriver().derive(batch, columns, rejected)
+        self.assertEqual(derived["reported_new_cases"].tolist(), [2, 3])
+        self.assertTrue(np.isnan(derived["reported_new_deaths"]).all())
+
+    def test_oversized_reported_increase_is_missing(self):
+        batch = _batch([1, 0], [5, 2], [1, 1])
+        columns = {"positiveIncrease": ["99999999999999999999", "2"]}
+        derived = metric_deriver().derive(batch, columns, np.zeros(2, dtype=bool))
+        self.assertTrue(np.isnan(derived["reported_new_cases"][1]))
+        self.assertEqual(derived["reported_new_cases"][0], 2)
+
+    def test_rows_after_a_watermark(self):
+        batch = _batch([2, 1, 0], [6, 3, 1], [0, 0, 0])
+        rows = derived_rows("CA", metric_deriver().derive(batch), since_day=1)
+        self.assertEqual(rows, [
+            ("CA", "1970-01-03", 3, 0, None, None, None, None),
+        ])
+
+
+if __name__ == "__main__":
+    unittest.main()
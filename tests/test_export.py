@@ -0,0 +1,75 @@
+import csv
+import gzip
+import io
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from export import compression_for, open_output, write_rows
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+COLUMNS = ["state", "date", "cases_total", "new_cases_avg7"]
+BATCHES = [
+    [("CA", "2021-03-01", 10, 1.5), ("CA", "2021-03-02", None, None)],
+    [("NY", "2021-03-01", 7, 0.25)],
+]
+
+
+class ExportTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _write(self, name: str, fmt: str, compression: str = None) -> str:
+        path = os.path.join(self.tmpdir, name)
+        with open_output(path, compression_for(path, compression)) as out:
+            self.assertEqual(write_rows(out, fmt, COLUMNS, iter(BATCHES)), 3)
+        return path
+
+    def test_ndjson(self):
+        with open(self._write("rows.ndjson", "ndjson")) as f:
+            rows = [json.loads(line) for line in f]
+        self.assertEqual(rows[1], {
+            "state": "CA", "date": "2021-03-02",
+            "cases_total": None, "new_cases_avg7": None,
+        })
+        self.assertEqual([row["cases_total"] for row in rows], [10, None, 7])
+
+    def test_csv_with_gzip_from_suffix(self):
+        path = self._write("rows.csv.gz", "csv")
+        with gzip.open(path, "rt", newline="") as f:
+            rows = list(csv.reader(f))
+        self.assertEqual(rows[0], COLUMNS)
+        self.assertEqual(rows[1:], [
+            ["CA", "2021-03-01", "10", "1.5"],
+            ["CA", "2021-03-02", "", ""],
+            ["NY", "2021-03-01", "7", "0.25"],
+        ])
+
+    @unittest.skipIf(zstandard is None, "zstandard is not installed")
+    def test_zstd(self):
+        path = self._write("rows.out", "ndjson", "zstd")
+        with open(path, "rb") as f:
+            raw = zstandard.ZstdDecompressor().stream_reader(f)
+            lines = io.TextIOWrapper(raw).readlines()
+        self.assertEqual(len(lines), 3)
+
+    def test_rejects_unknown_format_and_compression(self):
+        path = os.path.join(self.tmpdir, "rows")
+        with self.assertRaises(ValueError):
+            with open_output(path, "bz2"):
+                pass
+        with open_output(path) as out, self.assertRaises(ValueError):
+            write_rows(out, "xml", COLUMNS, BATCHES)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,81 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from configuration import Config
+from metrics import NULL_METRICS, run_metrics
+from pipeline import etl_pipeline
+
+
+class MetricsTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.csv_path = os.path.join(self.tmpdir, "history.csv")
+        with open(Config().csv_path) as src, open(self.csv_path, "w") as dst:
+            for _ in range(400):
+                dst.write(src.readline())
+        self.config = Config(
+            csv_path=self.csv_path, db=os.path.join(self.tmpdir, "metrics.db")
+        )
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_run_report_counts_rows_per_state(self):
+        metrics = run_metrics()
+        pipeline = etl_pipeline(self.config, metrics=metrics)
+        total = pipeline.run_for_all_states(workers=2)
+        pipeline.storage.close()
+        report = metrics.report()
+        run = report["run"]
+        self.assertEqual(run["counters"]["rows_in"], 399)
+        self.assertEqual(run["counters"]["rows_written"], total)
+        self.assertEqual(
+            run["counters"]["rows_rejected"], 399 - total
+        )
+        self.assertGreater(run["counters"]["bytes_read"], 0)
+        self.assertEqual(set(run["stages"]), {"extract", "transform", "derive", "load", "columns"})
+        self.assertIsNotNone(run["wall_seconds"])
+        self.assertGreater(run["peak_rss_bytes"], 0)
+        per_state = sum(
+            data["counters"]["rows_in"] for data in report["states"].values()
+        )
+        self.assertEqual(per_state, 399)
+        for state, data in report["states"].items():
+            # extract through derive ran in a worker, load in this process
+            self.assertEqual(set(data["rss_bytes"]), set(data["stages"]))
+            self.assertTrue(all(rss > 0 for rss in data["rss_bytes"].values()))
+            self.assertEqual(set(data["rss_growth_bytes"]), set(data["rss_bytes"]))
+        self.assertEqual(set(run["rss_bytes"]), set(run["stages"]))
+
+    def test_reports_are_written(self):
+        metrics = run_metrics()
+        pipeline = etl_pipeline(self.config, metrics=metrics)
+        pipeline.run_for_state("CA")
+        pipeline.storage.close()
+        json_path = os.path.join(self.tmpdir, "run.json")
+        prom_path = os.path.join(self.tmpdir, "run.prom")
+        metrics.write_json(json_path)
+        metrics.write_prometheus(prom_path)
+        with open(json_path) as f:
+            self.assertIn("CA", json.load(f)["states"])
+        with open(prom_path) as f:
+            text = f.read()
+        self.assertIn('etl_rows{counter="rows_in",state="CA"}', text)
+        self.assertIn('etl_stage_rss_bytes{stage="load",state="CA"}', text)
+        self.assertIn('etl_stage_rss_growth_bytes{stage="transform",state="CA"}', text)
+        self.assertIn("# TYPE etl_stage_seconds gauge", text)
+
+    def test_disabled_metrics_record_nothing(self):
+        pipeline = etl_pipeline(self.config)
+        self.assertIs(pipeline.metrics, NULL_METRICS)
+        with NULL_METRICS.timer("extract"):
+            NULL_METRICS.count("rows_in", 1)
+        self.assertFalse(hasattr(NULL_METRICS, "counters"))
+        pipeline.storage.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
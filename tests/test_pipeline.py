@@ -0,0 +1,230 @@
+import gzip
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+from unittest import mock
+
+from configuration import Config
+from pipeline import etl_pipeline
+from queries import query_service
+
+try:
+    import duckdb
+except ImportError:
+    duckdb = None
+
+
+class PipelineTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.csv_path = os.path.join(self.tmpdir, "history.csv")
+        with open(Config().csv_path) as src, open(self.csv_path, "w") as dst:
+            for _ in range(400):
+                dst.write(src.readline())
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _config(self, name: str) -> Config:
+        return Config(csv_path=self.csv_path, db=os.path.join(self.tmpdir, name))
+
+    def _rows(self, config: Config):
+        with sqlite3.connect(config.db) as conn:
+            return conn.execute("""
+                SELECT state, day, cases_total, deaths_total, tests_total
+                FROM covid_states ORDER BY state, day
+            """).fetchall()
+
+    def test_parallel_run_matches_sequential(self):
+        sequential = self._config("sequential.db")
+        parallel = self._config("parallel.db")
+        total = etl_pipeline(sequential).run_for_all_states()
+        pipeline = etl_pipeline(parallel)
+        self.assertEqual(pipeline.run_for_all_states(workers=2), total)
+        self.assertEqual(self._rows(parallel), self._rows(sequential))
+        # the states came from the CSV index; only the workers parsed rows
+        self.assertIsNotNone(pipeline._extractor._index)
+        self.assertEqual(pipeline._extractor._columns_by_state, {})
+
+    def test_bulk_run_matches_sequential(self):
+        sequential = self._config("sequential.db")
+        bulk = self._config("bulk.db")
+        total = etl_pipeline(sequential).run_for_all_states()
+        self.assertEqual(etl_pipeline(bulk).run_for_all_states(bulk=True), total)
+        self.assertEqual(self._rows(bulk), self._rows(sequential))
+
+    def test_incremental_rerun_skips_unchanged_states(self):
+        config = self._config("incremental.db")
+        first = etl_pipeline(config)
+        self.assertGreater(first.run_for_all_states(incremental=True), 0)
+        second = etl_pipeline(config)
+        self.assertEqual(second.run_for_all_states(incremental=True, workers=2), 0)
+        totals = second.load_totals()
+        self.assertEqual(totals["inserted"] + totals["updated"], 0)
+        self.assertEqual(totals["skipped"], first.load_totals()["inserted"])
+
+    def test_identical_incremental_rerun_reports_nothing_written(self):
+        config = self._config("incremental.db")
+        self.assertGreater(etl_pipeline(config).run_for_state("CA", incremental=True), 0)
+        # the source digest matches, so the state is skipped outright
+        self.assertEqual(etl_pipeline(config).run_for_state("CA", incremental=True), 0)
+        # or, with the digest gone, every row compares unchanged
+        pipeline = etl_pipeline(config)
+        with mock.patch.object(pipeline, "_known_digest", return_value=None):
+            self.assertEqual(pipeline.run_for_state("CA", incremental=True), 0)
+
+    def test_parallel_run_over_compressed_shards(self):
+        sequential = self._config("sequential.db")
+        total = etl_pipeline(sequential).run_for_all_states()
+        shard_dir = os.path.join(self.tmpdir, "shards")
+        os.mkdir(shard_dir)
+        with open(self.csv_path) as f:
+            header, *rows = f.readlines()
+        for i in range(2):
+            with gzip.open(os.path.join(shard_dir, f"part-{i}.csv.gz"), "wt") as f:
+                f.writelines([header] + rows[i::2])
+        sharded = Config(csv_path=shard_dir, db=os.path.join(self.tmpdir, "sharded.db"))
+        self.assertEqual(etl_pipeline(sharded).run_for_all_states(workers=2), total)
+        self.assertEqual(self._rows(sharded), self._rows(sequential))
+
+    def test_resume_skips_states_committed_before_a_crash(self):
+        expected = self._config("expected.db")
+        etl_pipeline(expected).run_for_all_states()
+        config = self._config("resumed.db")
+        first = etl_pipeline(config)
+        load_state = first._load_state
+        started = []
+
+        def crash_on_third(state, incremental=False):
+            if len(started) == 2:
+                # a reader on another connection sees the committed states
+                reader = query_service(config)
+                self.assertEqual(reader.get_summary()["total_states"], 2)
+                reader.close()
+                raise KeyboardInterrupt
+            started.append(state)
+            return load_state(state, incremental)
+
+        with mock.patch.object(first, "_load_state", crash_on_third):
+            with self.assertRaises(KeyboardInterrupt):
+                first.run_for_all_states()
+        run = first.get_load_runs(1)[0]
+        self.assertEqual((run["status"], run["states"]), ("failed", 2))
+        first.storage.close()
+
+        second = etl_pipeline(config)
+        resumed = []
+        load_state = second._load_state
+
+        def record(state, incremental=False):
+            resumed.append(state)
+            return load_state(state, incremental)
+
+        with mock.patch.object(second, "_load_state", record):
+            second.run_for_all_states(resume=True)
+        self.assertTrue(resumed)
+        self.assertFalse(set(started) & set(resumed))
+        self.assertEqual(second.run_id, run["id"])
+        self.assertEqual(self._rows(config), self._rows(expected))
+        run = second.get_load_runs(1)[0]
+        self.assertEqual(run["status"], "complete")
+        self.assertEqual(run["states"], len(started) + len(resumed))
+        second.storage.close()
+
+    def test_resume_after_input_changed_starts_a_new_run(self):
+        config = self._config("changed.db")
+        first = etl_pipeline(config)
+        total = first.run_for_all_states()
+        # a finished run on the same input leaves nothing to resume
+        self.assertEqual(etl_pipeline(config).run_for_all_states(resume=True), 0)
+        stat = os.stat(self.csv_path)
+        os.utime(self.csv_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+        changed = etl_pipeline(config)
+        self.assertEqual(changed.run_for_all_states(resume=True), total)
+        self.assertNotEqual(changed.run_id, first.run_id)
+
+    def _derived(self, pipeline, state="CA"):
+        return pipeline.storage.get_derived_series(state, 10_000)
+
+    def test_incremental_load_appends_derived_metrics(self):
+        full = etl_pipeline(self._config("full.db"))
+        full.run_for_state("CA")
+        expected = self._derived(full)
+        full.storage.close()
+
+        with open(self.csv_path) as f:
+            header, *rows = f.readlines()
+        # the sample is newest first; hold back CA's three latest days
+        ca_rows = [i for i, row in enumerate(rows) if ',"CA",' in row]
+        partial_path = os.path.join(self.tmpdir, "partial.csv")
+        with open(partial_path, "w") as f:
+            f.writelines([header] + [r for i, r in enumerate(rows) if i not in ca_rows[:3]])
+
+        config = self._config("incremental.db")
+        first = etl_pipeline(Config(csv_path=partial_path, db=config.db))
+        first.run_for_state("CA", incremental=True)
+        self.assertEqual(self._derived(first), expected[3:])
+        first.storage.close()
+        second = etl_pipeline(config)
+        second.run_for_state("CA", incremental=True)
+        self.assertEqual(second.load_totals()["inserted"], 3)
+        self.assertEqual(self._derived(second), expected)
+        self.assertEqual(
+            second.query_derived("CA", "new_cases", 7, 2),
+            [{"state": "CA", "date": r["date"], "new_cases_avg7": r["new_cases_avg7"]}
+             for r in expected[:2]],
+        )
+        second.storage.close()
+
+    def test_incremental_backfill_replaces_derived_metrics(self):
+        full = etl_pipeline(self._config("full.db"))
+        full.run_for_state("CA")
+        expected = self._derived(full)
+        full.storage.close()
+
+        with open(self.csv_path) as f:
+            header, *rows = f.readlines()
+        # a CA date four days before the latest is missing at first
+        missing = [i for i, row in enumerate(rows) if ',"CA",' in row][4]
+        partial_path = os.path.join(self.tmpdir, "partial.csv")
+        with open(partial_path, "w") as f:
+            f.writelines([header] + rows[:missing] + rows[missing + 1:])
+
+        config = self._config("backfill.db")
+        first = etl_pipeline(Config(csv_path=partial_path, db=config.db))
+        first.run_for_state("CA", incremental=True)
+        first.storage.close()
+        second = etl_pipeline(config)
+        second.run_for_state("CA", incremental=True)
+        self.assertEqual(second.load_totals()["inserted"], 1)
+        self.assertEqual(self._derived(second), expected)
+        second.storage.close()
+
+    @unittest.skipIf(duckdb is None, "duckdb is not installed")
+    def test_duckdb_backend_matches_sqlite(self):
+        sqlite_pipeline = etl_pipeline(self._config("sqlite.db"))
+        total = sqlite_pipeline.run_for_all_states()
+        expected = sqlite_pipeline.storage.get_history()
+        for name, kwargs in (("ingest", {"bulk": True}), ("parallel", {"workers": 2})):
+            config = self._config(f"{name}.db")
+            config.backend = "duckdb"
+            pipeline = etl_pipeline(config)
+            self.assertEqual(pipeline.run_for_all_states(**kwargs), total)
+            if name == "ingest":
+                # DuckDB read the CSV; the Python extractor never parsed it
+                self.assertIsNone(pipeline._extractor)
+            self.assertEqual(pipeline.storage.get_history(), expected)
+            self.assertEqual(pipeline.get_summary(), sqlite_pipeline.get_summary())
+            self.assertEqual(pipeline.get_load_runs(1)[0]["status"], "complete")
+            for state in ("CA", "NY"):
+                self.assertEqual(
+                    self._derived(pipeline, state), self._derived(sqlite_pipeline, state)
+                )
+            pipeline.storage.close()
+        sqlite_pipeline.storage.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,97 @@
+import logging
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+from configuration import Config
+from pipeline import etl_pipeline
+from quarantine import reject_log
+
+
+class QuarantineTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.csv_path = os.path.join(self.tmpdir, "history.csv")
+        with open(Config().csv_path) as src:
+            lines = [src.readline() for _ in range(400)]
+        header = lines[0].replace('"', "").strip().split(",")
+        self.date_col = header.index("date")
+        self.positive_col = header.index("positive")
+        ca_lines = [i for i, line in enumerate(lines) if ',"CA",' in line]
+        # one CA row with an impossible date, one with negative cases
+        self.bad_date = self._edit(lines, ca_lines[1], self.date_col, '"2021-02-30"')
+        self._edit(lines, ca_lines[2], self.positive_col, "-5")
+        with open(self.csv_path, "w") as dst:
+            dst.writelines(lines)
+        self.config = Config(csv_path=self.csv_path, db=os.path.join(self.tmpdir, "q.db"))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    @staticmethod
+    def _edit(lines, index: int, col: int, value: str) -> str:
+        fields = lines[index].rstrip("\n").split(",")
+        original = fields[col].strip('"')
+        fields[col] = value
+        lines[index] = ",".join(fields) + "\n"
+        return original
+
+    def test_rejected_rows_are_quarantined_with_reasons(self):
+        pipeline = etl_pipeline(self.config)
+        pipeline.run_for_state("CA")
+        self.assertEqual(pipeline.get_rejected_counts("CA"), [
+            {"state": "CA", "reason": "bad_date", "rows": 1},
+            {"state": "CA", "reason": "negative_cases_total", "rows": 1},
+        ])
+        # loading the same input again doesn't duplicate them
+        pipeline.run_for_state("CA")
+        self.assertEqual(len(pipeline.get_rejected("CA")), 2)
+        pipeline.storage.close()
+
+    def test_replay_loads_fixed_rows(self):
+        pipeline = etl_pipeline(self.config)
+        pipeline.run_for_state("CA")
+        days = len(pipeline.query_time_series("CA", 1000))
+        with sqlite3.connect(self.config.db) as conn:
+            conn.execute(
+                "UPDATE rejected_records SET raw = replace(raw, '2021-02-30', ?)"
+                " WHERE reason = 'bad_date'", (self.bad_date,),
+            )
+        totals = pipeline.replay_rejected("CA")
+        self.assertEqual(totals, {"replayed": 1, "rejected": 1})
+        self.assertEqual(len(pipeline.query_time_series("CA", 1000)), days + 1)
+        self.assertEqual(
+            [r["reason"] for r in pipeline.get_rejected("CA")], ["negative_cases_total"]
+        )
+        derived = pipeline.query_derived("CA", "new_cases", days=1000)
+        self.assertIn(self.bad_date, [r["date"] for r in derived])
+        self.assertIsNotNone(
+            pipeline.storage.get_derived_series("CA", 1000)[-1]["reported_new_cases"]
+        )
+        pipeline.storage.close()
+
+    def test_quarantine_can_be_disabled(self):
+        self.config.quarantine = False
+        pipeline = etl_pipeline(self.config)
+        pipeline.run_for_state("CA")
+        self.assertEqual(pipeline.get_rejected(), [])
+        pipeline.storage.close()
+
+
+class RejectLogTests(unittest.TestCase):
+    def test_samples_are_capped_and_counts_aggregated(self):
+        log = reject_log(max_samples=2)
+        rows = [("CA", "x", "bad_date", "{}")] * 5 + [("CA", "y", "bad_state", "{}")]
+        with self.assertLogs("quarantine", logging.WARNING) as logs:
+            log.add("CA", rows)
+            log.add("NY", rows[:1])
+            log.report()
+        self.assertEqual(len(logs.records), 2 + 1 + 2)
+        self.assertIn("CA: bad_date=5, bad_state=1", logs.output[3])
+        self.assertEqual(log.total(), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
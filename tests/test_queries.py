@@ -0,0 +1,100 @@
+import os
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import unittest
+
+from configuration import Config
+from pipeline import etl_pipeline
+from queries import query_service
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class QueryServiceTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.csv_path = os.path.join(self.tmpdir, "history.csv")
+        with open(Config().csv_path) as src, open(self.csv_path, "w") as dst:
+            for _ in range(400):
+                dst.write(src.readline())
+        self.config = Config(csv_path=self.csv_path, db=os.path.join(self.tmpdir, "q.db"))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_matches_pipeline_queries(self):
+        pipeline = etl_pipeline(self.config)
+        pipeline.run_for_all_states()
+        # the CSV is gone: queries must not need it
+        os.remove(self.csv_path)
+        queries = query_service(self.config)
+        self.assertEqual(queries.query_top_cases(5), pipeline.query_top_cases(5))
+        self.assertEqual(queries.query_state("CA"), pipeline.query_state("CA"))
+        self.assertEqual(
+            queries.query_time_series("CA", 5), pipeline.query_time_series("CA", 5)
+        )
+        self.assertEqual(queries.get_summary(), pipeline.get_summary())
+        with self.assertRaises(sqlite3.OperationalError):
+            queries.rebuild_latest()
+        queries.close()
+        pipeline.storage.close()
+
+    def test_time_range_groups_states(self):
+        etl_pipeline(self.config).run_for_all_states()
+        queries = query_service(self.config)
+        self.addCleanup(queries.close)
+        ranged = queries.query_time_range(
+            ["TX", "ca"], "2021-02-01", "2021-03-07", ["cases_total"]
+        )
+        self.assertEqual(sorted(ranged), ["CA", "TX"])
+        for state, rows in ranged.items():
+            newest_first = queries.query_time_series(state, len(rows))
+            self.assertEqual(
+                [(r["date"], r["cases_total"]) for r in rows],
+                [(r["date"], r["cases_total"]) for r in reversed(newest_first)],
+            )
+        dates, values = queries.series_by_state(
+            ["CA"], "cases_total", "2021-02-01", "2021-03-07"
+        )["CA"]
+        self.assertEqual(str(dates[-1]), ranged["CA"][-1]["date"])
+        self.assertEqual(values[-1], ranged["CA"][-1]["cases_total"])
+        self.assertIs(
+            queries.query_time_range(
+                ["CA", "TX"], "2021-02-01", "2021-03-07", ["cases_total"]
+            ),
+            ranged,
+        )
+
+    def test_missing_database_is_not_created(self):
+        with self.assertRaises(FileNotFoundError):
+            query_service(self.config)
+        self.assertFalse(os.path.exists(self.config.db))
+
+    def test_upgrades_older_schema_once(self):
+        etl_pipeline(self.config).run_for_state("CA")
+        with sqlite3.connect(self.config.db) as conn:
+            conn.execute("DROP TABLE etl_meta")
+            conn.execute("DROP TABLE derived_metrics")
+        queries = query_service(self.config)
+        self.assertEqual(queries.query_state("CA")["state"], "CA")
+        self.assertEqual(queries.query_derived("CA", "new_cases"), [])
+        queries.close()
+
+    def test_cli_queries_skip_heavy_imports(self):
+        code = (
+            "import sys, app, queries, store; "
+            "heavy = {'numpy', 'requests', 'dataextractor', 'pipeline'}; "
+            "print(sorted(heavy & set(sys.modules)))"
+        )
+        result = subprocess.run(
+            [sys.executable, "-c", code], cwd=REPO_ROOT,
+            capture_output=True, text=True, check=True,
+        )
+        self.assertEqual(result.stdout.strip(), "[]")
+
+
+if __name__ == "__main__":
+    unittest.main()
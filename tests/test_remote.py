@@ -0,0 +1,171 @@
+import csv
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from dataclasses import replace
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from configuration import Config
+from dataextractor import EXTRACT_FIELDS, data_extraction
+from remote import http_fetcher
+
+
+class _stand_in_api(BaseHTTPRequestHandler):
+    """Serves covidtracking v1-style JSON with ETags; `routes` maps paths to
+    bodies and `failures` to how many 503s a path returns first."""
+
+    routes = {}
+    failures = {}
+    hits = []
+
+    def do_GET(self):
+        path = self.path.lstrip("/")
+        self.hits.append((path, self.headers.get("If-None-Match")))
+        if self.failures.get(path):
+            self.failures[path] -= 1
+            self.send_response(503)
+            self.send_header("Retry-After", "0")
+            self.end_headers()
+            return
+        body = self.routes.get(path)
+        if body is None:
+            self.send_response(404)
+            self.end_headers()
+            return
+        etag = f'"{hash(body) & 0xffffffff:x}"'
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def _api_record(row: dict) -> dict:
+    record = {}
+    for field in EXTRACT_FIELDS:
+        value = row.get(field) or None
+        if field == "date":
+            value = int(value.replace("-", ""))
+        elif value is not None and value.lstrip("-").isdigit():
+            value = int(value)
+        record[field] = value
+    return record
+
+
+class RemoteExtractionTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.csv_path = os.path.join(self.tmpdir, "history.csv")
+        with open(Config().csv_path) as src, open(self.csv_path, "w") as dst:
+            for _ in range(400):
+                dst.write(src.readline())
+        by_state = {}
+        with open(self.csv_path, newline="") as f:
+            for row in csv.DictReader(f):
+                by_state.setdefault(row["state"], []).append(_api_record(row))
+        routes = {
+            "states/info.json": json.dumps(
+                [{"state": state} for state in by_state]
+            ).encode(),
+        }
+        for state, records in by_state.items():
+            routes[f"states/{state.lower()}/daily.json"] = json.dumps(records).encode()
+        routes["us/daily.json"] = json.dumps({"data": [{"date": 20210307}]}).encode()
+        _stand_in_api.routes = routes
+        _stand_in_api.failures = {}
+        _stand_in_api.hits = []
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), _stand_in_api)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.config = Config(
+            csv_path=self.csv_path,
+            api=f"http://127.0.0.1:{self.server.server_port}/",
+            http_cache_dir=os.path.join(self.tmpdir, "http"),
+            http_workers=4,
+            http_backoff=0,
+        )
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_remote_matches_csv(self):
+        local = data_extraction(Config(csv_path=self.csv_path))
+        remote = data_extraction(self.config)
+        self.addCleanup(remote.close)
+        self.assertTrue(remote.is_remote)
+        self.assertEqual(remote.get_state_info(), local.get_state_info())
+        for item in local.get_state_info():
+            self.assertEqual(
+                remote.fetch_state_columns(item["state"]),
+                local.fetch_state_columns(item["state"]),
+            )
+        self.assertGreater(remote.bytes_read, 0)
+        self.assertEqual(remote.fetch_us_daily(), [{"date": 20210307}])
+
+    def test_unchanged_endpoints_are_not_modified(self):
+        first = data_extraction(self.config)
+        first.prefetch([item["state"] for item in first.get_state_info()])
+        first.close()
+        requests_made = len(_stand_in_api.hits)
+        second = data_extraction(self.config)
+        second.prefetch([item["state"] for item in second.get_state_info()])
+        second.close()
+        self.assertEqual(second.fetcher.stats["not_modified"], requests_made)
+        self.assertEqual(second.bytes_read, 0)
+        self.assertEqual(second._columns_by_state, first._columns_by_state)
+        self.assertTrue(all(etag for _, etag in _stand_in_api.hits[requests_made:]))
+
+    def test_states_are_fetched_on_first_use(self):
+        extractor = data_extraction(self.config)
+        self.addCleanup(extractor.close)
+        self.assertEqual([path for path, _ in _stand_in_api.hits], ["states/info.json"])
+        state = extractor.get_state_info()[0]["state"]
+        self.assertTrue(extractor.fetch_state_columns(state)["date"])
+        self.assertEqual(
+            [path for path, _ in _stand_in_api.hits],
+            ["states/info.json", f"states/{state.lower()}/daily.json"],
+        )
+
+    def test_failed_state_fails_alone(self):
+        from pipeline import etl_pipeline
+
+        states = [item["state"] for item in data_extraction(self.config).get_state_info()]
+        del _stand_in_api.routes[f"states/{states[0].lower()}/daily.json"]
+        for workers in (1, 2):
+            config = replace(
+                self.config, db=os.path.join(self.tmpdir, f"load{workers}.db"),
+                columnar=False,
+            )
+            pipeline = etl_pipeline(config)
+            self.addCleanup(pipeline.close)
+            self.assertGreater(pipeline.run_for_all_states(workers=workers), 0)
+            self.assertEqual(pipeline.failed_states, [states[0]])
+            self.assertEqual(pipeline.storage.get_load_runs()[0]["status"], "partial")
+
+    def test_retries_transient_failures(self):
+        _stand_in_api.failures["states/info.json"] = 2
+        fetcher = http_fetcher(self.config.api, retries=2, backoff=0)
+        self.addCleanup(fetcher.close)
+        self.assertTrue(fetcher.get_json("states/info.json"))
+        self.assertEqual(fetcher.stats["retries"], 2)
+
+        _stand_in_api.failures["states/info.json"] = 3
+        with self.assertRaises(Exception):
+            fetcher.get_json("states/info.json")
+
+
+if __name__ == "__main__":
+    unittest.main()
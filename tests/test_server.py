@@ -0,0 +1,105 @@
+import asyncio
+import http.client
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from datetime import date
+
+from configuration import Config
+from pipeline import etl_pipeline
+from schema import covid_schema
+from server import query_server
+
+
+class QueryServerTests(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpdir = tempfile.mkdtemp()
+        csv_path = os.path.join(cls.tmpdir, "history.csv")
+        with open(Config().csv_path) as src, open(csv_path, "w") as dst:
+            dst.write(src.readline())
+        cls.pipeline = etl_pipeline(
+            Config(csv_path=csv_path, db=os.path.join(cls.tmpdir, "serve.db"))
+        )
+        cls.pipeline.storage.insert_records([
+            covid_schema(state="CA", date=date(2021, 3, day), cases_total=day * 10)
+            for day in range(1, 8)
+        ] + [covid_schema(state="NY", date=date(2021, 3, 7), cases_total=5)])
+
+        cls.loop = asyncio.new_event_loop()
+        cls.server = query_server(cls.pipeline, port=0, max_concurrency=4)
+        threading.Thread(target=cls.loop.run_forever, daemon=True).start()
+        asyncio.run_coroutine_threadsafe(cls.server.start(), cls.loop).result()
+
+    @classmethod
+    def tearDownClass(cls):
+        asyncio.run_coroutine_threadsafe(cls.server.close(), cls.loop).result()
+        cls.loop.call_soon_threadsafe(cls.loop.stop)
+        cls.pipeline.storage.close()
+        shutil.rmtree(cls.tmpdir)
+
+    def _get(self, path: str):
+        conn = http.client.HTTPConnection("127.0.0.1", self.server.port, timeout=5)
+        try:
+            conn.request("GET", path)
+            response = conn.getresponse()
+            return response.status, json.loads(response.read())
+        finally:
+            conn.close()
+
+    def test_top_and_state(self):
+        status, body = self._get("/top?metric=cases&limit=1")
+        self.assertEqual(status, 200)
+        self.assertEqual([row["state"] for row in body], ["CA"])
+        status, body = self._get("/state/ny")
+        self.assertEqual((status, body["cases_total"]), (200, 5))
+
+    def test_timeline_streams_all_rows(self):
+        status, body = self._get("/timeline/CA?days=5")
+        self.assertEqual(status, 200)
+        self.assertEqual([row["cases_total"] for row in body], [70, 60, 50, 40, 30])
+
+    def test_timeline_range_streams_from_cursor(self):
+        status, body = self._get("/timeline/ca?from=2021-03-02&to=2021-03-04")
+        self.assertEqual(status, 200)
+        self.assertEqual(
+            [(row["date"], row["cases_total"]) for row in body],
+            [("2021-03-02", 20), ("2021-03-03", 30), ("2021-03-04", 40)],
+        )
+        self.assertEqual(self._get("/timeline/ZZ?from=2021-03-01"), (200, []))
+        # each stream hands its reader back to the pool
+        for _ in range(self.pipeline.config.pool_size + 1):
+            self.assertEqual(len(self._get("/timeline/CA?from=2021-03-01")[1]), 7)
+
+    def test_errors(self):
+        self.assertEqual(self._get("/state/ZZ")[0], 404)
+        self.assertEqual(self._get("/top?limit=abc")[0], 400)
+        self.assertEqual(self._get("/nowhere")[0], 404)
+        self.assertEqual(self._get("/timeline/CA?from=March")[0], 400)
+
+    def test_oversized_header_is_rejected(self):
+        conn = http.client.HTTPConnection("127.0.0.1", self.server.port, timeout=5)
+        try:
+            conn.putrequest("GET", "/summary")
+            conn.putheader("X-Padding", "a" * (128 * 1024))
+            conn.endheaders()
+            self.assertEqual(conn.getresponse().status, 431)
+        finally:
+            conn.close()
+
+    def test_keep_alive_reuses_connection(self):
+        conn = http.client.HTTPConnection("127.0.0.1", self.server.port, timeout=5)
+        try:
+            for _ in range(3):
+                conn.request("GET", "/summary")
+                response = conn.getresponse()
+                self.assertEqual(json.loads(response.read())["total_states"], 2)
+        finally:
+            conn.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,22 +1,36 @@
 import os
+import shutil
+import sqlite3
 import tempfile
 import unittest
+from concurrent.futures import ThreadPoolExecutor
 from datetime import date
 
 from configuration import Config
-from schema import covid_schema
-from store import sqlstorage
+from schema import covid_schema, record_batch
+from backend import open_storage
+from store import SECONDARY_INDEXES
 
+try:
+    import duckdb
+except ImportError:
+    duckdb = None
+
+
+class StorageBackendTests:
+    """Behaviour every storage backend shares; mixed into one TestCase per
+    backend below."""
+
+    backend = None
 
-class SQLStorageTests(unittest.TestCase):
     def setUp(self):
-        fd, path = tempfile.mkstemp(suffix=".db")
-        os.close(fd)
-        self.db_path = path
-        self.storage = sqlstorage(Config(db=self.db_path))
+        self.tmpdir = tempfile.mkdtemp()
+        self.db_path = os.path.join(self.tmpdir, "store.db")
+        self.storage = open_storage(Config(db=self.db_path, backend=self.backend))
+
     def tearDown(self):
-        if os.path.exists(self.db_path):
-            os.remove(self.db_path)
+        self.storage.close()
+        shutil.rmtree(self.tmpdir)
 
     def _record(self, state: str, record_date: date, cases: int, deaths: int = 0):
         return covid_schema(
@@ -51,6 +65,19 @@ class SQLStorageTests(unittest.TestCase):
         self.assertEqual(len(top_states), 2)
         self.assertEqual([s["state"] for s in top_states], ["CA", "NY"])
 
+    def test_top_states_as_of_date(self):
+        self.storage.insert_records([
+            self._record("CA", date(2021, 3, 6), 300),
+            self._record("CA", date(2021, 3, 7), 310),
+            self._record("NY", date(2021, 3, 6), 400),
+            self._record("TX", date(2021, 3, 6), 100),
+        ])
+        top = self.storage.get_top_states_by_cases(
+            limit=2, as_of_date=date(2021, 3, 6)
+        )
+        self.assertEqual([(r["state"], r["date"]) for r in top],
+                         [("NY", "2021-03-06"), ("CA", "2021-03-06")])
+
     def test_get_time_series_limits_results(self):
         records = [
             self._record("ny",date(2021,3,5), 10, 1),
@@ -63,6 +90,405 @@ class SQLStorageTests(unittest.TestCase):
         self.assertEqual(len(series), 2)
         self.assertEqual([r["date"] for r in series],["2021-03-07", "2021-03-06"])
 
+    def test_iter_time_range(self):
+        self.storage.insert_records([
+            self._record("CA", date(2021, 3, day), 10 * day, day)
+            for day in range(1, 8)
+        ] + [
+            self._record("NY", date(2021, 3, day), day) for day in range(4, 7)
+        ] + [self._record("TX", date(2021, 3, 5), 1)])
+        rows = list(self.storage.iter_time_range(
+            ["ny", "CA"], "2021-03-05", date(2021, 3, 6), ["deaths_total"]
+        ))
+        self.assertEqual(rows, [
+            {"state": "CA", "date": "2021-03-05", "deaths_total": 5},
+            {"state": "CA", "date": "2021-03-06", "deaths_total": 6},
+            {"state": "NY", "date": "2021-03-05", "deaths_total": 0},
+            {"state": "NY", "date": "2021-03-06", "deaths_total": 0},
+        ])
+        open_ended = list(self.storage.iter_time_range(start="2021-03-06"))
+        self.assertEqual(
+            [(r["state"], r["date"]) for r in open_ended],
+            [("CA", "2021-03-06"), ("CA", "2021-03-07"), ("NY", "2021-03-06")],
+        )
+        self.assertEqual(len(open_ended[0]), 11)
+        with self.assertRaises(ValueError):
+            list(self.storage.iter_time_range(["CA"], fields=["loaded_at"]))
+
+    def test_iter_batches(self):
+        self.storage.insert_records([
+            self._record("CA", date(2021, 3, day), 10 * day, day)
+            for day in range(1, 6)
+        ] + [self._record("NY", date(2021, 3, 4), 7)])
+        batches = list(self.storage.iter_batches(
+            fields=["cases_total"], start="2021-03-02", size=2
+        ))
+        self.assertEqual([len(batch) for batch in batches], [2, 2, 1])
+        self.assertEqual([tuple(row) for batch in batches for row in batch], [
+            ("CA", "2021-03-02", 20), ("CA", "2021-03-03", 30),
+            ("CA", "2021-03-04", 40), ("CA", "2021-03-05", 50),
+            ("NY", "2021-03-04", 7),
+        ])
+        self.assertEqual(
+            self.storage.export_columns("states", ["cases_total"]),
+            ["state", "date", "cases_total"],
+        )
+        self.storage.insert_derived("CA", [("CA", "2021-03-02", 10, 1, None, None, 10, 1)])
+        derived = [
+            tuple(row) for batch in self.storage.iter_batches(
+                "derived", ["ca"], fields=["new_cases", "reported_new_deaths"]
+            ) for row in batch
+        ]
+        self.assertEqual(derived, [("CA", "2021-03-02", 10, 1)])
+        with self.assertRaises(ValueError):
+            list(self.storage.iter_batches("rejected_records"))
+        with self.assertRaises(ValueError):
+            list(self.storage.iter_batches("derived", fields=["cases_total"]))
+
+    def _load_rollup_fixture(self):
+        self.storage.insert_records(
+            [self._record("CA", date(2021, 3, day), 10 * day, day) for day in range(1, 9)]
+            + [self._record("NY", date(2021, 2, 28), 5),
+               self._record("NY", date(2021, 3, 7), 7)]
+        )
+
+    def test_rollups(self):
+        self._load_rollup_fixture()
+        national = self.storage.get_national_daily("2021-03-07", "2021-03-08")
+        self.assertEqual(
+            [(r["date"], r["states"], r["cases_total"]) for r in national],
+            [("2021-03-07", 2, 77), ("2021-03-08", 1, 80)],
+        )
+        # no state reports in_icu_currently: the total counts it as 0
+        self.assertEqual(national[0]["in_icu_currently"], 0)
+        weeks = self.storage.get_rollups("week", ["CA"])
+        self.assertEqual(
+            [(r["start"], r["days"], r["last_date"], r["cases_total"], r["new_cases"])
+             for r in weeks],
+            [("2021-03-01", 7, "2021-03-07", 70, None),
+             ("2021-03-08", 1, "2021-03-08", 80, 10)],
+        )
+        months = self.storage.get_rollups("month", start="2021-03-01")
+        self.assertEqual(
+            [(r["state"], r["start"], r["cases_total"], r["new_cases"]) for r in months],
+            [("CA", "2021-03-01", 80, None), ("NY", "2021-03-01", 7, 2)],
+        )
+
+        # a later write updates the buckets it touches
+        self.storage.insert_records_incremental(
+            [self._record("CA", date(2021, 3, 7), 75, 7)], "CA"
+        )
+        self.assertEqual(
+            self.storage.get_national_daily("2021-03-07", "2021-03-07")[0]["cases_total"],
+            82,
+        )
+        weeks = self.storage.get_rollups("week", ["CA"], start="2021-03-08")
+        self.assertEqual(weeks[0]["new_cases"], 5)
+        with self.assertRaises(ValueError):
+            self.storage.get_rollups("year")
+
+    def test_insert_record_batch(self):
+        nulls = [[True] * 9, [True] * 9]
+        nulls[0][0] = nulls[1][0] = False
+        batch = record_batch(
+            ["CA", "CA"],
+            [18692, 18693],
+            [[10] + [0] * 8, [20] + [0] * 8],
+            nulls,
+        )
+        self.assertEqual(batch.to_records()[1].date, date(2021, 3, 7))
+        self.storage.insert_records(batch)
+        latest = self.storage.get_latest_by_state("CA")
+        self.assertEqual(latest["date"], "2021-03-07")
+        self.assertEqual(latest["cases_total"], 20)
+        self.assertIsNone(latest["deaths_total"])
+
+    def test_insert_records_incremental_counts(self):
+        records = [
+            self._record("CA", date(2021, 3, 6), 10, 1),
+            self._record("CA", date(2021, 3, 7), 20, 2),
+        ]
+        stats = self.storage.insert_records_incremental(records, "CA", "v1")
+        self.assertEqual(stats, {
+            "inserted": 2, "updated": 0, "skipped": 0, "first_changed": "2021-03-06",
+        })
+
+        records = [
+            self._record("CA", date(2021, 3, 6), 10, 1),
+            self._record("CA", date(2021, 3, 7), 25, 2),
+            self._record("CA", date(2021, 3, 8), 30, 3),
+        ]
+        stats = self.storage.insert_records_incremental(records, "CA", "v2")
+        self.assertEqual(stats, {
+            "inserted": 1, "updated": 1, "skipped": 1, "first_changed": "2021-03-07",
+        })
+        self.assertEqual(self.storage.get_latest_by_state("CA")["cases_total"], 30)
+        self.assertEqual(self.storage.get_time_series("CA", 2)[1]["cases_total"], 25)
+
+        watermark = self.storage.get_watermark("CA")
+        self.assertEqual(watermark["max_date"], "2021-03-08")
+        self.assertEqual(watermark["source_digest"], "v2")
+
+    def test_incremental_after_full_insert_compares_stored_rows(self):
+        records = [
+            self._record("CA", date(2021, 3, 6), 10, 1),
+            self._record("CA", date(2021, 3, 7), 20, 2),
+        ]
+        self.storage.insert_records(records)
+        generation = self.storage.get_generation()
+        stats = self.storage.insert_records_incremental(records, "CA")
+        self.assertEqual(
+            (stats["inserted"], stats["updated"], stats["skipped"]), (0, 0, 2)
+        )
+        self.assertEqual(self.storage.get_generation(), generation)
+        records[1] = self._record("CA", date(2021, 3, 7), 25, 2)
+        stats = self.storage.insert_records_incremental(records, "CA")
+        self.assertEqual(
+            (stats["inserted"], stats["updated"], stats["skipped"]), (0, 1, 1)
+        )
+        self.assertEqual(self.storage.get_latest_by_state("CA")["cases_total"], 25)
+
+    def test_full_insert_resets_watermark(self):
+        records = [self._record("CA", date(2021, 3, 6), 10, 1)]
+        self.storage.insert_records_incremental(records, "CA", "v1")
+        self.storage.insert_records(records)
+        self.assertIsNone(self.storage.get_watermark("CA"))
+
+    def test_writes_bump_generation(self):
+        self.assertEqual(self.storage.get_generation(), 0)
+        records = [self._record("CA", date(2021, 3, 7), 20, 2)]
+        self.storage.insert_records(records)
+        self.assertEqual(self.storage.get_generation(), 1)
+        records = [self._record("CA", date(2021, 3, 7), 25, 2)]
+        self.storage.insert_records_incremental(records, "CA")
+        self.storage.insert_records_incremental(records, "CA")
+        self.assertEqual(self.storage.get_generation(), 2)
+
+    def test_savepoint_rolls_back_only_its_block(self):
+        with self.storage.session() as conn:
+            with self.storage.savepoint(conn):
+                self.storage.insert_records([self._record("CA", date(2021, 3, 7), 20)])
+            with self.assertRaises(RuntimeError):
+                with self.storage.savepoint(conn):
+                    self.storage.insert_records([self._record("NY", date(2021, 3, 7), 5)])
+                    raise RuntimeError("state failed")
+        self.assertEqual(self.storage.get_latest_by_state("CA")["cases_total"], 20)
+        self.assertIsNone(self.storage.get_latest_by_state("NY"))
+
+    def test_load_run_checkpoints(self):
+        run_id = self.storage.begin_load_run("input-1", "full")
+        with self.storage.session() as conn:
+            with self.storage.savepoint(conn):
+                self.storage.insert_records([self._record("CA", date(2021, 3, 7), 20)])
+                self.storage.complete_state(run_id, "ca", 1)
+            with self.assertRaises(RuntimeError):
+                with self.storage.savepoint(conn):
+                    self.storage.complete_state(run_id, "NY", 1)
+                    raise RuntimeError("state failed")
+        self.assertEqual(self.storage.get_completed_states(run_id), {"CA": 1})
+        self.storage.finish_load_run(run_id, "partial")
+        # resuming reopens the latest run on the same input only
+        self.assertEqual(self.storage.begin_load_run("input-1", "full", resume=True), run_id)
+        self.assertNotEqual(self.storage.begin_load_run("input-2", "full", resume=True), run_id)
+        self.assertNotEqual(self.storage.begin_load_run("input-1", "full"), run_id)
+        runs = self.storage.get_load_runs()
+        self.assertEqual(len(runs), 3)
+        self.assertEqual(
+            [(r["id"], r["status"], r["states"], r["records"]) for r in runs][-1],
+            (run_id, "running", 1, 1),
+        )
+
+    def test_history_and_summary(self):
+        self.storage.insert_records([
+            self._record("CA", date(2021, 3, 6), 10, 1),
+            self._record("CA", date(2021, 3, 7), 20, 2),
+            self._record("NY", date(2021, 3, 6), 5, 1),
+        ])
+        history = self.storage.get_history(["CA"])
+        self.assertEqual([row[:3] for row in history],
+                         [("CA", "2021-03-06", 10), ("CA", "2021-03-07", 20)])
+        summary = self.storage.get_summary_stats()
+        self.assertEqual(summary["total_states"], 2)
+        self.assertEqual(summary["total_cases"], 25)
+        self.assertEqual(summary["latest_date"], "2021-03-07")
+
+    def test_quarantine_upserts_by_raw_row(self):
+        self.storage.quarantine([
+            ("CA", "2021-02-30", "bad_date", '{"date":"2021-02-30"}'),
+            ("CA", "2021-03-07", "negative_cases_total", '{"positive":"-1"}'),
+        ])
+        self.storage.quarantine([
+            ("CA", "2021-02-30", "bad_state", '{"date":"2021-02-30"}'),
+        ])
+        rows = self.storage.get_rejected("ca")
+        self.assertEqual([(r["date"], r["reason"]) for r in rows],
+                         [("2021-02-30", "bad_state"),
+                          ("2021-03-07", "negative_cases_total")])
+        self.assertEqual(self.storage.get_rejected_counts(), [
+            {"state": "CA", "reason": "bad_state", "rows": 1},
+            {"state": "CA", "reason": "negative_cases_total", "rows": 1},
+        ])
+        self.storage.delete_rejected([rows[0]["id"]])
+        self.assertEqual(len(self.storage.get_rejected(reason="bad_state")), 0)
+        self.assertEqual(self.storage.get_generation(), 0)
+
+
+class SQLStorageTests(StorageBackendTests, unittest.TestCase):
+    backend = "sqlite"
+
+    def test_latest_by_state_check_and_rebuild(self):
+        self.storage.insert_records([
+            self._record("CA", date(2021, 3, 6), 10, 1),
+            self._record("NY", date(2021, 3, 6), 5, 1),
+        ])
+        self.storage.insert_records([self._record("CA", date(2021, 3, 7), 20, 2)])
+        self.assertEqual(self.storage.check_latest(), [])
+        self.assertEqual(self.storage.get_summary_stats()["total_cases"], 25)
+
+        with self.storage._get_connection() as conn:
+            conn.execute("UPDATE latest_by_state SET cases_total = 0 WHERE state = 'NY'")
+            conn.commit()
+        self.assertEqual(self.storage.check_latest(), ["NY"])
+        self.storage.rebuild_latest()
+        self.assertEqual(self.storage.check_latest(), [])
+        self.assertEqual(self.storage.get_latest_by_state("NY")["cases_total"], 5)
+
+    def test_pooled_readers_are_read_only_and_shareable(self):
+        self.storage.insert_records([
+            self._record("CA", date(2021, 3, 7), 20, 2),
+            self._record("NY", date(2021, 3, 7), 15, 1),
+        ])
+        with self.storage.pool.reader() as conn:
+            with self.assertRaises(sqlite3.OperationalError):
+                conn.execute("DELETE FROM covid_states")
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            results = list(executor.map(
+                lambda _: self.storage.get_top_states_by_cases(limit=1), range(32)
+            ))
+        self.assertTrue(all(r[0]["state"] == "CA" for r in results))
+
+    def _index_names(self):
+        with self.storage._get_connection() as conn:
+            return {
+                row[0] for row in conn.execute(
+                    "SELECT name FROM sqlite_master WHERE type = 'index'"
+                )
+            }
+
+    def test_migrates_schema_1_database(self):
+        path = os.path.join(self.tmpdir, "v1.db")
+        with sqlite3.connect(path) as conn:
+            conn.execute("""
+                CREATE TABLE covid_states (
+                    state TEXT NOT NULL,
+                    date DATE NOT NULL,
+                    cases_total INTEGER, cases_confirmed INTEGER,
+                    deaths_total INTEGER, deaths_confirmed INTEGER,
+                    deaths_probable INTEGER, hospitalized_currently INTEGER,
+                    hospitalized_cumulative INTEGER, in_icu_currently INTEGER,
+                    tests_total INTEGER,
+                    loaded_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    PRIMARY KEY (state, date)
+                )
+            """)
+            conn.execute("CREATE INDEX idx_state ON covid_states(state)")
+            conn.executemany(
+                "INSERT INTO covid_states (state, date, cases_total) VALUES (?, ?, ?)",
+                [("CA", "2021-03-06", 10), ("CA", "2021-03-07", 20),
+                 ("NY", "2021-03-07", 5)],
+            )
+        conn.close()
+
+        storage = open_storage(Config(db=path), read_only=True)
+        self.addCleanup(storage.close)
+        self.assertEqual(storage.get_latest_by_state("CA")["date"], "2021-03-07")
+        self.assertEqual(
+            [r["cases_total"] for r in storage.get_time_series("CA")], [20, 10]
+        )
+        self.assertEqual(storage.get_summary_stats()["latest_date"], "2021-03-07")
+        with storage._get_connection(readonly=True) as conn:
+            ddl = conn.execute(
+                "SELECT sql FROM sqlite_master WHERE name = 'covid_states'"
+            ).fetchone()[0]
+            indexes = {
+                row[0] for row in conn.execute(
+                    "SELECT name FROM sqlite_master WHERE type = 'index'"
+                    " AND tbl_name = 'covid_states'"
+                )
+            }
+        self.assertIn("WITHOUT ROWID", ddl)
+        self.assertNotIn("loaded_at", ddl)
+        self.assertEqual(indexes, set(SECONDARY_INDEXES))
+
+    def test_incremental_rollups_match_rebuild(self):
+        self._load_rollup_fixture()
+        with self.storage.session():
+            self.storage.insert_records(
+                [self._record("TX", date(2021, 1, 31), 3),
+                 self._record("CA", date(2021, 3, 2), 1)]
+            )
+
+        def tables():
+            with self.storage._get_connection(readonly=True) as conn:
+                return [
+                    conn.execute(f"SELECT * FROM {table} ORDER BY 1, 2, 3").fetchall()
+                    for table in ("rollup_national_daily", "rollup_state_period")
+                ]
+
+        incremental = [[tuple(row) for row in rows] for rows in tables()]
+        self.storage.rebuild_rollups()
+        rebuilt = [[tuple(row) for row in rows] for rows in tables()]
+        self.assertEqual(incremental, rebuilt)
+        with self.storage._get_connection(readonly=True) as conn:
+            self.assertIsNone(conn.execute("SELECT * FROM rollup_dirty").fetchone())
+
+    def test_bulk_load_rebuilds_indexes(self):
+        with self.storage.bulk_load():
+            self.assertFalse(set(SECONDARY_INDEXES) & self._index_names())
+            self.storage.insert_records([self._record("CA", date(2021, 3, 7), 20)])
+        self.assertTrue(set(SECONDARY_INDEXES) <= self._index_names())
+        self.assertEqual(self.storage.get_latest_by_state("CA")["cases_total"], 20)
+
+    def test_only_bulk_load_relaxes_synchronous(self):
+        full = 2
+        with self.storage.bulk_load() as conn:
+            self.assertEqual(conn.execute("PRAGMA synchronous").fetchone()[0], 0)
+        with self.storage.pool.writer() as conn:
+            self.assertEqual(conn.execute("PRAGMA synchronous").fetchone()[0], full)
+
+    def test_bulk_load_rolls_back_on_failure(self):
+        with self.assertRaises(RuntimeError):
+            with self.storage.bulk_load():
+                self.storage.insert_records([self._record("CA", date(2021, 3, 7), 20)])
+                raise RuntimeError("load failed")
+        self.assertIsNone(self.storage.get_latest_by_state("CA"))
+        self.assertTrue(set(SECONDARY_INDEXES) <= self._index_names())
+
+
+@unittest.skipIf(duckdb is None, "duckdb is not installed")
+class DuckDBStorageTests(StorageBackendTests, unittest.TestCase):
+    backend = "duckdb"
+
+    def test_ingest_csv_matches_pipeline_cleaning(self):
+        csv_path = os.path.join(self.tmpdir, "history.csv")
+        with open(csv_path, "w") as f:
+            f.write("date,state,positive,death,totalTestResults\n")
+            f.write("2021-03-07,ca,20.9,2,100\n")
+            f.write("2021-03-06,CA,,x,90\n")
+            f.write("2021-03-05,CA,-1,1,80\n")
+            f.write("not-a-date,CA,1,1,1\n")
+            f.write("2021-03-07,NY,5,1,50\n")
+        self.assertEqual(self.storage.ingest_csv(csv_path, ["ca"]), 2)
+        self.assertEqual(self.storage.get_history(), [
+            ("CA", "2021-03-06", None, None, None, None, None, None, None, None, 90),
+            ("CA", "2021-03-07", 20, None, 2, None, None, None, None, None, 100),
+        ])
+        self.assertEqual(self.storage.get_generation(), 1)
+        self.assertEqual(self.storage.get_rejected_counts(), [
+            {"state": "CA", "reason": "bad_date", "rows": 1},
+            {"state": "CA", "reason": "negative_cases_total", "rows": 1},
+        ])
+
 
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
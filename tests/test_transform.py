@@ -0,0 +1,62 @@
+import unittest
+from datetime import date
+
+from transform import data_cleaner
+
+
+class BatchCleanTests(unittest.TestCase):
+    def setUp(self):
+        self.cleaner = data_cleaner()
+        self.records = [
+            {"date": "2021-03-07", "positive": "20", "death": "2"},
+            {"date": "2021-02-30", "positive": "10", "death": "1"},
+            {"date": "2021-3-05", "positive": "1.5e3", "death": ""},
+            {"date": "2021-03-04", "positive": "-4", "death": "1"},
+            {"date": "2021-03-03", "positive": "abc", "death": None},
+            {"date": "0000-01-01", "positive": "5", "death": "0"},
+            {"date": "2021-03-02", "positive": "99999999999999999999", "death": "3"},
+        ]
+
+    def _columns(self):
+        keys = {key for record in self.records for key in record}
+        return {key: [r.get(key) for r in self.records] for key in keys}
+
+    def test_clean_batch_matches_row_path(self):
+        rows = self.cleaner.clean_and_validate(self.records, "ca")
+        batch, rejected = self.cleaner.clean_batch(self._columns(), "ca")
+        self.assertEqual(
+            rejected.tolist(), [False, True, False, True, False, True, False]
+        )
+        self.assertEqual(batch.to_records(), rows)
+        # an oversized cell is nulled like an unparsable one
+        self.assertEqual(batch.metric("cases_total").tolist()[-1], None)
+        self.assertEqual(batch.metric("deaths_total").tolist()[-1], 3)
+
+    def test_reject_reasons(self):
+        columns = self._columns()
+        _, rejected = self.cleaner.clean_batch(columns, "ca")
+        self.assertEqual(
+            self.cleaner.reject_reasons(columns, rejected, "ca"),
+            ["bad_date", "negative_cases_total", "bad_date"],
+        )
+        self.assertEqual(
+            self.cleaner.reject_reasons(columns, rejected, "cal"),
+            ["bad_state", "bad_state", "bad_state"],
+        )
+
+    def test_clean_batch_rejects_bad_state_codes(self):
+        columns = {
+            "date": ["2021-03-07", "2021-03-07"],
+            "state": ["ny", "CAL"],
+            "positive": ["1", "2"],
+        }
+        batch, rejected = self.cleaner.clean_batch(columns)
+        self.assertEqual(rejected.tolist(), [False, True])
+        self.assertEqual(batch.states.tolist(), ["NY"])
+        self.assertEqual(batch.dates().tolist(), [date(2021, 3, 7)])
+        self.assertEqual(batch.metric("cases_total").tolist(), [1])
+        self.assertEqual(batch.metric("deaths_total").tolist(), [None])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,21 +1,42 @@
 from datetime import datetime, date
-from typing import Dict, Any, List
+from typing import Dict, Any, List, Sequence, Tuple
 from typing import Optional
 
-from schema import covid_schema
+import numpy as np
+
+from schema import covid_schema, record_batch, METRIC_FIELDS
 import logging
 
 logger = logging.getLogger(__name__)
 
+# output column -> source CSV column
+METRIC_SOURCES = {
+    "cases_total": "positive",
+    "cases_confirmed": "positiveCasesViral",
+    "deaths_total": "death",
+    "deaths_confirmed": "deathConfirmed",
+    "deaths_probable": "deathProbable",
+    "hospitalized_currently": "hospitalizedCurrently",
+    "hospitalized_cumulative": "hospitalizedCumulative",
+    "in_icu_currently": "inIcuCurrently",
+    "tests_total": "totalTestResults",
+}
+
+_DATE_DIGITS = [0, 1, 2, 3, 5, 6, 8, 9]
+
+# metrics are stored as int64; larger cells are treated as unparsable
+_INT64 = np.iinfo(np.int64)
+
 class data_cleaner:
     @staticmethod
     def _parse_int(value: Optional[str]) -> Optional[int]:
         if value in (None, ""):
             return None
         try:
-            return int(float(value))
-        except (TypeError, ValueError):
+            parsed = int(float(value))
+        except (TypeError, ValueError, OverflowError):
             return None
+        return parsed if _INT64.min <= parsed <= _INT64.max else None
 
     @staticmethod
     def _parse_date(value: str):
@@ -38,16 +59,176 @@ class data_cleaner:
     def clean_and_validate(self, records: List[Dict[str, Any]], state: str
     ) -> List[covid_schema]:
         cleaned: List[covid_schema] = []
+        skipped = 0
+        first_error = None
         for record in records:
             try:
                 normalized = self.normalize(record, state)
                 cleaned.append(covid_schema(**normalized))
             except (ValueError, TypeError) as exc:
-                logger.warning(
-                    "Skipping invalid record for %s on %s: %s",
-                    state,
-                    record.get("date"),
-                    exc,
-                )
+                skipped += 1
+                if first_error is None:
+                    first_error = f"{record.get('date')}: {exc}"
                 continue
-        return cleaned
\ No newline at end of file
+        if skipped:
+            # one line per call, not per row: dirty input shouldn't flood logs
+            logger.warning(
+                "Skipping %d invalid records for %s (first at %s)",
+                skipped, state, first_error,
+            )
+        return cleaned
+
+    @staticmethod
+    def _as_str_array(values: Sequence[Optional[str]]) -> np.ndarray:
+        # None turns into "None", which the parsers below treat as invalid
+        return np.asarray(values, dtype=str)
+
+    @staticmethod
+    def _char_codes(values: np.ndarray, width: int) -> np.ndarray:
+        fixed = values.astype(f"U{width}")
+        return fixed.view(np.uint32).reshape(len(values), width)
+
+    def _parse_dates(self, values: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Parse dates, returning datetime64[D] and an invalid mask.
+
+        Strict YYYY-MM-DD strings are decoded from their character codes;
+        anything else goes through _parse_date like the per-row path.
+        """
+        slow = np.char.str_len(values) != 10
+        codes = self._char_codes(values, 10)
+        digits = codes[:, _DATE_DIGITS]
+        slow |= ((digits < 48) | (digits > 57)).any(axis=1)
+        slow |= (codes[:, 4] != 45) | (codes[:, 7] != 45)
+        digits = np.where(slow[:, None], 48, digits).astype(np.int64) - 48
+        year = digits[:, :4] @ np.array([1000, 100, 10, 1])
+        month = digits[:, 4] * 10 + digits[:, 5]
+        day = digits[:, 6] * 10 + digits[:, 7]
+        # strptime rejects year 0, and datetime.date can't hold it
+        invalid = ~slow & ((year < 1) | (month < 1) | (month > 12) | (day < 1))
+        month = np.where(slow | invalid, 1, month)
+        first = ((year - 1970) * 12 + month - 1).astype("datetime64[M]")
+        first_day = first.astype("datetime64[D]")
+        days_in_month = ((first + 1).astype("datetime64[D]") - first_day).astype(np.int64)
+        invalid |= ~slow & (day > days_in_month)
+        dates = first_day + np.where(slow | invalid, 0, day - 1)
+        for i in np.flatnonzero(slow):
+            try:
+                dates[i] = np.datetime64(self._parse_date(values[i]))
+            except (TypeError, ValueError):
+                invalid[i] = True
+        dates[invalid] = np.datetime64("NaT")
+        return dates, invalid
+
+    def _parse_ints(self, values: np.ndarray) -> np.ma.MaskedArray:
+        """Vectorized int(float(value)); blank, unparsable or out of int64
+        range cells are masked.
+
+        Plain digit strings are decoded from their character codes; anything
+        else (signs, decimals, exponents) goes through _parse_int.
+        """
+        size = len(values)
+        lengths = np.char.str_len(values)
+        width = int(lengths.max()) if size else 0
+        null = lengths == 0
+        if width == 0:
+            return np.ma.MaskedArray(np.zeros(size, dtype=np.int64), mask=null)
+        codes = self._char_codes(values, min(width, 18)).astype(np.int64) - 48
+        slow = lengths > 18
+        ints = np.zeros(size, dtype=np.int64)
+        for position in range(codes.shape[1]):
+            used = position < lengths
+            digit = codes[:, position]
+            slow |= used & ((digit < 0) | (digit > 9))
+            ints = np.where(used, ints * 10 + digit, ints)
+        for i in np.flatnonzero(slow):
+            parsed = self._parse_int(values[i])
+            if parsed is None:
+                null[i] = True
+            else:
+                ints[i] = parsed
+        return np.ma.MaskedArray(ints, mask=null)
+
+    def clean_batch(self, columns: Dict[str, Sequence[Optional[str]]],
+                    state: Optional[str] = None
+                    ) -> Tuple[record_batch, np.ndarray]:
+        """Clean a whole state (or file) worth of raw CSV columns at once.
+
+        Returns the accepted rows as a record_batch and a mask of rejected
+        input rows.
+        """
+        raw_dates = self._as_str_array(columns["date"])
+        size = len(raw_dates)
+        if state is not None:
+            states = np.full(size, state.upper(), dtype="U2")
+            bad_state = np.full(size, len(state) != 2)
+        else:
+            raw_states = self._as_str_array(columns["state"])
+            bad_state = np.char.str_len(raw_states) != 2
+            codes = self._char_codes(raw_states, 2)
+            lower = (codes >= 97) & (codes <= 122)
+            states = np.where(lower, codes - 32, codes).astype(np.uint32).view("U2").ravel()
+
+        dates, rejected = self._parse_dates(raw_dates)
+        rejected |= bad_state
+        values = np.empty((size, len(METRIC_FIELDS)), dtype=np.int64)
+        nulls = np.empty((size, len(METRIC_FIELDS)), dtype=bool)
+        for col, name in enumerate(METRIC_FIELDS):
+            parsed = self._parse_ints(
+                self._as_str_array(columns.get(METRIC_SOURCES[name], [""] * size))
+            )
+            values[:, col] = parsed.data
+            nulls[:, col] = parsed.mask
+            rejected |= ~parsed.mask & (parsed.data < 0)
+
+        if rejected.any():
+            # callers report rejects per run, see quarantine.reject_log
+            logger.debug(
+                "Skipping %d invalid records out of %d", int(rejected.sum()), size
+            )
+        keep = ~rejected
+        batch = record_batch(
+            states[keep],
+            dates[keep].astype(np.int32),
+            values[keep],
+            nulls[keep],
+        )
+        return batch, rejected
+
+    def reject_reasons(self, columns: Dict[str, Sequence[Optional[str]]],
+                       rejected: np.ndarray, state: Optional[str] = None
+                       ) -> List[str]:
+        """Reason codes for the rows clean_batch rejected, in row order.
+
+        Only rejected rows are re-checked, each until its first failing
+        check: bad_state, bad_date, then negative_<metric> in METRIC_FIELDS
+        order. Clean input costs nothing here.
+        """
+        rows = np.flatnonzero(rejected)
+        reasons = np.full(len(rows), "invalid", dtype=object)
+        # positions in rows whose reason is still unknown
+        pending = np.arange(len(rows))
+
+        def column(name: str) -> np.ndarray:
+            source = columns.get(name)
+            picked = rows[pending].tolist()
+            if source is None:
+                return np.full(len(picked), "", dtype=str)
+            return self._as_str_array([source[i] for i in picked])
+
+        def settle(failed: np.ndarray, reason: str):
+            nonlocal pending
+            reasons[pending[failed]] = reason
+            pending = pending[~failed]
+
+        if state is not None:
+            settle(np.full(len(pending), len(state) != 2), "bad_state")
+        else:
+            settle(np.char.str_len(column("state")) != 2, "bad_state")
+        if len(pending):
+            settle(self._parse_dates(column("date"))[1], "bad_date")
+        for name in METRIC_FIELDS:
+            if not len(pending):
+                break
+            parsed = self._parse_ints(column(METRIC_SOURCES[name]))
+            settle(~parsed.mask & (parsed.data < 0), f"negative_{name}")
+        return reasons.tolist()